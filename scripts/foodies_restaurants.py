@@ -1,77 +1,127 @@
 #!/usr/bin/env python
 # filepath: /Users/ks6088ts/src/github.com/ks6088ts-labs/template-fastapi/scripts/foodies_restaurants.py
 
-import csv
-
+import asyncio
+import gc
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import httpx
+import numpy as np
 import typer
+from fastapi import FastAPI
 from rich.console import Console
+from rich.table import Table
 
 from template_fastapi.models.restaurant import Restaurant
-from template_fastapi.repositories.restaurants import RestaurantRepository
+from template_fastapi.repositories.embeddings import EmbeddingBatcher, EmbeddingCache, FakeEmbedder
+from template_fastapi.repositories.restaurant_cache import RestaurantItemCache, RestaurantResultCache
+from template_fastapi.repositories.restaurant_geo import RestaurantGeoIndex, haversine_km
+from template_fastapi.repositories.restaurant_import import ImportProgress, import_restaurants
+from template_fastapi.repositories.restaurant_reembed import ReembedProgress, reembed_restaurants
+from template_fastapi.repositories.restaurant_vectors import RestaurantVectorIndex, quantize_vector
+from template_fastapi.repositories.restaurants import (
+    _ALL_QUERY,
+    AsyncRestaurantRepository,
+    RestaurantRepository,
+    embedding_model_version,
+)
+from template_fastapi.routers import foodies
+from template_fastapi.settings.restaurants import get_restaurants_settings
 
 app = typer.Typer()
 console = Console()
 restaurant_repo = RestaurantRepository()
-
-
-def read_csv_data(file_path: str) -> list[Restaurant]:
-    """CSVファイルからレストランデータを読み込む"""
-    restaurants = []
-    with open(file_path, encoding="utf-8") as csvfile:
-        csv_reader = csv.DictReader(csvfile)
-        for row in csv_reader:
-            # タグをリストに変換
-            tags = row["tags"].strip('"').split(",") if row["tags"] else []
-            restaurant = Restaurant(
-                id=row["id"],
-                name=row["name"],
-                description=row["description"],
-                price=float(row["price"]),
-                latitude=float(row["latitude"]) if row["latitude"] else None,
-                longitude=float(row["longitude"]) if row["longitude"] else None,
-                tags=tags,
-            )
-            restaurants.append(restaurant)
-    return restaurants
+restaurants_settings = get_restaurants_settings()
 
 
 @app.command()
 def import_data(
     csv_file: str = typer.Option(..., "--csv-file", "-f", help="CSVファイルのパス"),
-    batch_size: int = typer.Option(100, "--batch-size", "-b", help="一度に処理するバッチサイズ"),
+    batch_size: int = typer.Option(100, "--batch-size", "-b", help="1回の埋め込み要求にまとめる行数"),
+    concurrency: int = typer.Option(8, "--concurrency", "-c", help="並行して書き込む件数"),
+    checkpoint_file: str | None = typer.Option(
+        None, "--checkpoint", help="再開用のチェックポイントファイル（既定: <CSVファイル>.checkpoint）"
+    ),
+    restart: bool = typer.Option(False, "--restart", help="チェックポイントを無視して最初からインポートする"),
 ):
-    """CSVからデータをデータベースにインポートしてベクトル検索を設定する"""
-    console.print(f"[bold green]CSVファイル[/bold green]: {csv_file}からデータを読み込みます")
-
-    # CSVデータの読み込み
-    restaurants = read_csv_data(csv_file)
-    console.print(f"[bold blue]{len(restaurants)}件[/bold blue]のレストランデータを読み込みました")
-
-    # データの登録
-    console.print("[bold yellow]レストランデータをデータベースに登録しています...[/bold yellow]")
-
-    # バッチサイズごとに処理
-    for i in range(0, len(restaurants), batch_size):
-        batch = restaurants[i : i + batch_size]
-        for restaurant in batch:
-            created_restaurant = restaurant_repo.create_restaurant(restaurant)
-            console.print(f"ID: {created_restaurant.id} - {created_restaurant.name}を登録しました")
+    """CSVからデータをデータベースにインポートしてベクトル検索を設定する（中断しても続きから再開できる）"""
+    checkpoint_file = checkpoint_file or f"{csv_file}.checkpoint"
+    if restart:
+        Path(checkpoint_file).unlink(missing_ok=True)
+    console.print(f"[bold green]CSVファイル[/bold green]: {csv_file}からデータをインポートします")
+
+    def report(progress: ImportProgress) -> None:
+        console.print(
+            f"[bold blue]{progress.rows}件[/bold blue]処理完了 "
+            f"({progress.rows_per_second:,.1f} 件/秒, 再開位置: {progress.resumed_rows}件目)"
+        )
+
+    result = import_restaurants(
+        restaurant_repo,
+        csv_file,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        checkpoint_file=checkpoint_file,
+        on_progress=report,
+    )
+    imported = result.rows - result.resumed_rows
+    console.print(
+        f"[bold green]{imported}件のデータを{result.seconds:.1f}秒で登録しました！[/bold green]"
+        f" ({result.rows_per_second:,.1f} 件/秒)"
+    )
 
-        console.print(f"[bold blue]{min(i + batch_size, len(restaurants))}/{len(restaurants)}件[/bold blue]処理完了")
 
-    console.print("[bold green]すべてのデータが正常に登録されました！[/bold green]")
+@app.command()
+def reembed(
+    batch_size: int = typer.Option(
+        100, "--batch-size", "-b", help="1ページで読み出し、1回の埋め込み要求にまとめる件数"
+    ),
+    concurrency: int = typer.Option(8, "--concurrency", "-c", help="並行して書き戻す件数"),
+    checkpoint_file: str = typer.Option(".reembed.checkpoint", "--checkpoint", help="再開用のチェックポイントファイル"),
+    restart: bool = typer.Option(False, "--restart", help="チェックポイントを無視して最初から確認する"),
+    force: bool = typer.Option(False, "--force", help="古くなっていないベクトルも含めてすべて埋め込み直す"),
+):
+    """説明文や埋め込みモデルが変わって古くなったベクトルだけを埋め込み直す（中断しても続きから再開できる）"""
+    if restart:
+        Path(checkpoint_file).unlink(missing_ok=True)
+    console.print(f"[bold green]埋め込みモデル[/bold green]: {embedding_model_version()}でベクトルを確認します")
+
+    def report(progress: ReembedProgress) -> None:
+        console.print(
+            f"[bold blue]{progress.scanned}件[/bold blue]確認済み "
+            f"({progress.reembedded}件を埋め込み直し, {progress.conflicts}件は更新中のためスキップ)"
+        )
+
+    result = reembed_restaurants(
+        restaurant_repo,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        checkpoint_file=checkpoint_file,
+        force=force,
+        on_progress=report,
+    )
+    console.print(
+        f"[bold green]{result.scanned}件中{result.reembedded}件を埋め込み直しました！[/bold green]"
+        f" ({result.scanned_per_second:,.1f} 件/秒)"
+    )
 
 
 @app.command()
 def search(
     query: str = typer.Option(..., "--query", "-q", help="検索クエリ"),
     k: int = typer.Option(3, "--top-k", "-k", help="取得する上位結果の数"),
+    cursor: str | None = typer.Option(None, "--cursor", help="前回の検索結果に表示された続きのカーソル"),
 ):
     """説明文のベクトル検索を実行する"""
     console.print(f"[bold green]クエリ[/bold green]: '{query}'で検索します")
 
     # レポジトリを使用してベクトル検索を実行
-    results = restaurant_repo.search_restaurants(query=query, k=k)
+    results, next_cursor = restaurant_repo.search_restaurants_after(query=query, cursor=cursor, k=k)
 
     # 結果の表示
     console.print(f"\n[bold blue]{len(results)}件[/bold blue]の検索結果:")
@@ -82,23 +132,51 @@ def search(
         console.print(f"   タグ: {', '.join(restaurant.tags)}")
         if restaurant.latitude and restaurant.longitude:
             console.print(f"   位置: 緯度 {restaurant.latitude}, 経度 {restaurant.longitude}")
+    _print_next_cursor(next_cursor)
 
     return results
 
 
+@app.command()
+def list_restaurants(
+    limit: int = typer.Option(10, "--limit", "-l", help="取得する最大件数"),
+    cursor: str | None = typer.Option(None, "--cursor", help="前回の一覧に表示された続きのカーソル"),
+):
+    """レストランの一覧を取得する"""
+    results, next_cursor = restaurant_repo.list_restaurants_after(cursor=cursor, limit=limit)
+
+    table = Table(title=f"{len(results)}件のレストラン")
+    table.add_column("ID")
+    table.add_column("名前")
+    table.add_column("価格", justify="right")
+    table.add_column("タグ")
+    for restaurant in results:
+        table.add_row(restaurant.id, restaurant.name, f"¥{restaurant.price}", ", ".join(restaurant.tags))
+    console.print(table)
+    _print_next_cursor(next_cursor)
+
+    return results
+
+
+def _print_next_cursor(next_cursor: str | None) -> None:
+    if next_cursor:
+        console.print(f"\n[bold yellow]続きのカーソル[/bold yellow]: {next_cursor}")
+
+
 @app.command()
 def find_nearby(
     latitude: float = typer.Option(..., "--latitude", "-lat", help="緯度"),
     longitude: float = typer.Option(..., "--longitude", "-lon", help="経度"),
     distance_km: float = typer.Option(5.0, "--distance", "-d", help="検索半径（キロメートル）"),
     limit: int = typer.Option(10, "--limit", "-l", help="取得する最大件数"),
+    cursor: str | None = typer.Option(None, "--cursor", help="前回の検索結果に表示された続きのカーソル"),
 ):
     """位置情報に基づいて近くのレストランを検索する"""
     console.print(f"[bold green]位置[/bold green]: 緯度 {latitude}, 経度 {longitude}の{distance_km}km圏内を検索します")
 
     # レポジトリを使用して位置検索を実行
-    results = restaurant_repo.find_nearby_restaurants(
-        latitude=latitude, longitude=longitude, distance_km=distance_km, limit=limit
+    results, next_cursor = restaurant_repo.find_nearby_restaurants_after(
+        latitude=latitude, longitude=longitude, cursor=cursor, distance_km=distance_km, limit=limit
     )
 
     # 結果の表示
@@ -110,6 +188,8 @@ def find_nearby(
         console.print(f"   タグ: {', '.join(restaurant.tags)}")
         if restaurant.latitude and restaurant.longitude:
             console.print(f"   位置: 緯度 {restaurant.latitude}, 経度 {restaurant.longitude}")
+        console.print(f"   距離: {restaurant.distance_km:.2f}km")
+    _print_next_cursor(next_cursor)
 
     return results
 
@@ -168,5 +248,599 @@ def delete_restaurant(
         console.print(f"[bold red]エラー[/bold red]: {str(e)}")
 
 
+@app.command()
+def benchmark_embeddings(
+    requests: int = typer.Option(2000, "--requests", "-n", help="埋め込み要求の数"),
+    concurrency: int = typer.Option(64, "--concurrency", "-c", help="同時に要求するスレッド数"),
+    latency_ms: float = typer.Option(50.0, "--latency", "-l", help="模擬するAPI呼び出しのレイテンシ（ミリ秒）"),
+    batch_size: int = typer.Option(64, "--batch-size", "-b", help="1回のAPI呼び出しにまとめる最大件数"),
+    api_concurrency: int = typer.Option(8, "--api-concurrency", "-a", help="APIが同時に処理する呼び出し数の上限"),
+):
+    """同時に届く埋め込み要求を、個別に呼び出す場合とマイクロバッチでまとめる場合で比較する（Azureは呼び出さない）"""
+    texts = [f"query {i}" for i in range(requests)]
+    table = Table(
+        title=f"{requests} embedding requests, {concurrency} concurrent, "
+        f"{latency_ms:.0f} ms per API call, {api_concurrency} calls served at once"
+    )
+    table.add_column("mode")
+    table.add_column("API calls", justify="right")
+    table.add_column("requests/sec", justify="right")
+
+    for mode in ["unbatched", "micro-batched"]:
+        embedder = FakeEmbedder(latency=latency_ms / 1000)
+        # レート制限されたAPIのように、同時に処理される呼び出し数を制限する
+        api_slots = threading.Semaphore(api_concurrency)
+
+        def call_api(texts: list[str], embedder=embedder, api_slots=api_slots) -> list[list[float]]:
+            with api_slots:
+                return embedder(texts)
+
+        batcher = EmbeddingBatcher(call_api, max_batch_size=batch_size)
+        embed = (lambda text: call_api([text])[0]) if mode == "unbatched" else (lambda text: batcher.embed([text])[0])
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(embed, texts))
+        elapsed = time.perf_counter() - start
+        batcher.close()
+        table.add_row(mode, str(len(embedder.calls)), f"{requests / elapsed:,.0f}")
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_async(
+    requests: int = typer.Option(2000, "--requests", "-n", help="リクエスト数"),
+    concurrency: int = typer.Option(200, "--concurrency", "-c", help="同時に送るリクエスト数"),
+    latency_ms: float = typer.Option(20.0, "--latency", "-l", help="模擬するCosmosDBの往復レイテンシ（ミリ秒）"),
+):
+    """同期・非同期のCosmosDBクライアントでレストラン取得の同時実行スループットを比較する（Azureは呼び出さない）"""
+    latency = latency_ms / 1000
+    items = {f"r{i}": {"id": f"r{i}", "name": f"Restaurant {i}", "price": 1000 + i} for i in range(100)}
+
+    class SyncContainer:
+        def read_item(self, item: str, partition_key: str) -> dict:
+            time.sleep(latency)
+            return items[item]
+
+    class AsyncContainer:
+        async def read_item(self, item: str, partition_key: str) -> dict:
+            await asyncio.sleep(latency)
+            return items[item]
+
+    # 同じIDの読み出しをキャッシュせず、毎回CosmosDBへの往復を比較する
+    sync_repo = RestaurantRepository(
+        container=SyncContainer(),
+        embed_documents=FakeEmbedder(),
+        embedding_cache=EmbeddingCache(),
+        item_cache=RestaurantItemCache(max_size=0),
+    )
+
+    # Before: the blocking client called from the event loop, and the same client moved to the threadpool
+    blocking = FastAPI()
+
+    @blocking.get("/foodies/restaurants/{restaurant_id}", response_model=Restaurant)
+    async def get_blocking(restaurant_id: str):
+        return sync_repo.get_restaurant(restaurant_id)
+
+    threadpool = FastAPI()
+
+    @threadpool.get("/foodies/restaurants/{restaurant_id}", response_model=Restaurant)
+    def get_threadpool(restaurant_id: str):
+        return sync_repo.get_restaurant(restaurant_id)
+
+    # After: the foodies router awaiting the aio client
+    foodies.restaurant_repo = AsyncRestaurantRepository(
+        container=AsyncContainer(),
+        embed_documents=FakeEmbedder(),
+        embedding_cache=EmbeddingCache(),
+        item_cache=RestaurantItemCache(max_size=0),
+    )
+    awaited = FastAPI()
+    awaited.include_router(foodies.router, prefix="/foodies")
+
+    table = Table(
+        title=f"GET /foodies/restaurants/{{id}}: {requests} requests, {concurrency} concurrent, "
+        f"{latency_ms:.0f} ms per read"
+    )
+    table.add_column("handler")
+    table.add_column("requests/sec", justify="right")
+    apps = {
+        "async def + sync client": blocking,
+        "def + sync client (threadpool)": threadpool,
+        "async def + aio client": awaited,
+    }
+    for name, api in apps.items():
+
+        async def run(api=api) -> float:
+            slots = asyncio.Semaphore(concurrency)
+
+            async def get(client: httpx.AsyncClient, i: int) -> None:
+                async with slots:
+                    response = await client.get(f"/foodies/restaurants/r{i % len(items)}")
+                    response.raise_for_status()
+
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api), base_url="http://test") as client:
+                start = time.perf_counter()
+                await asyncio.gather(*(get(client, i) for i in range(requests)))
+                return requests / (time.perf_counter() - start)
+
+        table.add_row(name, f"{asyncio.run(run()):,.0f}")
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_vector_search(
+    count: int = typer.Option(20000, "--count", "-c", help="インデックスするレストランの数"),
+    dimensions: int = typer.Option(1536, "--dimensions", "-d", help="ベクトルの次元数"),
+    queries: int = typer.Option(200, "--queries", "-q", help="検索クエリの数"),
+    k: int = typer.Option(10, "--top-k", "-k", help="取得する上位結果の数"),
+):
+    """ローカルのベクトルインデックスを、全件を並べ替える総当たり検索と再現率・レイテンシで比較する"""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((count, dimensions)).astype(np.float32)
+    query_vectors = rng.standard_normal((queries, dimensions)).astype(np.float32)
+    restaurants = [Restaurant(id=str(i), name=f"Restaurant {i}", price=1000) for i in range(count)]
+
+    start = time.perf_counter()
+    index = RestaurantVectorIndex()
+    index.load(list(zip(restaurants, vectors.tolist())))
+    console.print(f"Loaded {count} vectors in {time.perf_counter() - start:.2f}s")
+
+    # Reference: score every vector and sort all of them, one query at a time
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def brute_force() -> list[list[str]]:
+        return [[str(row) for row in np.argsort(-(normalized @ query))[:k]] for query in query_vectors]
+
+    def local() -> list[list[str]]:
+        return [[r.id for r in index.search(query, k)] for query in query_vectors.tolist()]
+
+    def local_batched() -> list[list[str]]:
+        return [[r.id for r in results] for results in index.search_many(query_vectors.tolist(), k)]
+
+    table = Table(title=f"top-{k} search over {count} x {dimensions} vectors, {queries} queries")
+    table.add_column("method")
+    table.add_column("ms/query", justify="right")
+    table.add_column(f"recall@{k}", justify="right")
+    expected = None
+    for name, search in [
+        ("brute force (full argsort)", brute_force),
+        ("local index (argpartition)", local),
+        ("local index (batched)", local_batched),
+    ]:
+        start = time.perf_counter()
+        results = search()
+        elapsed = time.perf_counter() - start
+        expected = expected or results
+        recall = sum(len(set(a) & set(b)) for a, b in zip(results, expected)) / (k * queries)
+        table.add_row(name, f"{elapsed * 1000 / queries:.3f}", f"{recall:.3f}")
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_quantization(
+    count: int = typer.Option(100000, "--count", "-c", help="インデックスするレストランの数"),
+    dimensions: int = typer.Option(1536, "--dimensions", "-d", help="ベクトルの次元数"),
+    queries: int = typer.Option(100, "--queries", "-q", help="検索クエリの数"),
+    k: int = typer.Option(10, "--top-k", "-k", help="取得する上位結果の数"),
+):
+    """ベクトルの保存精度（float32・float16・int8）ごとに、ドキュメントとインデックスの大きさ・再現率を比較する"""
+    # 近傍が互いに近くなるよう、クラスターの中心の周りにベクトルを散らばらせる
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((256, dimensions)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), count)]
+    vectors += 0.5 * rng.standard_normal((count, dimensions), dtype=np.float32)
+    query_vectors = (centers[:queries] + 0.5 * rng.standard_normal((queries, dimensions))).tolist()
+    restaurants = [Restaurant(id=str(i), name=f"Restaurant {i}", price=1000) for i in range(count)]
+    # OpenAIの埋め込みと同じく、正規化したベクトルをJSONに書き込む
+    samples = (vectors[:100] / np.linalg.norm(vectors[:100], axis=1, keepdims=True)).tolist()
+
+    table = Table(title=f"top-{k} search over {count} x {dimensions} vectors, {queries} queries")
+    table.add_column("storage")
+    table.add_column("vector JSON KB/doc", justify="right")
+    table.add_column("index MB", justify="right")
+    table.add_column("ms/query", justify="right")
+    table.add_column(f"recall@{k}", justify="right")
+    expected = None
+    for storage in ["float32", "float16", "int8"]:
+        size = sum(len(json.dumps(quantize_vector(sample, storage))) for sample in samples) / len(samples)
+        index = RestaurantVectorIndex(storage)
+        index.load(list(zip(restaurants, vectors)))
+        start = time.perf_counter()
+        results = [{r.id for r in result} for result in index.search_many(query_vectors, k)]
+        elapsed = time.perf_counter() - start
+        expected = expected or results
+        recall = sum(len(a & b) for a, b in zip(results, expected)) / (k * queries)
+        table.add_row(
+            storage,
+            f"{size / 1024:.2f}",
+            f"{index.nbytes / 2**20:.0f}",
+            f"{elapsed * 1000 / queries:.2f}",
+            f"{recall:.3f}",
+        )
+        del index
+    console.print(table)
+
+
+@app.command()
+def benchmark_two_stage(
+    count: int = typer.Option(100000, "--count", "-c", help="インデックスするレストランの数"),
+    dimensions: int = typer.Option(1536, "--dimensions", "-d", help="ベクトルの次元数"),
+    search_dimensions: int = typer.Option(256, "--search-dimensions", "-s", help="1段目の検索に使う先頭の次元数"),
+    queries: int = typer.Option(100, "--queries", "-q", help="検索クエリの数"),
+    k: int = typer.Option(10, "--top-k", "-k", help="取得する上位結果の数"),
+):
+    """先頭の次元で候補を絞ってから全次元で並べ替える2段階検索を、1段階の検索とレイテンシ・再現率で比較する"""
+    # Matryoshka表現学習の埋め込みと同じく、先頭の次元ほど分散が大きくなるようにする
+    rng = np.random.default_rng(0)
+    weights = ((1 + np.arange(dimensions)) ** -0.5).astype(np.float32)
+    centers = rng.standard_normal((1024, dimensions), dtype=np.float32) * weights
+    vectors = centers[rng.integers(0, len(centers), count)]
+    vectors += rng.standard_normal((count, dimensions), dtype=np.float32) * weights
+    query_vectors = (centers[:queries] + rng.standard_normal((queries, dimensions)) * weights).tolist()
+    restaurants = [Restaurant(id=str(i), name=f"Restaurant {i}", price=1000) for i in range(count)]
+
+    table = Table(title=f"top-{k} search over {count} x {dimensions} vectors, {queries} queries")
+    table.add_column("method")
+    table.add_column("index MB", justify="right")
+    table.add_column("ms/query", justify="right")
+    table.add_column(f"recall@{k}", justify="right")
+    expected = None
+    for name, index in [
+        ("single-stage", RestaurantVectorIndex()),
+        *(
+            (
+                f"{search_dimensions} dims, re-rank {factor * k}",
+                RestaurantVectorIndex(search_dimensions=search_dimensions, rerank_factor=factor),
+            )
+            for factor in (2, 4, 10)
+        ),
+    ]:
+        index.load(list(zip(restaurants, vectors)))
+        start = time.perf_counter()
+        results = [{r.id for r in index.search(query, k)} for query in query_vectors]
+        elapsed = time.perf_counter() - start
+        expected = expected or results
+        recall = sum(len(a & b) for a, b in zip(results, expected)) / (k * queries)
+        table.add_row(name, f"{index.nbytes / 2**20:.0f}", f"{elapsed * 1000 / queries:.2f}", f"{recall:.3f}")
+        del index
+    console.print(table)
+
+
+@app.command()
+def benchmark_geo_search(
+    count: int = typer.Option(100000, "--count", "-c", help="インデックスするレストランの数"),
+    queries: int = typer.Option(1000, "--queries", "-q", help="検索クエリの数"),
+    distance_km: float = typer.Option(5.0, "--distance", "-d", help="検索半径（キロメートル）"),
+    cell_km: float = typer.Option(5.0, "--cell-km", help="格子のセルの大きさ（キロメートル）"),
+):
+    """格子による地理空間インデックスを、全件の距離を計算する総当たり検索とレイテンシで比較する"""
+    # 東京周辺の約100km四方にレストランとクエリを散らばらせる
+    rng = np.random.default_rng(0)
+    latitudes = 35.68 + rng.uniform(-0.5, 0.5, count)
+    longitudes = 139.77 + rng.uniform(-0.5, 0.5, count)
+    points = list(zip(35.68 + rng.uniform(-0.5, 0.5, queries), 139.77 + rng.uniform(-0.5, 0.5, queries)))
+    index = RestaurantGeoIndex(cell_km)
+    index.load(
+        [
+            Restaurant(id=str(i), name=f"Restaurant {i}", price=1000, latitude=latitude, longitude=longitude)
+            for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes))
+        ]
+    )
+
+    def brute_force() -> list[list[str]]:
+        results = []
+        for latitude, longitude in points:
+            distances = haversine_km(latitude, longitude, latitudes, longitudes)
+            rows = np.flatnonzero(distances <= distance_km)
+            results.append([str(row) for row in rows[np.argsort(distances[rows], kind="stable")][:10]])
+        return results
+
+    def grid() -> list[list[str]]:
+        return [[r.id for r, _ in index.search(latitude, longitude, distance_km)] for latitude, longitude in points]
+
+    table = Table(title=f"nearest 10 within {distance_km} km among {count} restaurants, {queries} queries")
+    table.add_column("method")
+    table.add_column("ms/query", justify="right")
+    table.add_column("same results", justify="right")
+    expected = None
+    for name, search in [("brute force haversine", brute_force), (f"grid index ({cell_km} km cells)", grid)]:
+        start = time.perf_counter()
+        results = search()
+        elapsed = time.perf_counter() - start
+        expected = expected or results
+        table.add_row(name, f"{elapsed * 1000 / queries:.3f}", f"{sum(map(list.__eq__, results, expected))}/{queries}")
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_result_cache(
+    requests: int = typer.Option(2000, "--requests", "-n", help="検索リクエストの数"),
+    distinct: int = typer.Option(50, "--distinct", "-u", help="異なる検索キーワードの数"),
+    concurrency: int = typer.Option(100, "--concurrency", "-c", help="同時に実行する検索の数"),
+    latency_ms: float = typer.Option(20.0, "--latency", "-l", help="模擬するCosmosDBクエリのレイテンシ（ミリ秒）"),
+):
+    """検索結果キャッシュの有無で、繰り返される検索のスループットとCosmosDBへのクエリ数を比較する（Azureは呼び出さない）"""
+    latency = latency_ms / 1000
+    item = {"id": "r0", "name": "Restaurant 0", "price": 1000}
+
+    class AsyncContainer:
+        def __init__(self):
+            self.queries = 0
+
+        async def query_items(self, query: str, parameters: list[dict] | None = None):
+            self.queries += 1
+            await asyncio.sleep(latency)
+            yield item
+
+    table = Table(
+        title=f"{requests} searches over {distinct} keywords, {concurrency} concurrent, {latency_ms:.0f} ms per query"
+    )
+    table.add_column("result cache")
+    table.add_column("Cosmos DB queries", justify="right")
+    table.add_column("searches/sec", justify="right")
+    for name, ttl in [("off", 0), ("on", 30)]:
+        container = AsyncContainer()
+        repository = AsyncRestaurantRepository(
+            container=container,
+            embed_documents=FakeEmbedder(),
+            embedding_cache=EmbeddingCache(),
+            result_cache=RestaurantResultCache(ttl=ttl),
+        )
+
+        async def run(repository=repository) -> float:
+            slots = asyncio.Semaphore(concurrency)
+
+            async def search(i: int) -> None:
+                async with slots:
+                    await repository.search_restaurants(f"keyword {i % distinct}")
+
+            start = time.perf_counter()
+            await asyncio.gather(*(search(i) for i in range(requests)))
+            return requests / (time.perf_counter() - start)
+
+        rate = asyncio.run(run())
+        repository.embedding_batcher.close()
+        table.add_row(name, str(container.queries), f"{rate:,.0f}")
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_projection(
+    count: int = typer.Option(1000, "--count", "-c", help="取得するレストランの数"),
+    dimensions: int = typer.Option(1536, "--dimensions", "-d", help="ベクトルの次元数"),
+    live: bool = typer.Option(False, "--live", help="模擬データではなく、設定されたCosmosDBのRU消費量を計測する"),
+):
+    """`SELECT *`とAPIのフィールドだけを射影するクエリで、転送量・デコード時間（--liveではRU）を比較する"""
+    queries = [("SELECT *", "SELECT * FROM c"), ("projection", _ALL_QUERY)]
+    table = Table(title=f"{count} restaurants with {dimensions}-dimensional vectors" if not live else "live Cosmos DB")
+    table.add_column("query")
+    table.add_column("items", justify="right")
+    table.add_column("KB/item", justify="right")
+    table.add_column("ms to decode", justify="right")
+    if live:
+        table.add_column("RU", justify="right")
+
+    if not live:
+        # CosmosDBが返すJSONの本文を模擬する（射影したクエリではベクトルを含まない）
+        rng = np.random.default_rng(0)
+        items = [
+            {
+                "id": str(i),
+                "name": f"Restaurant {i}",
+                "description": "Fresh nigiri and seasonal sashimi",
+                "price": 3000,
+                "tags": ["sushi"],
+                "vector": rng.standard_normal(dimensions).round(8).tolist(),
+                "location": {"type": "Point", "coordinates": [139.77, 35.68]},
+            }
+            for i in range(count)
+        ]
+        bodies = {}
+        for name, query in queries:
+            fields = set(re.findall(r"\bc\.(\w+)", query)) or None
+            bodies[name] = json.dumps(
+                {"Documents": [{k: v for k, v in item.items() if fields is None or k in fields} for item in items]}
+            ).encode()
+        restaurant_repo._cosmos_item_to_restaurant(items[0])  # 初回の検証器の構築を計測に含めない
+        del items
+        gc.collect()
+        for name, body in bodies.items():
+            start = time.perf_counter()
+            restaurants = [restaurant_repo._cosmos_item_to_restaurant(item) for item in json.loads(body)["Documents"]]
+            elapsed = time.perf_counter() - start
+            table.add_row(
+                name, str(len(restaurants)), f"{len(body) / len(restaurants) / 1024:.2f}", f"{elapsed * 1000:.1f}"
+            )
+        console.print(table)
+        return
+
+    container = restaurant_repo.container
+    for name, query in queries:
+        request_charge = 0.0
+        size = 0
+        decoded = 0
+        start = time.perf_counter()
+        for page in container.query_items(
+            query=query, enable_cross_partition_query=True, max_item_count=count
+        ).by_page():
+            page_items = list(page)
+            request_charge += float(container.client_connection.last_response_headers.get("x-ms-request-charge", 0))
+            size += len(json.dumps(page_items).encode())
+            decoded += len([restaurant_repo._cosmos_item_to_restaurant(item) for item in page_items])
+            if decoded >= count:
+                break
+        elapsed = time.perf_counter() - start
+        table.add_row(
+            name, str(decoded), f"{size / max(decoded, 1) / 1024:.2f}", f"{elapsed * 1000:.1f}", f"{request_charge:.2f}"
+        )
+    console.print(table)
+
+
+@app.command()
+def benchmark_write_behind(
+    requests: int = typer.Option(500, "--requests", "-n", help="作成するレストランの数"),
+    concurrency: int = typer.Option(50, "--concurrency", "-c", help="同時に送る作成リクエストの数"),
+    embedding_latency_ms: float = typer.Option(
+        300.0, "--embedding-latency", help="模擬する埋め込みAPIのレイテンシ（ミリ秒）"
+    ),
+    write_latency_ms: float = typer.Option(
+        10.0, "--write-latency", help="模擬するCosmosDBの書き込みレイテンシ（ミリ秒）"
+    ),
+    workers: int = typer.Option(2, "--workers", "-w", help="write-behindのワーカー数"),
+):
+    """レストラン作成のレイテンシを、同期埋め込みとwrite-behind埋め込みで比較する（Azureは呼び出さない）"""
+    write_latency = write_latency_ms / 1000
+
+    class AsyncContainer:
+        def __init__(self):
+            self.items: dict[str, dict] = {}
+
+        async def create_item(self, body: dict) -> dict:
+            await asyncio.sleep(write_latency)
+            self.items[body["id"]] = dict(body)
+            return dict(body)
+
+        async def patch_item(
+            self, item: str, partition_key: str, patch_operations: list[dict], filter_predicate: str
+        ) -> dict:
+            await asyncio.sleep(write_latency)
+            for operation in patch_operations:
+                if operation["op"] == "remove":
+                    self.items[item].pop(operation["path"][1:])
+                else:
+                    self.items[item][operation["path"][1:]] = operation["value"]
+            return dict(self.items[item])
+
+    table = Table(
+        title=f"{requests} creates, {concurrency} concurrent, {embedding_latency_ms:.0f} ms per embedding call, "
+        f"{write_latency_ms:.0f} ms per write"
+    )
+    table.add_column("embedding mode")
+    table.add_column("create p50 (ms)", justify="right")
+    table.add_column("create p99 (ms)", justify="right")
+    table.add_column("all vectors ready (s)", justify="right")
+    for mode in ["sync", "write_behind"]:
+        restaurants_settings.restaurant_embedding_mode = mode
+        restaurants_settings.restaurant_embedding_workers = workers
+        container = AsyncContainer()
+        repository = AsyncRestaurantRepository(
+            container=container,
+            embed_documents=FakeEmbedder(latency=embedding_latency_ms / 1000),
+            embedding_cache=EmbeddingCache(),
+        )
+
+        async def run(repository=repository) -> tuple[list[float], float]:
+            slots = asyncio.Semaphore(concurrency)
+            latencies = []
+
+            async def create(i: int) -> None:
+                async with slots:
+                    start = time.perf_counter()
+                    await repository.create_restaurant(
+                        Restaurant(id=f"r{i}", name=f"Restaurant {i}", description=f"Dish number {i}", price=1000 + i)
+                    )
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(create(i) for i in range(requests)))
+            await repository.close()
+            return latencies, time.perf_counter() - start
+
+        latencies, elapsed = asyncio.run(run())
+        repository.embedding_batcher.close()
+        assert not any(item.get("vector_status") for item in container.items.values())
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        table.add_row(mode, f"{p50:.1f}", f"{p99:.1f}", f"{elapsed:.2f}")
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_point_read(
+    requests: int = typer.Option(5000, "--requests", "-n", help="取得リクエストの数"),
+    distinct: int = typer.Option(200, "--distinct", "-u", help="取得されるレストランの数"),
+    concurrency: int = typer.Option(50, "--concurrency", "-c", help="同時に実行する取得の数"),
+    latency_ms: float = typer.Option(10.0, "--latency", "-l", help="模擬するCosmosDBの読み出しレイテンシ（ミリ秒）"),
+    fresh_seconds: float = typer.Option(5.0, "--fresh", "-f", help="キャッシュから返す期間（秒）"),
+    dimensions: int = typer.Option(1536, "--dimensions", "-d", help="アイテムに保存されたベクトルの次元数"),
+):
+    """IDによる取得を、キャッシュなし・毎回ETagで再検証・新鮮な期間はメモリから返す場合で比較する（Azureは呼び出さない）"""
+    latency = latency_ms / 1000
+    rng = np.random.default_rng(0)
+    items = {
+        f"r{i}": {
+            "id": f"r{i}",
+            "name": f"Restaurant {i}",
+            "description": f"Dish number {i}",
+            "price": 1000 + i,
+            "vector": rng.standard_normal(dimensions).tolist(),
+            "_etag": f"etag-{i}",
+        }
+        for i in range(distinct)
+    }
+    sizes = {restaurant_id: len(json.dumps(item).encode()) for restaurant_id, item in items.items()}
+
+    class AsyncContainer:
+        def __init__(self):
+            self.reads = 0
+            self.bytes = 0
+
+        async def read_item(self, item: str, partition_key: str, etag: str | None = None, match_condition=None) -> dict:
+            self.reads += 1
+            await asyncio.sleep(latency)
+            if etag == items[item]["_etag"]:
+                return {}
+            self.bytes += sizes[item]
+            return items[item]
+
+    # 人気のあるレストランほど頻繁に取得される（Zipf分布）
+    ids = [f"r{(rank - 1) % distinct}" for rank in rng.zipf(1.2, requests)]
+    table = Table(
+        title=f"{requests} reads over {distinct} restaurants, {concurrency} concurrent, {latency_ms:.0f} ms per read"
+    )
+    table.add_column("point-read cache")
+    table.add_column("Cosmos DB reads", justify="right")
+    table.add_column("304 Not Modified", justify="right")
+    table.add_column("KB transferred", justify="right")
+    table.add_column("reads/sec", justify="right")
+    modes = {
+        "off": RestaurantItemCache(max_size=0),
+        "revalidate every read": RestaurantItemCache(fresh_for=0),
+        f"fresh for {fresh_seconds:g} s": RestaurantItemCache(fresh_for=fresh_seconds),
+    }
+    for name, item_cache in modes.items():
+        container = AsyncContainer()
+        repository = AsyncRestaurantRepository(
+            container=container, embed_documents=FakeEmbedder(), embedding_cache=EmbeddingCache(), item_cache=item_cache
+        )
+
+        async def run(repository=repository) -> float:
+            slots = asyncio.Semaphore(concurrency)
+
+            async def get(restaurant_id: str) -> None:
+                async with slots:
+                    await repository.get_restaurant(restaurant_id)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(get(restaurant_id) for restaurant_id in ids))
+            return requests / (time.perf_counter() - start)
+
+        rate = asyncio.run(run())
+        table.add_row(
+            name,
+            str(container.reads),
+            str(item_cache.revalidated),
+            f"{container.bytes / 1024:,.0f}",
+            f"{rate:,.0f}",
+        )
+
+    console.print(table)
+
+
 if __name__ == "__main__":
     app()
@@ -0,0 +1,352 @@
+"""Items store CLI tool."""
+
+import asyncio
+import gc
+import random
+import sys
+import tempfile
+import time
+
+import httpx
+import typer
+from fastapi import FastAPI, Query
+from fastapi.testclient import TestClient
+from rich.console import Console
+from rich.table import Table
+
+from template_fastapi.models.item import Item
+from template_fastapi.repositories.item_storage import ItemStorage
+from template_fastapi.repositories.items import ColumnarItemRepository, ItemRepository
+from template_fastapi.routers import items as items_router
+
+app = typer.Typer()
+console = Console()
+
+WORDS = ["hammer", "saw", "drill", "wrench", "bolt", "nail", "steel", "wood", "red", "blue", "heavy", "compact"]
+TAGS = ["tool", "hardware", "power", "cutting", "garden", "outdoor", "kitchen", "paint", "safety", "electric"]
+
+
+def generate_items(count: int, seed: int = 0) -> list[Item]:
+    """ベンチマーク用のアイテムを生成する"""
+    rng = random.Random(seed)
+    return [
+        Item(
+            id=i,
+            name=f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}",
+            description=" ".join(rng.choices(WORDS, k=5)),
+            price=round(rng.uniform(1, 1000), 2),
+            tags=rng.sample(TAGS, rng.randint(1, 4)),
+        )
+        for i in range(count)
+    ]
+
+
+def measure(func, repeat: int) -> float:
+    """関数の平均実行時間（ミリ秒）を計測する"""
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - start) / repeat * 1000
+    finally:
+        gc.enable()
+
+
+@app.command()
+def benchmark_store(
+    sizes: list[int] = typer.Option([10_000, 100_000, 1_000_000], "--size", "-s", help="アイテム数"),
+    repeat: int = typer.Option(20, "--repeat", "-r", help="各クエリの繰り返し回数"),
+):
+    """dictストアとcolumnarストアの検索性能を比較する"""
+    queries = {
+        "price range": {"min_price": 100, "max_price": 110},
+        "tags": {"tags": ["power", "electric"]},
+        "price + tags": {"min_price": 100, "max_price": 300, "tags": ["garden"]},
+        "q + tags": {"q": "drill", "tags": ["safety"]},
+        "tags top 20": {"tags": ["power", "electric"], "limit": 20},
+        "tags, -price top 20": {"tags": ["power"], "sort": "-price", "limit": 20},
+        "price range, name top 20": {"min_price": 100, "max_price": 300, "sort": "name", "limit": 20},
+    }
+
+    table = Table(title="search latency (ms)")
+    table.add_column("items", justify="right")
+    table.add_column("store")
+    table.add_column("method")
+    table.add_column("build (s)", justify="right")
+    for name in queries:
+        table.add_column(name, justify="right")
+
+    for size in sizes:
+        console.print(f"[bold green]{size}件[/bold green]のアイテムを生成しています...")
+        items = generate_items(size)
+        for repo_class in [ItemRepository, ColumnarItemRepository]:
+            start = time.perf_counter()
+            repo = repo_class(items)
+            build_seconds = time.perf_counter() - start
+            # search_itemsはItemを返し、encode_searchはエンドポイントと同じくキャッシュ済みのJSONを返す
+            for method in ["search_items", "encode_search"]:
+                search = getattr(repo, method)
+                for filters in queries.values():
+                    search(**filters)
+                latencies = [
+                    f"{measure(lambda filters=filters, search=search: search(**filters), repeat):.2f}"
+                    for filters in queries.values()
+                ]
+                table.add_row(str(size), repo_class.__name__, method, f"{build_seconds:.2f}", *latencies)
+            del repo, search
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_fuzzy(
+    count: int = typer.Option(500_000, "--count", "-c", help="アイテム数"),
+    repeat: int = typer.Option(200, "--repeat", "-r", help="各クエリの繰り返し回数"),
+    limit: int = typer.Option(10, "--limit", "-l", help="返す上位件数"),
+):
+    """あいまい検索（fuzzy=true）のレイテンシをパーセンタイルで計測する"""
+    queries = {
+        "hamer": {},
+        "stel blu": {},
+        "hevy compct drll": {},
+        "wrnch": {"min_price": 100, "max_price": 110},
+        "drll": {"tags": ["garden"]},
+        "4711": {},
+    }
+    console.print(f"[bold green]{count}件[/bold green]のアイテムを生成しています...")
+    items = generate_items(count)
+
+    table = Table(title=f"fuzzy search_items latency ({count} items, top {limit}, ms)")
+    table.add_column("store")
+    table.add_column("query")
+    table.add_column("filters")
+    table.add_column("p50", justify="right")
+    table.add_column("p99", justify="right")
+    for repo_class in [ItemRepository, ColumnarItemRepository]:
+        repo = repo_class(items)
+        gc.collect()
+        gc.disable()
+        for q, filters in queries.items():
+            latencies = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                repo.search_items(q, fuzzy=True, limit=limit, **filters)
+                latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+            table.add_row(repo_class.__name__, q, str(filters or ""), f"{p50:.2f}", f"{p99:.2f}")
+        gc.enable()
+        del repo
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_bulk(
+    count: int = typer.Option(5000, "--count", "-c", help="書き込むアイテム数"),
+    batch_size: int = typer.Option(1000, "--batch-size", "-b", help="一括書き込みのバッチサイズ"),
+):
+    """単一アイテムのエンドポイントと一括エンドポイントの書き込みスループットを比較する"""
+    api = FastAPI()
+    api.include_router(items_router.router, prefix="/items")
+    client = TestClient(api)
+    rows = [item.model_dump() for item in generate_items(count)]
+    ids = [row["id"] for row in rows]
+    batches = [slice(i, i + batch_size) for i in range(0, count, batch_size)]
+
+    def single_create():
+        for row in rows:
+            client.post("/items/", json=row)
+
+    def single_update():
+        for row in rows:
+            client.put(f"/items/{row['id']}", json=row)
+
+    def single_delete():
+        for item_id in ids:
+            client.delete(f"/items/{item_id}")
+
+    def bulk_create():
+        for batch in batches:
+            client.post("/items/bulk", json=rows[batch])
+
+    def bulk_update():
+        for batch in batches:
+            client.put("/items/bulk", json=rows[batch])
+
+    def bulk_delete():
+        for batch in batches:
+            client.request("DELETE", "/items/bulk", json=ids[batch])
+
+    table = Table(title=f"items/sec ({count} items, batch size {batch_size})")
+    table.add_column("operation")
+    table.add_column("single", justify="right")
+    table.add_column("bulk", justify="right")
+    for name, single, bulk in [
+        ("create", single_create, bulk_create),
+        ("update", single_update, bulk_update),
+        ("delete", single_delete, bulk_delete),
+    ]:
+        results = []
+        for func in [single, bulk]:
+            if name != "create":
+                bulk_create()
+            results.append(f"{count / (measure(func, 1) / 1000):,.0f}")
+            if name == "create":
+                bulk_delete()
+        table.add_row(name, *results)
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_responses(
+    count: int = typer.Option(10_000, "--count", "-c", help="ストアのアイテム数"),
+    requests: int = typer.Option(1000, "--requests", "-n", help="各エンドポイントへのリクエスト数"),
+):
+    """response_modelによるシリアライズと、キャッシュ済みJSONからの応答のスループット（req/s）を比較する"""
+    repo = items_router.item_repo
+    repo.save_items(generate_items(count))
+
+    # Baseline: the same endpoints returning models through FastAPI's response_model serialisation
+    baseline = FastAPI()
+
+    @baseline.get("/items/", response_model=list[Item])
+    async def list_items(limit: int = 10):
+        return repo.list_items(0, limit)
+
+    @baseline.get("/items/search/", response_model=list[Item])
+    async def search_items(tags: list[str] = Query([]), limit: int | None = None):
+        return repo.search_items(tags=tags, limit=limit)
+
+    @baseline.get("/items/{item_id}", response_model=Item)
+    async def read_item(item_id: int):
+        return repo.get_item(item_id)
+
+    cached = FastAPI()
+    cached.include_router(items_router.router, prefix="/items")
+
+    endpoints = {
+        "GET /items/{id}": lambda i: (f"/items/{i % count}", None),
+        "GET /items/?limit=10": lambda i: ("/items/", {"limit": 10}),
+        "GET /items/?limit=100": lambda i: ("/items/", {"limit": 100}),
+        "GET /items/search/?tags=power&limit=100": lambda i: ("/items/search/", {"tags": "power", "limit": 100}),
+    }
+    table = Table(title=f"items endpoints req/s ({count} items, {requests} requests each)")
+    table.add_column("endpoint")
+    table.add_column("response_model", justify="right")
+    table.add_column("cached JSON", justify="right")
+    table.add_column("speedup", justify="right")
+    for name, request in endpoints.items():
+        rates = []
+        for api in [baseline, cached]:
+
+            async def run(api=api, request=request) -> float:
+                # An in-process ASGI client keeps transport overhead out of the comparison
+                async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api), base_url="http://test") as client:
+                    for i in range(requests):  # Warm up, which also fills the encoding cache
+                        path, params = request(i)
+                        await client.get(path, params=params)
+                    start = time.perf_counter()
+                    for i in range(requests):
+                        path, params = request(i)
+                        await client.get(path, params=params)
+                    return requests / (time.perf_counter() - start)
+
+            rates.append(asyncio.run(run()))
+        table.add_row(name, f"{rates[0]:,.0f}", f"{rates[1]:,.0f}", f"{rates[1] / rates[0]:.2f}x")
+
+    console.print(table)
+
+
+@app.command()
+def benchmark_persistence(
+    count: int = typer.Option(1_000_000, "--count", "-c", help="スナップショットのアイテム数"),
+    log_records: int = typer.Option(10_000, "--log-records", "-l", help="再生するログのレコード数"),
+    writes: int = typer.Option(2000, "--writes", "-w", help="書き込みレイテンシの計測回数"),
+    stores: list[str] = typer.Option(["dict", "columnar"], "--store", "-s", help="計測するストア（dict / columnar）"),
+):
+    """スナップショットとログからの起動時間と、書き込みレイテンシのオーバーヘッドを計測する"""
+    # 先頭のアイテムは件数によらず同じものが生成される
+    updates = [item.model_copy(update={"price": item.price + 1}) for item in generate_items(max(writes, log_records))]
+    repository_classes = {"dict": ItemRepository, "columnar": ColumnarItemRepository}
+    results: dict[str, dict[str, str]] = {}
+
+    for store in stores:
+        repository_class = repository_classes[store]
+        with tempfile.TemporaryDirectory() as directory:
+            storage = ItemStorage(directory, snapshot_interval=log_records + 1)
+            # 起動を計測する前に解放できるよう、ストアごとにアイテムを生成する
+            storage.attach(repository_class(generate_items(count)))
+            # スナップショット（インデックス状態を含む）の構築と書き込み。通常はバックグラウンドで実行される
+            start = time.perf_counter()
+            storage.checkpoint(wait=True)
+            snapshot_seconds = time.perf_counter() - start
+            storage.items_saved(updates[:log_records])
+            storage.close()
+            del storage
+            gc.collect()
+
+            # 起動: スナップショットをメモリマップし、インデックスを復元してログを再生する
+            gc.disable()
+            start = time.perf_counter()
+            storage = ItemStorage(directory, snapshot_interval=log_records + writes + 1)
+            repo = storage.restore(repository_class)
+            startup_seconds = time.perf_counter() - start
+            gc.enable()
+
+            def write_all(repo=repo):
+                for item in updates[:writes]:
+                    repo.save_item(item)
+
+            in_memory_ms = measure(write_all, 1) / writes
+            storage.attach(repo)
+            logged_ms = measure(write_all, 1) / writes
+            storage.fsync = True
+            fsync_ms = measure(write_all, 1) / writes
+            storage.fsync = False
+
+            # スナップショットを開始する書き込みのレイテンシ（凍結とログのローテーションのみ同期で行う）
+            storage.wait()
+            storage.snapshot_interval = 1
+            snapshot_start = time.perf_counter()
+            repo.save_item(updates[0])
+            trigger_ms = (time.perf_counter() - snapshot_start) * 1000
+            # 計測中は次のスナップショットを開始しない
+            storage.snapshot_interval = sys.maxsize
+            latencies = []
+            while storage.snapshotting:
+                start = time.perf_counter()
+                repo.save_item(updates[len(latencies) % writes])
+                latencies.append((time.perf_counter() - start) * 1000)
+            background_seconds = time.perf_counter() - snapshot_start
+            storage.close()
+            del repo
+            gc.collect()
+
+        results[store] = {
+            "snapshot build + write, background (s)": f"{snapshot_seconds:.2f}",
+            "startup: restore + log replay (s)": f"{startup_seconds:.2f}",
+            "write latency, in-memory (ms)": f"{in_memory_ms:.3f}",
+            "write latency, logged (ms)": f"{logged_ms:.3f}",
+            "write latency, logged + fsync (ms)": f"{fsync_ms:.3f}",
+            "write starting a snapshot (ms)": f"{trigger_ms:.1f}",
+            "background snapshot under writes (s)": f"{background_seconds:.2f}",
+            "writes during background snapshot": f"{len(latencies)}",
+            "max write latency during snapshot (ms)": f"{max(latencies, default=0):.1f}",
+        }
+
+    table = Table(title=f"items persistence ({count} items, {log_records} log records)")
+    table.add_column("metric")
+    for store in stores:
+        table.add_column(store, justify="right")
+    for metric in results[stores[0]]:
+        table.add_row(metric, *(results[store][metric] for store in stores))
+    console.print(table)
+
+
+if __name__ == "__main__":
+    app()
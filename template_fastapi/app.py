@@ -4,6 +4,7 @@ ref. https://github.com/tadata-org/fastapi_mcp/blob/v0.3.4/examples/shared/apps/
 """
 
 import uuid
+from contextlib import asynccontextmanager
 from os import getenv
 
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -18,7 +19,22 @@ from template_fastapi.settings.logging import configure_logging, get_logger
 configure_logging()
 logger = get_logger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared clients on startup and close them on shutdown."""
+    try:
+        await foodies.restaurant_repo.open()
+    except ValueError as e:
+        # Cosmos DB is optional: the foodies endpoints report the error per request instead
+        logger.warning(f"Azure Cosmos DB client not opened: {e}")
+    try:
+        yield
+    finally:
+        await foodies.restaurant_repo.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 logger.info("Starting FastAPI application")
 
@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import BaseModel
 
 
@@ -7,3 +9,51 @@ class Item(BaseModel):
     description: str | None = None
     price: float
     tags: list[str] = []
+
+
+class ItemPage(BaseModel):
+    """A page of items returned by cursor pagination."""
+
+    items: list[Item]
+    next_cursor: str | None = None
+
+
+class ItemChange(BaseModel):
+    """A mutation of the items store, numbered in the order it was applied."""
+
+    sequence: int
+    operation: Literal["saved", "deleted"]
+    id: int
+    item: Item | None = None
+
+
+class ItemBulkResult(BaseModel):
+    """The outcome of one row of a bulk item request."""
+
+    index: int
+    id: int | None = None
+    status: str
+    errors: list[str] = []
+
+
+class ItemBulkResponse(BaseModel):
+    """Per-row results of a bulk item request, applied all-or-nothing."""
+
+    applied: bool
+    results: list[ItemBulkResult]
+
+
+class PriceBucket(BaseModel):
+    """Number of items priced from `min_price` up to, but excluding, `max_price`."""
+
+    min_price: float
+    max_price: float | None = None
+    count: int
+
+
+class ItemFacets(BaseModel):
+    """Tag counts and price histogram of the items matching a search."""
+
+    total: int
+    tags: dict[str, int]
+    price_buckets: list[PriceBucket]
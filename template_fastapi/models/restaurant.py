@@ -9,3 +9,21 @@ class Restaurant(BaseModel):
     latitude: float | None = None
     longitude: float | None = None
     tags: list[str] = []
+
+
+class NearbyRestaurant(Restaurant):
+    distance_km: float
+
+
+class RestaurantPage(BaseModel):
+    """カーソルによるページネーションで返すレストランの1ページ"""
+
+    restaurants: list[Restaurant]
+    next_cursor: str | None = None
+
+
+class NearbyRestaurantPage(BaseModel):
+    """カーソルによるページネーションで返す近くのレストランの1ページ"""
+
+    restaurants: list[NearbyRestaurant]
+    next_cursor: str | None = None
@@ -0,0 +1,398 @@
+import asyncio
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from template_fastapi.opentelemetry import get_meter
+from template_fastapi.settings.logging import get_logger
+
+logger = get_logger(__name__)
+meter = get_meter(__name__)
+
+lookup_counter = meter.create_counter(
+    "embeddings.cache.lookups",
+    description="The number of embedding cache lookups by result (memory, disk or miss)",
+)
+batch_size_histogram = meter.create_histogram(
+    "embeddings.batch.size",
+    description="The number of distinct texts sent per embedding API call",
+)
+
+
+def embedding_cache_key(text: str, deployment: str, dimensions: int | None) -> str:
+    """テキスト・デプロイメント名・次元数からキャッシュキーを生成する"""
+    return hashlib.sha256(json.dumps([deployment, dimensions, text]).encode()).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    埋め込みベクトルの2層キャッシュ
+
+    プロセス内のLRUと、ワーカー間・再起動後も共有されるSQLiteファイルの2層で
+    ベクトルを保持する。どちらの層も件数の上限を超えると最も古く使われたものから
+    削除する。APIが返す埋め込みはfloat32精度のため、ディスクにはfloat32で保存する。
+
+    ディスクの層は読み取りと書き込みで接続を分け、読み取りでは書き込まない。ディスクから読んだ
+    エントリの最終使用時刻は最大`_MAX_TOUCHED`件まで保持し、削除の前に行う次の書き込みでまとめて
+    反映する。`aembed`は読み取りをスレッドで、書き込みを専用のスレッドで待つため、他のワーカーが
+    ファイルをロックしていてもイベントループや他の読み取りを止めない。
+    """
+
+    # ディスクの上限を超えたとき、この割合まで削除して削除の頻度を抑える
+    _DISK_EVICTION_RATIO = 0.9
+    # 次の書き込みまで保持する最終使用時刻の件数（超えたら古いものから捨てる）
+    _MAX_TOUCHED = 4096
+
+    def __init__(self, path: str | Path | None = None, memory_size: int = 1024, disk_size: int = 100000):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self._memory: OrderedDict[str, list[float]] = OrderedDict()
+        # メモリの層・統計・最終使用時刻を守るロック。ディスクの入出力の間は保持しない
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._touched: OrderedDict[str, float] = OrderedDict()
+        self._db = None
+        self._reader = None
+        self._writer = None
+        if path and disk_size > 0:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+            self._disk_count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            # WALでは書き込み中も読み取れるため、書き込みがロックを待つ間も別の接続で読み取る
+            self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-cache")
+
+    def get(self, key: str) -> list[float] | None:
+        """キャッシュからベクトルを取得する（見つからない場合はNone）"""
+        vector = self._get_memory([key]).get(key)
+        if vector is None:
+            vector = self._get_disk([key]).get(key)
+        return vector
+
+    def put(self, key: str, vector: list[float]) -> None:
+        """ベクトルを両方の層に保存する"""
+        self._put_memory({key: vector})
+        self._put_disk({key: vector})
+
+    def embed(
+        self,
+        texts: list[str],
+        deployment: str,
+        dimensions: int | None,
+        embed_documents: Callable[[list[str]], list[list[float]]],
+    ) -> list[list[float]]:
+        """キャッシュにないテキストだけを1回の呼び出しでまとめて埋め込み、全テキストのベクトルを返す"""
+        keys = [embedding_cache_key(text, deployment, dimensions) for text in texts]
+        vectors = self._get_memory(keys)
+        vectors.update(self._get_disk(self._unresolved(vectors)))
+        missing = self._missing(keys, texts, vectors)
+        if missing:
+            embedded = dict(zip(missing, embed_documents(list(missing.values()))))
+            self._put_memory(embedded)
+            self._put_disk(embedded)
+            vectors.update(embedded)
+        return [vectors[key] for key in keys]
+
+    async def aembed(
+        self,
+        texts: list[str],
+        deployment: str,
+        dimensions: int | None,
+        aembed_documents: Callable[[list[str]], Awaitable[list[list[float]]]],
+    ) -> list[list[float]]:
+        """
+        `embed`のイベントループ版
+
+        メモリの層はループ上で引き、ディスクの層の読み書きとキャッシュにないテキストの埋め込みは
+        ループをブロックせずに待つ
+        """
+        keys = [embedding_cache_key(text, deployment, dimensions) for text in texts]
+        vectors = self._get_memory(keys)
+        unresolved = self._unresolved(vectors)
+        if unresolved and self._reader is not None:
+            vectors.update(await asyncio.to_thread(self._get_disk, unresolved))
+        elif unresolved:
+            # ディスクの層がなければミスを数えるだけなので、ループ上で済ませる
+            self._get_disk(unresolved)
+        missing = self._missing(keys, texts, vectors)
+        if missing:
+            embedded = dict(zip(missing, await aembed_documents(list(missing.values()))))
+            self._put_memory(embedded)
+            if self._writer is not None:
+                await asyncio.get_running_loop().run_in_executor(self._writer, self._put_disk, embedded)
+            vectors.update(embedded)
+        return [vectors[key] for key in keys]
+
+    @staticmethod
+    def _unresolved(vectors: dict[str, list[float] | None]) -> list[str]:
+        return [key for key, vector in vectors.items() if vector is None]
+
+    @staticmethod
+    def _missing(keys: list[str], texts: list[str], vectors: dict[str, list[float] | None]) -> dict[str, str]:
+        return {key: text for key, text in zip(keys, texts) if vectors[key] is None}
+
+    def stats(self) -> dict[str, int]:
+        """層ごとのヒット数、ミス数と保持件数を返す"""
+        with self._lock:
+            return {
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._disk_count if self._db is not None else 0,
+            }
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.shutdown()
+            self._writer = None
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+        with self._write_lock:
+            if self._db is not None:
+                self._flush_touched()
+                self._db.close()
+                self._db = None
+
+    def _get_memory(self, keys: list[str]) -> dict[str, list[float] | None]:
+        """メモリの層から引く。見つからなかったキーはNoneになる"""
+        vectors: dict[str, list[float] | None] = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                vectors[key] = self._memory.get(key)
+                if vectors[key] is not None:
+                    self._memory.move_to_end(key)
+                    self._record("memory")
+        return vectors
+
+    def _get_disk(self, keys: list[str]) -> dict[str, list[float] | None]:
+        """ディスクの層から引き、見つかったものをメモリの層にも保存する"""
+        found: dict[str, list[float] | None] = {}
+        with self._read_lock:
+            if keys and self._reader is not None:
+                placeholders = ", ".join("?" * len(keys))
+                rows = self._reader.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys
+                ).fetchall()
+                found = {key: np.frombuffer(vector, dtype="<f4").tolist() for key, vector in rows}
+        now = time.time()
+        with self._lock:
+            for key in found:
+                self._touched[key] = now
+                self._touched.move_to_end(key)
+            while len(self._touched) > self._MAX_TOUCHED:
+                self._touched.popitem(last=False)
+            for key in keys:
+                vector = found.get(key)
+                if vector is None:
+                    self._record("miss")
+                else:
+                    self._remember(key, vector)
+                    self._record("disk")
+        return found
+
+    def _put_memory(self, vectors: dict[str, list[float]]) -> None:
+        with self._lock:
+            for key, vector in vectors.items():
+                self._remember(key, vector)
+
+    def _put_disk(self, vectors: dict[str, list[float]]) -> None:
+        """ベクトルと保留中の最終使用時刻を1回のトランザクションでディスクの層に書き込む"""
+        with self._write_lock:
+            if self._db is None:
+                return
+            now = time.time()
+            self._db.execute("BEGIN")
+            try:
+                inserted = self._db.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)",
+                    [(key, np.asarray(vector, dtype="<f4").tobytes(), now) for key, vector in vectors.items()],
+                ).rowcount
+                self._flush_touched()
+                # 他のワーカーの書き込みは数えないため概算だが、削除のたびに数え直す
+                self._disk_count += inserted
+                if self._disk_count > self.disk_size:
+                    self._evict_disk()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _flush_touched(self) -> None:
+        with self._lock:
+            touched = [(at, key) for key, at in self._touched.items()]
+            self._touched.clear()
+        if touched:
+            self._db.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?", touched)
+
+    def _record(self, result: str) -> None:
+        if result == "miss":
+            self.misses += 1
+        else:
+            self.hits[result] += 1
+        lookup_counter.add(1, {"result": result})
+
+    def _remember(self, key: str, vector: list[float]) -> None:
+        if self.memory_size <= 0:
+            return
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self) -> None:
+        excess = self._disk_count - int(self.disk_size * self._DISK_EVICTION_RATIO)
+        self._db.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed LIMIT ?)", (excess,)
+        )
+        self._disk_count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        logger.info(f"Evicted {excess} embeddings from the on-disk cache")
+
+
+class FakeEmbedder:
+    """
+    テスト・ローカル開発用の決定的な埋め込み生成器
+
+    テキストのハッシュから単位ベクトルを生成するため、同じテキストには常に同じ
+    ベクトルを返す。`latency`秒の待ち時間でAPI呼び出しを模擬し、呼び出しを記録する。
+    """
+
+    def __init__(self, dimensions: int = 8, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.calls: list[list[str]] = []
+
+    def __call__(self, texts: list[str]) -> list[list[float]]:
+        self.calls.append(list(texts))
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.embed(text) for text in texts]
+
+    def embed(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+class EmbeddingBatcher:
+    """
+    同時に届いた埋め込み要求をまとめて1回のAPI呼び出しにするマイクロバッチャー
+
+    要求はキューに積まれ、ワーカースレッドが最初の要求から`max_wait`秒待つか
+    `max_batch_size`件集まった時点で、重複を除いたテキストを`embed_documents`に
+    まとめて渡し、結果をそれぞれの待ち手に返す。API呼び出しは最大`max_concurrency`
+    本まで並行する。スレッドからは`embed`、イベントループからは`aembed`で呼び出す。
+    """
+
+    def __init__(
+        self,
+        embed_documents: Callable[[list[str]], list[list[float]]],
+        max_batch_size: int = 64,
+        max_wait: float = 0.01,
+        max_concurrency: int = 4,
+    ):
+        self.embed_documents = embed_documents
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.calls = 0
+        self.texts = 0
+        self._queue: queue.SimpleQueue[tuple[str, Future] | None] = queue.SimpleQueue()
+        self._workers: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def submit(self, texts: list[str]) -> list[Future]:
+        """テキストをキューに積み、それぞれのベクトルを受け取るFutureを返す"""
+        if not self._workers:
+            self._start()
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return futures
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        """テキストのベクトルを、他の要求とまとめて埋め込んだうえで返す"""
+        return [future.result() for future in self.submit(texts)]
+
+    async def aembed(self, texts: list[str]) -> list[list[float]]:
+        """`embed`のイベントループ版。待っている間ループをブロックしない"""
+        return list(await asyncio.gather(*(asyncio.wrap_future(future) for future in self.submit(texts))))
+
+    def close(self) -> None:
+        """キューに残った要求を処理し終えてからワーカーを停止する"""
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._workers:
+                return
+            self._workers = [
+                threading.Thread(target=self._run, name=f"embedding-batcher-{i}", daemon=True)
+                for i in range(self.max_concurrency)
+            ]
+            for worker in self._workers:
+                worker.start()
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.max_wait
+            stopping = False
+            while len(batch) < self.max_batch_size:
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch: list[tuple[str, Future]]) -> None:
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = dict(zip(texts, self.embed_documents(texts), strict=True))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self.calls += 1
+            self.texts += len(texts)
+        batch_size_histogram.record(len(texts))
+        for text, future in batch:
+            future.set_result(vectors[text])
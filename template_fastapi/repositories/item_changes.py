@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import uuid
+from collections import deque
+from itertools import islice
+
+from template_fastapi.models.item import Item, ItemChange
+
+
+class ExpiredSequenceError(ValueError):
+    """Raised when the changes after a sequence number are no longer in the feed."""
+
+
+class ItemChangeFeed:
+    """
+    Bounded in-memory ring buffer of item mutations.
+
+    Subscribed to an items repository as a listener, it numbers every saved
+    or deleted item with a monotonically increasing sequence number, so
+    readers can resume after the last change they saw. Publishing only
+    appends to the buffer and wakes waiting readers, so writes never block
+    on them. Sequence numbers are local to the process and restart from 0,
+    so the positions handed to readers also carry an epoch drawn at startup,
+    and positions from before a restart are rejected instead of resuming at
+    an unrelated change.
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self.sequence = 0
+        self.epoch = uuid.uuid4().hex[:16]
+        self._changes: deque[ItemChange] = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+
+    def items_saved(self, items: list[Item]) -> None:
+        self._publish([("saved", item.id, item) for item in items])
+
+    def items_deleted(self, item_ids: list[int]) -> None:
+        self._publish([("deleted", item_id, None) for item_id in item_ids])
+
+    def _publish(self, changes: list[tuple[str, int, Item | None]]) -> None:
+        with self._lock:
+            for operation, item_id, item in changes:
+                self.sequence += 1
+                # Items were validated on write, so skip re-validation
+                self._changes.append(
+                    ItemChange.model_construct(sequence=self.sequence, operation=operation, id=item_id, item=item)
+                )
+            waiters, self._waiters = self._waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def position(self, sequence: int) -> str:
+        """The resumable position of a sequence number, as `<epoch>:<sequence>`."""
+        return f"{self.epoch}:{sequence}"
+
+    def sequence_at(self, position: str) -> int:
+        """
+        The sequence number of a position issued by `position`.
+
+        Raises a `ValueError` if the position is malformed, and an
+        `ExpiredSequenceError` if it was issued by another epoch of the feed,
+        e.g. before the process restarted.
+        """
+        epoch, _, sequence = position.rpartition(":")
+        if not sequence.isdigit():
+            raise ValueError(f"Invalid change feed position: {position!r}")
+        if epoch != self.epoch:
+            raise ExpiredSequenceError(f"Position {position} was issued before the change feed restarted")
+        return int(sequence)
+
+    def since(self, sequence: int) -> list[ItemChange]:
+        """
+        Changes after a sequence number, oldest first.
+
+        Raises an `ExpiredSequenceError` if some of them were already evicted
+        from the buffer, or if the sequence number was never issued, e.g.
+        because the process restarted since.
+        """
+        with self._lock:
+            oldest = self.sequence - len(self._changes)
+            if not oldest <= sequence <= self.sequence:
+                raise ExpiredSequenceError(
+                    f"Sequence {sequence} is outside the retained changes ({oldest} to {self.sequence})"
+                )
+            return list(islice(self._changes, sequence - oldest, None))
+
+    async def wait(self, sequence: int, timeout: float | None = None) -> bool:
+        """Wait until a change after the sequence number is published. Returns False on timeout."""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._lock:
+            if self.sequence > sequence:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,292 @@
+import fcntl
+import mmap
+import os
+import struct
+from bisect import bisect_left, insort
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
+from pathlib import Path
+
+from template_fastapi.models.item import Item, ItemFacets
+from template_fastapi.repositories.items import ItemRepository, ItemSort
+from template_fastapi.settings.logging import get_logger
+
+logger = get_logger(__name__)
+
+HEAP_MAGIC = b"ITEMSHM1"
+# magic, epoch, end offset of the last published record
+HEAP_HEADER = struct.Struct("<8sQQ")
+# payload length, operation
+RECORD_HEADER = struct.Struct("<IB")
+RECORD_SAVE = 1
+RECORD_DELETE = 2
+ITEM_ID = struct.Struct("<q")
+INITIAL_CAPACITY = 1 << 20
+
+
+class SharedItemHeap:
+    """
+    Append-only record heap in a memory-mapped file shared by worker processes.
+
+    Writers serialise on an exclusive `flock` and publish records by bumping the
+    end offset in the header after the record bytes are in place. Readers never
+    lock: they read the end offset and consume the records before it. Compaction
+    writes a new file and bumps the epoch so readers re-open and rebuild.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self.path.with_name(self.path.name + ".lock"), "a+b")
+        self._file = None
+        self._mm = None
+        with self.lock():
+            if not self.path.exists() or self.path.stat().st_size < HEAP_HEADER.size:
+                self._create(self.path, epoch=0, records=b"")
+            self.reopen()
+
+    @staticmethod
+    def _create(path: Path, epoch: int, records: bytes) -> None:
+        capacity = max(INITIAL_CAPACITY, 1 << (HEAP_HEADER.size + len(records)).bit_length())
+        temporary_path = path.with_name(path.name + ".tmp")
+        with open(temporary_path, "wb") as f:
+            f.write(HEAP_HEADER.pack(HEAP_MAGIC, epoch, HEAP_HEADER.size + len(records)))
+            f.write(records)
+            f.truncate(capacity)
+        os.replace(temporary_path, path)
+
+    def reopen(self) -> None:
+        """Map the current heap file, e.g. after another process compacted it."""
+        self.close()
+        self._file = open(self.path, "r+b")
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        if self._mm[:8] != HEAP_MAGIC:
+            raise ValueError(f"Not a shared items heap: {self.path}")
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+            self._mm = self._file = None
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """Hold the cross-process write lock."""
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    @property
+    def epoch(self) -> int:
+        return HEAP_HEADER.unpack_from(self._mm)[1]
+
+    @property
+    def end(self) -> int:
+        return HEAP_HEADER.unpack_from(self._mm)[2]
+
+    def records(self, start: int, end: int) -> Iterator[tuple[int, int, bytes]]:
+        """Yield (offset, operation, payload) of the records between two offsets."""
+        if end > len(self._mm):
+            # Another process grew the file since it was mapped
+            self._mm.close()
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+        position = start
+        while position < end:
+            length, operation = RECORD_HEADER.unpack_from(self._mm, position)
+            payload_start = position + RECORD_HEADER.size
+            yield position, operation, self._mm[payload_start : payload_start + length]
+            position = payload_start + length
+
+    def payload(self, offset: int) -> bytes:
+        """Read the payload of the record at an offset."""
+        length, _ = RECORD_HEADER.unpack_from(self._mm, offset)
+        start = offset + RECORD_HEADER.size
+        return self._mm[start : start + length]
+
+    def append(self, records: list[tuple[int, bytes]]) -> None:
+        """Append and publish records. Must be called while holding `lock()`."""
+        data = b"".join(RECORD_HEADER.pack(len(payload), operation) + payload for operation, payload in records)
+        end = self.end
+        if end + len(data) > len(self._mm):
+            capacity = 1 << (end + len(data)).bit_length()
+            self._file.truncate(capacity)
+            self._mm.close()
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._mm[end : end + len(data)] = data
+        # Publishing the new end offset last makes the records visible to lock-free readers
+        struct.pack_into("<Q", self._mm, 16, end + len(data))
+
+    def compact(self, records: list[tuple[int, bytes]]) -> None:
+        """Replace the heap with the given live records. Must be called while holding `lock()`."""
+        data = b"".join(RECORD_HEADER.pack(len(payload), operation) + payload for operation, payload in records)
+        epoch = self.epoch + 1
+        self._create(self.path, epoch=epoch, records=data)
+        # Readers still mapping the old file notice the epoch change and re-open
+        struct.pack_into("<Q", self._mm, 8, epoch)
+        self.reopen()
+
+
+class SharedItemsView(Mapping):
+    """Item IDs mapped to records in the shared heap, decoded on access."""
+
+    def __init__(self, heap: SharedItemHeap):
+        self.heap = heap
+        self.offsets: dict[int, int] = {}
+
+    def __getitem__(self, item_id: int) -> Item:
+        return Item.model_validate_json(self.heap.payload(self.offsets[item_id]))
+
+    def __contains__(self, item_id: object) -> bool:
+        return item_id in self.offsets
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+
+class SharedItemRepository(ItemRepository):
+    """
+    Items repository whose catalogue lives in a memory-mapped file shared by all workers.
+
+    Each worker keeps only the offsets of the live records and its search
+    indexes, and decodes items from the shared mapping on access, so N workers
+    serve the same data from one copy of the catalogue in the page cache.
+    Every read first catches up with records published by other workers,
+    which also drops the cached encodings of the items they wrote.
+    """
+
+    # Compact once the heap holds this many times more records than live items
+    _COMPACTION_RATIO = 2
+    _COMPACTION_MIN_RECORDS = 10000
+
+    def __init__(self, path: str | Path, items: list[Item] | None = None):
+        self.heap = SharedItemHeap(path)
+        super().__init__()
+        self.items = SharedItemsView(self.heap)
+        self._epoch = self.heap.epoch
+        self._position = HEAP_HEADER.size
+        self._records = 0
+        with self.heap.lock():
+            if self.heap.end == HEAP_HEADER.size and items:
+                self.heap.append([(RECORD_SAVE, item.model_dump_json().encode()) for item in items])
+            self._sync()
+
+    def _reset(self) -> None:
+        self.items.offsets.clear()
+        self._encoded.clear()
+        self._sequence.clear()
+        self._sorted_ids = []
+        self.index = type(self.index)()
+        self._position = HEAP_HEADER.size
+        self._records = 0
+
+    def _sync(self) -> None:
+        """Apply records published since the last sync. Lock-free unless the heap was compacted."""
+        if self.heap.epoch != self._epoch:
+            self.heap.reopen()
+            self._epoch = self.heap.epoch
+            self._reset()
+        end = self.heap.end
+        if end == self._position:
+            return
+
+        records = list(self.heap.records(self._position, end))
+        self._position = end
+        self._records += len(records)
+        # Large catch-ups (startup, compaction) rebuild the sorted indexes once at the end
+        bulk = len(records) > self._BULK_LOAD_THRESHOLD
+        saved: dict[int, Item] = {}
+        for offset, operation, payload in records:
+            if operation == RECORD_SAVE:
+                item = Item.model_validate_json(payload)
+                if item.id not in self._sequence:
+                    self._sequence[item.id] = self._next_sequence
+                    self._next_sequence += 1
+                    if not bulk:
+                        insort(self._sorted_ids, item.id)
+                self.items.offsets[item.id] = offset
+                self._encoded.pop(item.id, None)
+                saved[item.id] = item
+            else:
+                item_id = ITEM_ID.unpack(payload)[0]
+                self._encoded.pop(item_id, None)
+                if self.items.offsets.pop(item_id, None) is not None:
+                    del self._sequence[item_id]
+                    if not bulk:
+                        del self._sorted_ids[bisect_left(self._sorted_ids, item_id)]
+                    self.index.remove(item_id)
+                    saved.pop(item_id, None)
+
+        if bulk:
+            self.index.add_many(list(saved.values()))
+            self._sorted_ids = sorted(self.items.offsets)
+        else:
+            for item in saved.values():
+                self.index.add(item)
+
+    def _write(self, records: list[tuple[int, bytes]]) -> None:
+        with self.heap.lock():
+            self._sync()
+            self.heap.append(records)
+            self._sync()
+            if self._records > max(self._COMPACTION_MIN_RECORDS, self._COMPACTION_RATIO * len(self.items)):
+                self._compact()
+
+    def _compact(self) -> None:
+        live = [(RECORD_SAVE, bytes(self.heap.payload(offset))) for offset in self.items.offsets.values()]
+        logger.info(f"Compacting shared items heap {self.heap.path}: {self._records} records, {len(live)} live")
+        self.heap.compact(live)
+        self._epoch = self.heap.epoch
+        self._reset()
+        self._sync()
+
+    def load_items(self, items: list[Item]) -> None:
+        self._write([(RECORD_SAVE, item.model_dump_json().encode()) for item in items])
+
+    def _save_item(self, item: Item) -> None:
+        self._write([(RECORD_SAVE, item.model_dump_json().encode())])
+
+    def _delete_item(self, item_id: int) -> bool:
+        with self.heap.lock():
+            self._sync()
+            if item_id not in self.items:
+                return False
+            self.heap.append([(RECORD_DELETE, ITEM_ID.pack(item_id))])
+            self._sync()
+        return True
+
+    def __len__(self) -> int:
+        self._sync()
+        return super().__len__()
+
+    def __contains__(self, item_id: int) -> bool:
+        self._sync()
+        return super().__contains__(item_id)
+
+    def iter_items(self) -> Iterator[Item]:
+        self._sync()
+        yield from super().iter_items()
+
+    def list_items(self, skip: int = 0, limit: int = 10, sort: ItemSort | None = None) -> list[Item]:
+        self._sync()
+        return super().list_items(skip, limit, sort)
+
+    def list_items_after(self, cursor: str | None = None, limit: int = 10) -> tuple[list[Item], str | None]:
+        self._sync()
+        return super().list_items_after(cursor, limit)
+
+    def get_item(self, item_id: int) -> Item | None:
+        self._sync()
+        return super().get_item(item_id)
+
+    def search_items(self, *args, **kwargs) -> list[Item]:
+        self._sync()
+        return super().search_items(*args, **kwargs)
+
+    def facets(self, *args, **kwargs) -> ItemFacets:
+        self._sync()
+        return super().facets(*args, **kwargs)
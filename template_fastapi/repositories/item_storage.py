@@ -0,0 +1,455 @@
+import gc
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from template_fastapi.models.item import Item
+from template_fastapi.settings.logging import get_logger
+
+logger = get_logger(__name__)
+
+SNAPSHOT_MAGIC = b"ITEMSNP2"
+# Snapshots written before the index state was saved alongside the items
+SNAPSHOT_MAGIC_V1 = b"ITEMSNP1"
+# magic, item count, string count
+SNAPSHOT_HEADER = struct.Struct("<8sQQ")
+# Whether index state follows the items (v2 only)
+SNAPSHOT_INDEX_FLAG = struct.Struct("<Q")
+# Element count of a variable-length array in the index state
+ARRAY_LENGTH = struct.Struct("<Q")
+# operation, payload length, payload CRC32
+LOG_RECORD_HEADER = struct.Struct("<BII")
+LOG_SAVE = 1
+LOG_DELETE = 2
+ITEM_ID = struct.Struct("<q")
+
+
+@dataclass
+class ItemColumns:
+    """The items of a snapshot as columns, in insertion order."""
+
+    ids: np.ndarray
+    prices: np.ndarray
+    names: list[str]
+    descriptions: list[str | None]
+    tags: list[list[str]]
+
+    @classmethod
+    def from_items(cls, items: Iterable[Item]) -> "ItemColumns":
+        items = list(items)
+        return cls(
+            ids=np.fromiter((item.id for item in items), dtype=np.int64, count=len(items)),
+            prices=np.fromiter((item.price for item in items), dtype=np.float64, count=len(items)),
+            names=[item.name for item in items],
+            descriptions=[item.description for item in items],
+            tags=[list(item.tags) for item in items],
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def to_items(self) -> list[Item]:
+        # Values were validated before they were written, so skip re-validation
+        return [
+            Item.model_construct(id=item_id, name=name, description=description, price=price, tags=tags)
+            for item_id, name, description, price, tags in zip(
+                self.ids.tolist(), self.names, self.descriptions, self.prices.tolist(), self.tags
+            )
+        ]
+
+
+@dataclass
+class ItemIndexState:
+    """
+    Search index state saved alongside the items, so that startup restores it instead of rebuilding it.
+
+    Orders and tag postings refer to rows of the snapshot columns. Posting lists
+    are stored as offsets and values arrays: the values of key `k` are
+    `values[offsets[k] : offsets[k + 1]]`.
+    """
+
+    # Rows in (price, ID) and (lowercase name, ID) order
+    price_order: np.ndarray
+    name_order: np.ndarray
+    # Text tokens, the IDs of the items containing each one and the tokens of each row
+    vocabulary: list[str]
+    token_offsets: np.ndarray
+    token_ids: np.ndarray
+    item_token_offsets: np.ndarray
+    item_tokens: np.ndarray
+    # Trigrams of the vocabulary and the indices of the tokens containing each one
+    trigrams: list[str]
+    trigram_offsets: np.ndarray
+    trigram_tokens: np.ndarray
+    # Tags and the rows carrying each one
+    tags: list[str]
+    tag_offsets: np.ndarray
+    tag_rows: np.ndarray
+
+
+# dtype of every array of the index state, in the order they are written
+_INDEX_ARRAYS = {
+    "price_order": "<i8",
+    "name_order": "<i8",
+    "token_offsets": "<i8",
+    "token_ids": "<i8",
+    "item_token_offsets": "<i8",
+    "item_tokens": "<u4",
+    "trigram_offsets": "<i8",
+    "trigram_tokens": "<u4",
+    "tag_offsets": "<i8",
+    "tag_rows": "<i8",
+}
+_INDEX_STRINGS = ("vocabulary", "trigrams", "tags")
+
+
+def clear_in_chunks(*lists: list) -> None:
+    """
+    Empty large lists a chunk at a time.
+
+    Dropping millions of references in a single call holds the GIL throughout,
+    which would stall writes while a snapshot is written in the background.
+    """
+    for values in lists:
+        while values:
+            del values[-65536:]
+
+
+def _write_strings(f, strings: Iterable[str]) -> None:
+    encoded = [text.encode() for text in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+    np.cumsum(np.fromiter((len(data) for data in encoded), dtype="<u8", count=len(encoded)), out=offsets[1:])
+    _write_array(f, offsets, "<u8")
+    f.write(b"".join(encoded))
+
+
+def _write_array(f, values: Any, dtype: str) -> None:
+    array = np.ascontiguousarray(values, dtype=dtype)
+    f.write(ARRAY_LENGTH.pack(len(array)))
+    f.write(array.tobytes())
+
+
+def write_snapshot(path: Path, columns: ItemColumns, index: ItemIndexState | None = None) -> int:
+    """
+    Write items, and optionally their index state, to a compact binary snapshot. Returns the number of items.
+
+    The layout is columnar: a header, then the IDs, prices, tag counts and
+    description flags as fixed-width arrays, then the end offset of every
+    string (name, description and tags of each item) into a UTF-8 blob. The
+    index state follows as length-prefixed arrays and string tables.
+
+    Snapshots are written on a background thread, so columns are filled from
+    generators: converting a list of millions of ints in a single call would
+    hold the GIL throughout and stall concurrent writes.
+    """
+    offsets = array("q", [0])
+    blob = bytearray()
+    for name, description, tags in zip(columns.names, columns.descriptions, columns.tags):
+        for text in (name, description or "", *tags):
+            blob += text.encode()
+            offsets.append(len(blob))
+
+    with open(path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(columns), len(offsets) - 1))
+        f.write(np.asarray(columns.ids, dtype="<i8").tobytes())
+        f.write(np.asarray(columns.prices, dtype="<f8").tobytes())
+        f.write(np.fromiter((len(tags) for tags in columns.tags), dtype="<u4", count=len(columns)).tobytes())
+        described = (description is not None for description in columns.descriptions)
+        f.write(np.fromiter(described, dtype="u1", count=len(columns)).tobytes())
+        f.write(np.frombuffer(offsets, dtype=np.int64).astype("<u8").tobytes())
+        f.write(blob)
+        f.write(SNAPSHOT_INDEX_FLAG.pack(index is not None))
+        if index is not None:
+            for name in _INDEX_STRINGS:
+                _write_strings(f, getattr(index, name))
+            for name, dtype in _INDEX_ARRAYS.items():
+                _write_array(f, getattr(index, name), dtype)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(columns)
+
+
+def read_snapshot_columns(path: Path) -> tuple[ItemColumns, ItemIndexState | None]:
+    """Read the columns and any index state of a snapshot written by `write_snapshot` through a memory map."""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, count, string_count = SNAPSHOT_HEADER.unpack_from(mm)
+        if magic not in (SNAPSHOT_MAGIC, SNAPSHOT_MAGIC_V1):
+            raise ValueError(f"Not an items snapshot: {path}")
+
+        position = SNAPSHOT_HEADER.size
+
+        def column(dtype: str, length: int) -> np.ndarray:
+            nonlocal position
+            # Copied out of the map, which is closed once the snapshot is read
+            array = np.frombuffer(mm, dtype=dtype, count=length, offset=position).copy()
+            position += array.nbytes
+            return array
+
+        def array(dtype: str) -> np.ndarray:
+            nonlocal position
+            (length,) = ARRAY_LENGTH.unpack_from(mm, position)
+            position += ARRAY_LENGTH.size
+            return column(dtype, length)
+
+        def strings(offsets: np.ndarray) -> list[str]:
+            nonlocal position
+            bounds = (offsets + position).tolist()
+            position = bounds[-1]
+            return [mm[start:end].decode() for start, end in zip(bounds, bounds[1:])]
+
+        ids = column("<i8", count)
+        prices = column("<f8", count)
+        tag_counts = column("<u4", count).tolist()
+        has_description = column("u1", count).tolist()
+        texts = strings(column("<u8", string_count + 1))
+
+        index = None
+        if magic == SNAPSHOT_MAGIC and SNAPSHOT_INDEX_FLAG.unpack_from(mm, position)[0]:
+            position += SNAPSHOT_INDEX_FLAG.size
+            values: dict[str, Any] = {name: strings(array("<u8")) for name in _INDEX_STRINGS}
+            values.update((name, array(dtype)) for name, dtype in _INDEX_ARRAYS.items())
+            index = ItemIndexState(*(values[field.name] for field in fields(ItemIndexState)))
+
+    names, descriptions, tags = [], [], []
+    cursor = 0
+    for tag_count, described in zip(tag_counts, has_description):
+        names.append(texts[cursor])
+        descriptions.append(texts[cursor + 1] if described else None)
+        tags.append(texts[cursor + 2 : cursor + 2 + tag_count])
+        cursor += 2 + tag_count
+    return ItemColumns(ids, prices, names, descriptions, tags), index
+
+
+def read_snapshot(path: Path) -> list[Item]:
+    """Read the items of a snapshot written by `write_snapshot`."""
+    columns, _ = read_snapshot_columns(path)
+    return columns.to_items()
+
+
+class ItemStorage:
+    """
+    Snapshot plus append-only log persistence for the items store.
+
+    Every write is appended to an operation log. Once the log holds
+    `snapshot_interval` records it is rotated aside, and a compacted binary
+    snapshot of the store and its search index is written on a background
+    thread, after which the rotated log is deleted. On startup the snapshot is
+    memory-mapped, the index is restored from it, and the logs are replayed on
+    top.
+    """
+
+    def __init__(self, directory: str | Path, snapshot_interval: int = 10000, fsync: bool = False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.snapshot_path = self.directory / "items.snapshot"
+        self.log_path = self.directory / "items.log"
+        # Log rotated aside while a snapshot is written; kept if the snapshot fails
+        self.rotated_log_path = self.directory / "items.log.old"
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self._log = None
+        self._log_records = 0
+        self._source = None
+        self._snapshot_thread: threading.Thread | None = None
+
+    def exists(self) -> bool:
+        """Whether a snapshot or log has been written to the directory."""
+        return any(path.exists() for path in (self.snapshot_path, self.log_path, self.rotated_log_path))
+
+    def load(self) -> list[Item]:
+        """Load the snapshot and replay the logs, returning items in insertion order."""
+        items: dict[int, Item] = {}
+        if self.snapshot_path.exists():
+            for item in read_snapshot(self.snapshot_path):
+                items[item.id] = item
+
+        for operation, payload in self._replay_logs():
+            if operation == LOG_SAVE:
+                item = Item.model_validate_json(payload)
+                items[item.id] = item
+            else:
+                items.pop(ITEM_ID.unpack(payload)[0], None)
+
+        logger.info(f"Loaded {len(items)} items from {self.directory} ({self._log_records} log records replayed)")
+        return list(items.values())
+
+    def restore(self, repository_class):
+        """
+        Build a repository from the snapshot and the index state saved with it, then replay the logs into it.
+
+        Consecutive saves in the logs are applied as one bulk load, so that the
+        sort indexes are merged once per batch instead of once per record.
+        """
+        if self.snapshot_path.exists():
+            repository = repository_class.restore(*read_snapshot_columns(self.snapshot_path))
+        else:
+            repository = repository_class()
+
+        batch: list[Item] = []
+        for operation, payload in self._replay_logs():
+            if operation == LOG_SAVE:
+                batch.append(Item.model_validate_json(payload))
+                continue
+            if batch:
+                repository.load_items(batch)
+                batch = []
+            repository.delete_items([ITEM_ID.unpack(payload)[0]])
+        if batch:
+            repository.load_items(batch)
+
+        logger.info(
+            f"Restored {len(repository)} items from {self.directory} ({self._log_records} log records replayed)"
+        )
+        return repository
+
+    def _replay_logs(self) -> Iterator[tuple[int, bytes]]:
+        # Records in a rotated log predate the current log but may be missing from the snapshot
+        for path in (self.rotated_log_path, self.log_path):
+            yield from self._replay_log(path)
+
+    def _replay_log(self, path: Path) -> Iterator[tuple[int, bytes]]:
+        if not path.exists():
+            return
+        data = path.read_bytes()
+        position = 0
+        while position + LOG_RECORD_HEADER.size <= len(data):
+            operation, length, crc = LOG_RECORD_HEADER.unpack_from(data, position)
+            start = position + LOG_RECORD_HEADER.size
+            payload = data[start : start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc or operation not in (LOG_SAVE, LOG_DELETE):
+                break
+            yield operation, payload
+            self._log_records += 1
+            position = start + length
+
+        if position < len(data):
+            # Drop a record torn by a crash while it was being appended
+            logger.warning(f"Truncating {len(data) - position} bytes of incomplete log records in {path}")
+            with open(path, "r+b") as f:
+                f.truncate(position)
+
+    def attach(self, repository) -> None:
+        """Persist every subsequent write made through the repository."""
+        self._source = repository
+        repository.subscribe(self)
+
+    def items_saved(self, items: list[Item]) -> None:
+        self._append([(LOG_SAVE, item.model_dump_json().encode()) for item in items])
+
+    def items_deleted(self, item_ids: list[int]) -> None:
+        self._append([(LOG_DELETE, ITEM_ID.pack(item_id)) for item_id in item_ids])
+
+    def _append(self, records: list[tuple[int, bytes]]) -> None:
+        if self._log is None:
+            self._log = open(self.log_path, "ab")
+        self._log.write(
+            b"".join(
+                LOG_RECORD_HEADER.pack(operation, len(payload), zlib.crc32(payload)) + payload
+                for operation, payload in records
+            )
+        )
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+
+        self._log_records += len(records)
+        if self._source is not None and self._log_records >= self.snapshot_interval and not self.snapshotting:
+            self.checkpoint()
+
+    @property
+    def snapshotting(self) -> bool:
+        """Whether a background snapshot is being written."""
+        return self._snapshot_thread is not None and self._snapshot_thread.is_alive()
+
+    def checkpoint(self, wait: bool = False) -> None:
+        """
+        Snapshot the attached repository with its index state.
+
+        The repository is frozen and the log rotated on the calling thread,
+        which takes a few milliseconds; the snapshot itself is written on a
+        background thread unless `wait` is set.
+        """
+        self.wait()
+        # Freezing copies millions of references into new lists; a collection
+        # midway would only traverse them, so it is deferred until they are built
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            build = self._source.snapshot_state()
+            self._rotate_log()
+        finally:
+            if collecting:
+                gc.enable()
+        if wait:
+            self._write_snapshot(build)
+            return
+        self._snapshot_thread = threading.Thread(
+            target=self._write_snapshot_in_background, args=(build,), name="items-snapshot", daemon=True
+        )
+        self._snapshot_thread.start()
+
+    def _rotate_log(self) -> None:
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self.rotated_log_path.exists():
+            # The previous snapshot failed, so its rotated log is still needed and grows instead
+            if self.log_path.exists():
+                with open(self.rotated_log_path, "ab") as f:
+                    f.write(self.log_path.read_bytes())
+        elif self.log_path.exists():
+            os.replace(self.log_path, self.rotated_log_path)
+        self._log = open(self.log_path, "wb")
+        self._log_records = 0
+
+    def _write_snapshot(self, build: Callable[[], tuple[ItemColumns, ItemIndexState]]) -> None:
+        columns, index = build()
+        self._replace_snapshot(columns, index)
+        clear_in_chunks(columns.names, columns.descriptions, columns.tags, index.vocabulary, index.trigrams)
+        # Replaying the rotated log on top of the new snapshot is idempotent, so a
+        # crash before it is deleted cannot corrupt the store
+        self.rotated_log_path.unlink(missing_ok=True)
+
+    def _write_snapshot_in_background(self, build: Callable[[], tuple[ItemColumns, ItemIndexState]]) -> None:
+        try:
+            self._write_snapshot(build)
+        except Exception:
+            # The rotated log is kept, and the next snapshot appends the current log to it
+            logger.exception(f"Failed to write snapshot to {self.snapshot_path}")
+
+    def _replace_snapshot(self, columns: ItemColumns, index: ItemIndexState | None) -> None:
+        temporary_path = self.snapshot_path.with_suffix(".tmp")
+        count = write_snapshot(temporary_path, columns, index)
+        os.replace(temporary_path, self.snapshot_path)
+        logger.info(f"Wrote snapshot of {count} items to {self.snapshot_path}")
+
+    def snapshot(self, items: Iterable[Item]) -> None:
+        """Write a compacted snapshot of the items, without index state, and truncate the logs."""
+        self.wait()
+        self._replace_snapshot(ItemColumns.from_items(items), None)
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, "wb")
+        self._log_records = 0
+        self.rotated_log_path.unlink(missing_ok=True)
+
+    def wait(self) -> None:
+        """Wait for a background snapshot to finish."""
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+
+    def close(self) -> None:
+        self.wait()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
@@ -1,7 +1,1549 @@
-from template_fastapi.models.item import Item
+import base64
+import gc
+import heapq
+import json
+import math
+import re
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from itertools import chain, islice
+from typing import Any, Literal, Protocol
+
+import numpy as np
+
+from template_fastapi.models.item import Item, ItemFacets, PriceBucket
+from template_fastapi.repositories.item_changes import ItemChangeFeed
+from template_fastapi.repositories.item_storage import ItemColumns, ItemIndexState, ItemStorage, clear_in_chunks
+from template_fastapi.settings.items import get_items_settings
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Orders served from the sort indexes; a leading `-` sorts in descending order
+ItemSort = Literal["id", "name", "price", "-price"]
+
+# Lower bounds of the price buckets returned by `facets`; the last bucket is open-ended
+PRICE_BUCKET_EDGES = (0.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0)
+
+
+def _tokenize(text: str | None) -> set[str]:
+    """Split text into the set of lowercase word tokens."""
+    if not text:
+        return set()
+    return set(_TOKEN_PATTERN.findall(text.lower()))
+
+
+def _intersect(sets: list[set[int]]) -> set[int]:
+    """Intersect posting sets, starting from the smallest one."""
+    if not sets:
+        return set()
+    sets = sorted(sets, key=len)
+    result = set(sets[0])
+    for other in sets[1:]:
+        if not result:
+            break
+        result &= other
+    return result
+
+
+def _discard(postings: dict[str, set[int]], key: str, item_id: int) -> None:
+    ids = postings[key]
+    ids.discard(item_id)
+    if not ids:
+        del postings[key]
+
+
+def _matches_text(q: str, name: str, description: str | None) -> bool:
+    """Lowercase substring match of `q` against an item's name or description."""
+    return q in name.lower() or (description is not None and q in description.lower())
+
+
+def _trigrams(token: str) -> set[str]:
+    """Trigrams of a token, padded so that its start and end weigh more."""
+    padded = f"  {token} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def _fuzzy_ranking(
+    levels: list[list[tuple[float, set[int]]]],
+    limit: int | None,
+    order: Callable[[int], int],
+    ordered_ids: Callable[[], Iterator[int]],
+    size: int,
+    candidates: set[int] | None = None,
+) -> list[int]:
+    """
+    Rank items by fuzzy score, ties in store order, stopping once `limit` are found.
+
+    `levels` holds, for every query token, the IDs of items containing a
+    similar token grouped by descending similarity, and an item scores the sum
+    of the first level it appears in for each token. Combinations of levels are
+    popped from a heap from the highest score down, so only the items of the
+    combinations needed for the top `limit` are ever looked at.
+    """
+    levels = [token_levels for token_levels in levels if token_levels]
+    if not levels:
+        return []
+
+    def score(combination: tuple[int, ...]) -> float:
+        return round(sum(levels[t][i][0] for t, i in enumerate(combination) if i < len(levels[t])), 9)
+
+    def members(combination: tuple[int, ...], need: int | None) -> list[int]:
+        required = [levels[t][i][1] for t, i in enumerate(combination) if i < len(levels[t])]
+        if candidates is not None:
+            required.append(candidates)
+        # Items in a higher level of a token score that level instead
+        excluded = [ids for t, i in enumerate(combination) for _, ids in levels[t][:i]]
+
+        def matches(item_id: int) -> bool:
+            return all(item_id in ids for ids in required) and not any(item_id in ids for ids in excluded)
+
+        smallest = min(required, key=len)
+        if need is not None and need * size < len(smallest) ** 2:
+            # Dense combinations: walking the `size` items of the store in order finds the first members quickly
+            return list(islice(filter(matches, ordered_ids()), need))
+        found = [item_id for item_id in smallest if matches(item_id)]
+        return sorted(found, key=order) if need is None else heapq.nsmallest(need, found, key=order)
+
+    start = (0,) * len(levels)
+    heap = [(-score(start), start)]
+    seen = {start}
+    ranked: list[int] = []
+    while heap and heap[0][0] < 0 and (limit is None or len(ranked) < limit):
+        best = heap[0][0]
+        need = None if limit is None else limit - len(ranked)
+        tied: list[int] = []
+        while heap and heap[0][0] == best:
+            _, combination = heapq.heappop(heap)
+            tied.extend(members(combination, need))
+            for t, i in enumerate(combination):
+                if i < len(levels[t]):
+                    following = combination[:t] + (i + 1,) + combination[t + 1 :]
+                    if following not in seen:
+                        seen.add(following)
+                        heapq.heappush(heap, (-score(following), following))
+        ranked.extend(sorted(tied, key=order)[:need])
+    return ranked
+
+
+def _fuzzy_matches(levels: list[list[tuple[float, set[int]]]], candidates: set[int] | None = None) -> set[int]:
+    """IDs of every item with a positive fuzzy score."""
+    matched = set().union(*(ids for token_levels in levels for _, ids in token_levels))
+    return matched if candidates is None else matched & candidates
+
+
+class TrigramIndex:
+    """Trigram posting lists over a vocabulary of tokens, used to find tokens similar to a misspelt one."""
+
+    def __init__(self):
+        self._postings: dict[str, set[str]] = {}
+        self._sizes: dict[str, int] = {}
+
+    def add(self, token: str) -> None:
+        trigrams = _trigrams(token)
+        self._sizes[token] = len(trigrams)
+        for trigram in trigrams:
+            self._postings.setdefault(trigram, set()).add(token)
+
+    def restore(self, state: ItemIndexState) -> None:
+        """Restore the postings from the index state saved with a snapshot."""
+        vocabulary = state.vocabulary
+        offsets = state.trigram_offsets.tolist()
+        tokens = state.trigram_tokens.tolist()
+        self._postings = {
+            trigram: set(map(vocabulary.__getitem__, tokens[start:end]))
+            for trigram, start, end in zip(state.trigrams, offsets, offsets[1:])
+        }
+        self._sizes = dict(zip(vocabulary, np.bincount(state.trigram_tokens, minlength=len(vocabulary)).tolist()))
+
+    def remove(self, token: str) -> None:
+        if self._sizes.pop(token, None) is None:
+            return
+        for trigram in _trigrams(token):
+            _discard(self._postings, trigram, token)
+
+    def containing(self, fragment: str) -> set[str]:
+        """Vocabulary tokens containing `fragment` as a substring."""
+        if len(fragment) >= 3:
+            # A token containing the fragment has every trigram of it
+            postings = sorted(
+                (self._postings.get(fragment[i : i + 3], set()) for i in range(len(fragment) - 2)), key=len
+            )
+            tokens = set(postings[0])
+            for other in postings[1:]:
+                if not tokens:
+                    break
+                tokens &= other
+        else:
+            # Too short for a trigram of its own: it lies inside some padded trigram of every token containing
+            # it, and the trigrams are bounded by the alphabet rather than by the size of the vocabulary
+            tokens = set().union(*(tokens for trigram, tokens in self._postings.items() if fragment in trigram))
+        return {token for token in tokens if fragment in token}
+
+    def similar(self, token: str, threshold: float) -> dict[str, float]:
+        """Vocabulary tokens whose trigram Jaccard similarity to `token` is at least `threshold`."""
+        trigrams = _trigrams(token)
+        postings = sorted((self._postings.get(trigram, set()) for trigram in trigrams), key=len)
+        # A similar token shares at least `threshold` of the query's trigrams, so it has to contain
+        # one of the rarest ones and only those postings need to be counted
+        prefix_length = len(postings) - math.ceil(threshold * len(postings)) + 1
+        overlaps: Counter[str] = Counter()
+        for tokens in postings[:prefix_length]:
+            overlaps.update(tokens)
+
+        similar = {}
+        common = postings[prefix_length:]
+        for candidate, overlap in overlaps.items():
+            for tokens in common:
+                if candidate in tokens:
+                    overlap += 1
+            similarity = overlap / (len(trigrams) + self._sizes[candidate] - overlap)
+            if similarity >= threshold:
+                similar[candidate] = similarity
+        return similar
+
+
+class TextIndex:
+    """Token posting lists over item names and descriptions."""
+
+    # Minimum trigram similarity for a token to match a query token in fuzzy searches
+    FUZZY_THRESHOLD = 0.3
+
+    def __init__(self):
+        self._token_postings: dict[str, set[int]] = {}
+        self._item_tokens: dict[int, set[str]] = {}
+        # Row of each item restored from a snapshot and not written since, and the tokens saved for each row
+        self._saved_rows: dict[int, int] = {}
+        self._saved_vocabulary: list[str] = []
+        self._saved_offsets = np.zeros(1, dtype=np.int64)
+        self._saved_tokens = np.zeros(0, dtype=np.uint32)
+        self.trigrams = TrigramIndex()
+
+    def add(self, item_id: int, name: str, description: str | None) -> None:
+        """Index the text of an item, replacing any previous entry."""
+        self.remove(item_id)
+        tokens = _tokenize(name) | _tokenize(description)
+        for token in tokens:
+            postings = self._token_postings.get(token)
+            if postings is None:
+                postings = self._token_postings[token] = set()
+                self.trigrams.add(token)
+            postings.add(item_id)
+        self._item_tokens[item_id] = tokens
+
+    def restore(self, state: ItemIndexState, ids: list[int]) -> None:
+        """
+        Restore the index from the state saved with a snapshot whose rows hold `ids`.
+
+        The tokens of each restored item are kept in the saved arrays and only
+        turned into strings when the item is rewritten or deleted.
+        """
+        offsets = state.token_offsets.tolist()
+        token_ids = state.token_ids.tolist()
+        self._token_postings = {
+            token: set(token_ids[start:end]) for token, start, end in zip(state.vocabulary, offsets, offsets[1:])
+        }
+        self._item_tokens = {}
+        self._saved_rows = dict(zip(ids, range(len(ids))))
+        self._saved_vocabulary = state.vocabulary
+        self._saved_offsets = state.item_token_offsets
+        self._saved_tokens = state.item_tokens
+        self.trigrams.restore(state)
+
+    def _tokens(self, item_id: int) -> Iterable[str]:
+        """Pop the indexed tokens of an item."""
+        tokens = self._item_tokens.pop(item_id, None)
+        if tokens is not None:
+            return tokens
+        row = self._saved_rows.pop(item_id, None)
+        if row is None:
+            return ()
+        saved = self._saved_tokens[self._saved_offsets[row] : self._saved_offsets[row + 1]]
+        return [self._saved_vocabulary[index] for index in saved.tolist()]
+
+    def remove(self, item_id: int) -> None:
+        """Drop the text of an item if it is present."""
+        for token in self._tokens(item_id):
+            _discard(self._token_postings, token, item_id)
+            if token not in self._token_postings:
+                self.trigrams.remove(token)
+
+    def candidates(self, q: str) -> set[int] | None:
+        """
+        Candidate IDs for a lowercase substring query.
+
+        Every word fragment of the query has to occur inside some token of a
+        matching item, so the candidates are the intersection of the postings of
+        the vocabulary tokens containing each fragment. A fragment with non-word
+        characters on both sides in the query has to be a whole token and is
+        looked up directly; the others are found through the trigram index, and
+        have to start or end a token when the query continues before or after
+        them. Returns None when the query has no word characters and cannot be
+        answered from the index.
+        """
+        fragments = {(m.group(), m.start() > 0, m.end() < len(q)) for m in _TOKEN_PATTERN.finditer(q)}
+        if not fragments:
+            return None
+
+        candidate_sets = []
+        for fragment, starts_token, ends_token in fragments:
+            if starts_token and ends_token:
+                tokens = [fragment] if fragment in self._token_postings else []
+            else:
+                tokens = [
+                    token
+                    for token in self.trigrams.containing(fragment)
+                    if (not starts_token or token.startswith(fragment)) and (not ends_token or token.endswith(fragment))
+                ]
+            # The postings of a single token are intersected without copying them first
+            if len(tokens) == 1:
+                ids = self._token_postings[tokens[0]]
+            else:
+                ids = set().union(*(self._token_postings[token] for token in tokens))
+            if not ids:
+                return set()
+            candidate_sets.append(ids)
+        return _intersect(candidate_sets)
+
+    def fuzzy_levels(self, q: str) -> list[list[tuple[float, set[int]]]]:
+        """
+        Items approximately matching each token of a lowercase query.
+
+        Every query token is looked up in the trigram index of the vocabulary,
+        and the postings of the similar tokens are grouped by descending
+        similarity, ready for `_fuzzy_ranking`.
+        """
+        levels = []
+        for token in _tokenize(q):
+            by_similarity: dict[float, set[int]] = {}
+            for vocabulary_token, similarity in self.trigrams.similar(token, self.FUZZY_THRESHOLD).items():
+                ids = self._token_postings[vocabulary_token]
+                grouped = by_similarity.get(similarity)
+                by_similarity[similarity] = ids if grouped is None else grouped | ids
+            levels.append(sorted(by_similarity.items(), key=lambda level: level[0], reverse=True))
+        return levels
+
+
+class SortIndex:
+    """Item IDs ordered by a sort key and then by ID, maintained incrementally with bisect."""
+
+    def __init__(self):
+        self._entries: list[tuple[Any, int]] = []
+        self._keys: dict[int, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def key(self, item_id: int) -> Any:
+        return self._keys[item_id]
+
+    def entry(self, item_id: int) -> tuple[Any, int]:
+        """The sort position of an item, usable as a sort key."""
+        return self._keys[item_id], item_id
+
+    def histogram(self, edges: tuple | list) -> list[int]:
+        """Number of items in each bucket starting at the ascending `edges`, the last one open-ended."""
+        ranks = [bisect_left(self._entries, (edge, float("-inf"))) for edge in edges]
+        return [hi - lo for lo, hi in zip(ranks, [*ranks[1:], len(self._entries)])]
+
+    def add(self, item_id: int, key: Any) -> None:
+        """Insert an item or move it to the position of its new key."""
+        previous = self._keys.get(item_id)
+        if previous is not None:
+            if previous == key:
+                return
+            del self._entries[bisect_left(self._entries, (previous, item_id))]
+        insort(self._entries, (key, item_id))
+        self._keys[item_id] = key
+
+    def add_many(self, entries: Iterator[tuple[int, Any]]) -> None:
+        """Set the keys of a batch of items, sorting once at the end."""
+        batch = dict(entries)
+        if not batch.keys().isdisjoint(self._keys):
+            self._entries = [entry for entry in self._entries if entry[1] not in batch]
+        self._keys.update(batch)
+        self._entries.extend((key, item_id) for item_id, key in batch.items())
+        # Timsort merges the new entries into the sorted run of the existing ones in about linear time
+        self._entries.sort()
+
+    def copy_entries(self) -> list[tuple[Any, int]]:
+        """A copy of the (key, ID) entries in sort order."""
+        return list(self._entries)
+
+    def restore(self, keys: list, ids: list[int]) -> None:
+        """Restore the index from keys and IDs that are already in sort order."""
+        self._entries = list(zip(keys, ids))
+        self._keys = dict(zip(ids, keys))
+
+    def remove(self, item_id: int) -> None:
+        key = self._keys.pop(item_id, None)
+        if key is not None:
+            del self._entries[bisect_left(self._entries, (key, item_id))]
+
+    def _bounds(self, lo: Any, hi: Any) -> tuple[int, int]:
+        start = 0 if lo is None else bisect_left(self._entries, (lo, float("-inf")))
+        stop = len(self._entries) if hi is None else bisect_right(self._entries, (hi, float("inf")))
+        return start, stop
+
+    def count(self, lo: Any = None, hi: Any = None) -> int:
+        """Number of items whose key is between `lo` and `hi`, inclusive."""
+        start, stop = self._bounds(lo, hi)
+        return stop - start
+
+    def between(self, lo: Any = None, hi: Any = None) -> set[int]:
+        """IDs of the items whose key is between `lo` and `hi`, inclusive."""
+        start, stop = self._bounds(lo, hi)
+        return {item_id for _, item_id in self._entries[start:stop]}
+
+    def page(self, skip: int, limit: int, descending: bool = False) -> list[int]:
+        """IDs at positions `skip` to `skip + limit` of the sort order."""
+        if descending:
+            start, stop = max(0, len(self._entries) - skip - limit), max(0, len(self._entries) - skip)
+            return [item_id for _, item_id in reversed(self._entries[start:stop])]
+        return [item_id for _, item_id in self._entries[skip : skip + limit]]
+
+    def iter_ids(self, descending: bool = False, lo: Any = None, hi: Any = None) -> Iterator[int]:
+        """Walk the IDs in sort order, starting from the bound nearest to the walk."""
+        start, stop = self._bounds(lo, hi)
+        positions = range(stop - 1, start - 1, -1) if descending else range(start, stop)
+        entries = self._entries
+        for position in positions:
+            yield entries[position][1]
+
+
+def _order_ids(
+    ordered: Callable[[], Iterator[int]],
+    key: Callable[[int], Any],
+    descending: bool,
+    matches: Callable[[int], bool],
+    candidates: Callable[[], Iterable[int]],
+    count: int,
+    size: int,
+    limit: int | None,
+) -> list[int]:
+    """
+    Order the `count` matching candidates by a sort index, keeping the first `limit`.
+
+    When matches are dense among the `size` items of the store, walking the
+    index in order finds the first `limit` in about O(limit) steps; sparse ones
+    are picked from the candidates with a heap instead.
+    """
+    if limit is not None and limit * size < count**2:
+        return list(islice(filter(matches, ordered()), limit))
+    ids = filter(matches, candidates())
+    if limit is None:
+        return sorted(ids, key=key, reverse=descending)
+    return (heapq.nlargest if descending else heapq.nsmallest)(limit, ids, key=key)
+
+
+def _invert_postings(offsets: np.ndarray, keys: np.ndarray, size: int) -> tuple[np.ndarray, np.ndarray]:
+    """Turn posting lists of rows to keys in `range(size)` into posting lists of keys to rows."""
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))[np.argsort(keys, kind="stable")]
+    inverted = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=size), out=inverted[1:])
+    return inverted, rows
+
+
+def _ints(values: np.ndarray, chunk_size: int = 65536) -> Iterator[int]:
+    """
+    Iterate over an integer array as Python ints, converting one chunk at a time.
+
+    Converting millions of values in a single call holds the GIL throughout,
+    which would stall writes while a snapshot is built in the background.
+    """
+    for start in range(0, len(values), chunk_size):
+        yield from values[start : start + chunk_size].tolist()
+
+
+def _postings(rows: Iterable[Iterable[str]]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """Number the keys of each row, returning the keys and the row posting lists as offsets and values."""
+    numbers: dict[str, int] = {}
+    # Filled from generators rather than converted from lists, for the same reason as `_ints`
+    offsets = array("q", [0])
+    values = array("I")
+    for keys in rows:
+        values.extend(numbers.setdefault(key, len(numbers)) for key in keys)
+        offsets.append(len(values))
+    return list(numbers), np.frombuffer(offsets, dtype=np.int64), np.frombuffer(values, dtype=np.uint32)
+
+
+def _index_state(columns: ItemColumns, prices: list[tuple[float, int]], names: list[tuple[str, int]]) -> ItemIndexState:
+    """
+    Build the index state saved with a snapshot from its columns and the entries of its sort indexes.
+
+    This is the work that restoring the state saves at startup: tokenizing the
+    text and building the token, trigram and tag postings.
+    """
+    rows = {item_id: row for row, item_id in enumerate(_ints(columns.ids))}
+
+    vocabulary, item_token_offsets, item_tokens = _postings(
+        _tokenize(name) | _tokenize(description) for name, description in zip(columns.names, columns.descriptions)
+    )
+    token_offsets, token_rows = _invert_postings(item_token_offsets, item_tokens, len(vocabulary))
+    trigrams, token_trigram_offsets, token_trigrams = _postings(map(_trigrams, vocabulary))
+    trigram_offsets, trigram_tokens = _invert_postings(token_trigram_offsets, token_trigrams, len(trigrams))
+    tags, row_tag_offsets, row_tags = _postings(map(set, columns.tags))
+    tag_offsets, tag_rows = _invert_postings(row_tag_offsets, row_tags, len(tags))
+
+    return ItemIndexState(
+        price_order=np.fromiter((rows[item_id] for _, item_id in prices), dtype=np.int64, count=len(prices)),
+        name_order=np.fromiter((rows[item_id] for _, item_id in names), dtype=np.int64, count=len(names)),
+        vocabulary=vocabulary,
+        token_offsets=token_offsets,
+        token_ids=columns.ids[token_rows],
+        item_token_offsets=item_token_offsets,
+        item_tokens=item_tokens,
+        trigrams=trigrams,
+        trigram_offsets=trigram_offsets,
+        trigram_tokens=trigram_tokens,
+        tags=tags,
+        tag_offsets=tag_offsets,
+        tag_rows=tag_rows,
+    )
+
+
+def _restore_sort_indexes(prices: SortIndex, names: SortIndex, columns: ItemColumns, state: ItemIndexState) -> None:
+    prices.restore(columns.prices[state.price_order].tolist(), columns.ids[state.price_order].tolist())
+    names.restore(
+        [columns.names[row].lower() for row in state.name_order.tolist()], columns.ids[state.name_order].tolist()
+    )
+
+
+class ItemSearchIndex:
+    """
+    Inverted index over the items store used by `search_items`.
+
+    Keeps token posting lists for names and descriptions, per-tag posting sets
+    and sorted price and name indexes, all updated incrementally on every write.
+    """
+
+    def __init__(self):
+        self.text = TextIndex()
+        self._tag_postings: dict[str, set[int]] = {}
+        self._item_tags: dict[int, set[str]] = {}
+        self.prices = SortIndex()
+        self.names = SortIndex()
+
+    def add(self, item: Item) -> None:
+        """Index an item, replacing any previous entry with the same ID."""
+        self._remove_postings(item.id)
+        self._add_postings(item)
+        self.prices.add(item.id, item.price)
+        self.names.add(item.id, item.name.lower())
+
+    def add_many(self, items: list[Item]) -> None:
+        """Index a batch of items, sorting the price and name indexes once at the end."""
+        for item in items:
+            self._remove_postings(item.id)
+            self._add_postings(item)
+        self.prices.add_many((item.id, item.price) for item in items)
+        self.names.add_many((item.id, item.name.lower()) for item in items)
+
+    def restore(self, columns: ItemColumns, state: ItemIndexState) -> None:
+        """Restore the index of the snapshot `columns` from the state saved with them."""
+        ids = columns.ids.tolist()
+        self.text.restore(state, ids)
+        offsets = state.tag_offsets.tolist()
+        tag_ids = columns.ids[state.tag_rows].tolist()
+        self._tag_postings = {tag: set(tag_ids[start:end]) for tag, start, end in zip(state.tags, offsets, offsets[1:])}
+        self._item_tags = dict(zip(ids, map(set, columns.tags)))
+        _restore_sort_indexes(self.prices, self.names, columns, state)
+
+    def _add_postings(self, item: Item) -> None:
+        self.text.add(item.id, item.name, item.description)
+
+        tags = set(item.tags)
+        for tag in tags:
+            self._tag_postings.setdefault(tag, set()).add(item.id)
+        self._item_tags[item.id] = tags
+
+    def remove(self, item_id: int) -> None:
+        """Drop an item from the index if it is present."""
+        self._remove_postings(item_id)
+        self.prices.remove(item_id)
+        self.names.remove(item_id)
+
+    def _remove_postings(self, item_id: int) -> None:
+        tags = self._item_tags.pop(item_id, None)
+        if tags is None:
+            return
+        self.text.remove(item_id)
+        for tag in tags:
+            _discard(self._tag_postings, tag, item_id)
+
+    def facets(self, candidates: set[int] | None, price_edges: tuple[float, ...] | list[float]) -> ItemFacets:
+        """
+        Tag counts and price buckets of the candidates, or of every item if None.
+
+        Unfiltered facets come straight from the posting set sizes and the
+        sorted price index, which every write already keeps up to date.
+        """
+        if candidates is None:
+            tag_counts = {tag: len(ids) for tag, ids in self._tag_postings.items()}
+            return _item_facets(len(self.prices), tag_counts, price_edges, self.prices.histogram(price_edges))
+
+        # An element of a set intersection costs far less than counting a candidate's tags,
+        # so intersect unless the postings to walk far outnumber the candidates
+        intersection_cost = sum(min(len(ids), len(candidates)) for ids in self._tag_postings.values())
+        if intersection_cost <= 16 * len(candidates):
+            tag_counts = {tag: len(ids & candidates) for tag, ids in self._tag_postings.items()}
+        else:
+            tag_counts = Counter(chain.from_iterable(map(self._item_tags.__getitem__, candidates)))
+
+        prices = np.fromiter(map(self.prices.key, candidates), dtype=np.float64, count=len(candidates))
+        buckets = np.searchsorted(np.asarray(price_edges), prices, side="right") - 1
+        bucket_counts = np.bincount(np.compress(buckets >= 0, buckets), minlength=len(price_edges))
+        return _item_facets(len(candidates), tag_counts, price_edges, bucket_counts)
+
+    def match(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+    ) -> tuple[Callable[[int], bool], Callable[[], Iterable[int]], int] | None:
+        """
+        Describe the candidates for the given filters without intersecting them.
+
+        Returns a membership test, a way to iterate a superset of the
+        candidates, and the size of that superset, or None when no filter
+        narrows the result set. Suits callers that consume the candidates in
+        another order, where dense filters are cheaper to test than to build.
+        """
+        checks: list[Callable[[int], bool]] = []
+        sources: list[tuple[int, Callable[[], Iterable[int]]]] = []
+
+        for tag in set(tags or []):
+            ids = self._tag_postings.get(tag)
+            if not ids:
+                return (lambda item_id: False), (lambda: ()), 0
+            checks.append(ids.__contains__)
+            sources.append((len(ids), lambda ids=ids: ids))
+
+        if min_price is not None or max_price is not None:
+            lo = float("-inf") if min_price is None else min_price
+            hi = float("inf") if max_price is None else max_price
+            checks.append(lambda item_id: lo <= self.prices.key(item_id) <= hi)
+            sources.append((self.prices.count(min_price, max_price), lambda: self.prices.iter_ids(False, lo, hi)))
+
+        if q:
+            ids = self.text.candidates(q.lower())
+            if ids is not None:
+                checks.append(ids.__contains__)
+                sources.append((len(ids), lambda: ids))
+
+        if not sources:
+            return None
+        count, candidates = min(sources, key=lambda source: source[0])
+        return (lambda item_id: all(check(item_id) for check in checks)), candidates, count
+
+    def search(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+    ) -> set[int] | None:
+        """
+        Return the IDs of candidate items for the given filters.
+
+        Returns None when no filter narrows the result set. Text candidates are a
+        superset of the real matches and must be verified by the caller.
+        """
+        candidate_sets = []
+
+        for tag in set(tags or []):
+            ids = self._tag_postings.get(tag)
+            if not ids:
+                return set()
+            candidate_sets.append(ids)
+
+        if min_price is not None or max_price is not None:
+            candidate_sets.append(self.prices.between(min_price, max_price))
+
+        if q:
+            ids = self.text.candidates(q.lower())
+            if ids is not None:
+                candidate_sets.append(ids)
+
+        if not candidate_sets:
+            return None
+        return _intersect(candidate_sets)
+
+
+def _check_price_edges(price_edges: tuple[float, ...] | list[float]) -> None:
+    if not price_edges or any(lo >= hi for lo, hi in zip(price_edges, price_edges[1:])):
+        raise ValueError("Price bucket edges must be a non-empty, strictly ascending list")
+
+
+def _item_facets(total: int, tag_counts: dict[str, int], price_edges, bucket_counts) -> ItemFacets:
+    """Assemble facets, listing tags from the most frequent."""
+    tags = sorted(((tag, count) for tag, count in tag_counts.items() if count), key=lambda entry: (-entry[1], entry[0]))
+    bounds = [*price_edges[1:], None]
+    return ItemFacets(
+        total=total,
+        tags=dict(tags),
+        price_buckets=[
+            PriceBucket(min_price=lo, max_price=hi, count=int(count))
+            for lo, hi, count in zip(price_edges, bounds, bucket_counts)
+        ],
+    )
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor cannot be decoded."""
+
+
+def encode_cursor(item_id: int) -> str:
+    """Encode the last seen item ID into an opaque cursor."""
+    payload = json.dumps({"id": item_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """Decode an opaque cursor back into the last seen item ID."""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        item_id = json.loads(payload)["id"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(item_id, int):
+        raise InvalidCursorError(f"Invalid cursor: {cursor}")
+    return item_id
+
+
+def _page_after(sorted_ids: list[int], cursor: str | None, limit: int) -> tuple[list[int], str | None]:
+    """Slice the page of IDs following the cursor out of an ascending ID list."""
+    start = 0 if not cursor else bisect_right(sorted_ids, decode_cursor(cursor))
+    page_ids = sorted_ids[start : start + limit]
+    next_cursor = None
+    if page_ids and start + len(page_ids) < len(sorted_ids):
+        next_cursor = encode_cursor(page_ids[-1])
+    return page_ids, next_cursor
+
+
+class ItemListener(Protocol):
+    """Receives every write applied to an items repository."""
+
+    def items_saved(self, items: list[Item]) -> None: ...
+
+    def items_deleted(self, item_ids: list[int]) -> None: ...
+
+
+class BaseItemRepository(ABC):
+    """Write path and batch operations shared by the item stores."""
+
+    # Batches above this size rebuild the sorted indexes once instead of inserting item by item
+    _BULK_LOAD_THRESHOLD = 256
+
+    def __init__(self):
+        self._listeners: list[ItemListener] = []
+        # JSON encoding of each item served so far, dropped whenever the item is written
+        self._encoded: dict[int, bytes] = {}
+        # Item IDs kept in ascending order for keyset pagination and `sort=id`
+        self._sorted_ids: list[int] = []
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """The number of stored items."""
+
+    @abstractmethod
+    def __contains__(self, item_id: int) -> bool:
+        """Whether an item with this ID is stored."""
+
+    @classmethod
+    def restore(cls, columns: ItemColumns, state: ItemIndexState | None) -> "BaseItemRepository":
+        """Create a repository from snapshot columns, rebuilding the indexes when no state was saved with them."""
+        return cls(columns.to_items())
+
+    def snapshot_state(self) -> Callable[[], tuple[ItemColumns, ItemIndexState]]:
+        """
+        Freeze the store, returning a function that builds its snapshot columns and index state.
+
+        Freezing only copies references; the returned function reads nothing
+        else, so it can run on a background thread while writes continue. It
+        releases the frozen copies as it goes and can only be called once.
+        """
+        items = list(self.iter_items())
+        prices, names = self._sort_index("price").copy_entries(), self._sort_index("name").copy_entries()
+
+        def build() -> tuple[ItemColumns, ItemIndexState]:
+            columns = ItemColumns.from_items(items)
+            clear_in_chunks(items)
+            state = _index_state(columns, prices, names)
+            clear_in_chunks(prices, names)
+            return columns, state
+
+        return build
+
+    @abstractmethod
+    def load_items(self, items: list[Item]) -> None:
+        """Bulk load items without notifying listeners."""
+
+    @abstractmethod
+    def list_items(self, skip: int = 0, limit: int = 10, sort: ItemSort | None = None) -> list[Item]:
+        """List items in insertion order, or in `sort` order, with offset pagination."""
+
+    @abstractmethod
+    def list_items_after(self, cursor: str | None = None, limit: int = 10) -> tuple[list[Item], str | None]:
+        """List items in ascending ID order, resuming after the cursor."""
+
+    @abstractmethod
+    def get_item(self, item_id: int) -> Item | None:
+        """Get an item by its ID, or None if it does not exist."""
+
+    @abstractmethod
+    def search_items(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        fuzzy: bool = False,
+        limit: int | None = None,
+        sort: ItemSort | None = None,
+    ) -> list[Item]:
+        """Search items by text, price range and tags."""
+
+    def encode_search(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        fuzzy: bool = False,
+        limit: int | None = None,
+        sort: ItemSort | None = None,
+    ) -> bytes:
+        """The JSON array of the items `search_items` would return."""
+        return self.encode_items(
+            self.search_items(
+                q=q, min_price=min_price, max_price=max_price, tags=tags, fuzzy=fuzzy, limit=limit, sort=sort
+            )
+        )
+
+    @abstractmethod
+    def facets(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        price_edges: tuple[float, ...] | list[float] = PRICE_BUCKET_EDGES,
+    ) -> ItemFacets:
+        """Tag counts and price buckets of the items `search_items` would return for the same filters."""
+
+    @abstractmethod
+    def _sort_index(self, sort: ItemSort) -> SortIndex:
+        """The index serving a `price` or `name` sort."""
+
+    @abstractmethod
+    def _save_item(self, item: Item) -> None:
+        """Create or replace an item in the store and its indexes."""
+
+    @abstractmethod
+    def _delete_item(self, item_id: int) -> bool:
+        """Delete an item from the store and its indexes. Returns False if it did not exist."""
+
+    def _sorted_page(self, sort: ItemSort, skip: int, limit: int) -> list[int]:
+        """IDs of a page in sort order, sliced straight out of the sort index."""
+        if sort == "id":
+            return self._sorted_ids[skip : skip + limit]
+        return self._sort_index(sort).page(skip, limit, descending=sort.startswith("-"))
+
+    def _sorted_matches(
+        self,
+        sort: ItemSort,
+        matches: Callable[[int], bool],
+        candidates: Callable[[], Iterable[int]],
+        count: int,
+        limit: int | None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+    ) -> list[int]:
+        """Order the `count` IDs accepted by `matches` by a sort index, keeping the first `limit`."""
+        descending = sort.startswith("-")
+        if sort == "id":
+            return _order_ids(
+                lambda: iter(self._sorted_ids), None, descending, matches, candidates, count, len(self), limit
+            )
+
+        index = self._sort_index(sort)
+        # A price walk can start at the bound of the price filter instead of the cheapest item
+        lo, hi = (min_price, max_price) if sort.endswith("price") else (None, None)
+        return _order_ids(
+            lambda: index.iter_ids(descending, lo, hi),
+            index.entry,
+            descending,
+            matches,
+            candidates,
+            count,
+            len(self),
+            limit,
+        )
+
+    def encode_item(self, item: Item) -> bytes:
+        """The JSON encoding of a stored item, cached until the item is next written."""
+        encoded = self._encoded.get(item.id)
+        if encoded is None:
+            encoded = self._encoded[item.id] = item.model_dump_json().encode()
+        return encoded
+
+    def encode_items(self, items: Iterable[Item]) -> bytes:
+        """A JSON array of stored items, joined from their cached encodings."""
+        return b"[" + b",".join(map(self.encode_item, items)) + b"]"
+
+    def _invalidate(self, item_ids: Iterable[int]) -> None:
+        """Drop the cached encodings of items that were written."""
+        for item_id in item_ids:
+            self._encoded.pop(item_id, None)
+
+    def subscribe(self, listener: ItemListener) -> None:
+        """Register a listener notified after every write."""
+        self._listeners.append(listener)
+
+    def iter_items(self) -> Iterator[Item]:
+        """Iterate over all items in insertion order."""
+        yield from self.list_items(0, len(self))
+
+    def save_item(self, item: Item) -> Item:
+        """Create or replace an item."""
+        self._save_item(item)
+        self._invalidate([item.id])
+        for listener in self._listeners:
+            listener.items_saved([item])
+        return item
+
+    def delete_item(self, item_id: int) -> bool:
+        """Delete an item. Returns False if it did not exist."""
+        if not self._delete_item(item_id):
+            return False
+        self._invalidate([item_id])
+        for listener in self._listeners:
+            listener.items_deleted([item_id])
+        return True
+
+    def save_items(self, items: list[Item]) -> list[bool]:
+        """Create or replace a batch of items. Returns whether each one was newly created."""
+        created = []
+        seen: set[int] = set()
+        for item in items:
+            created.append(item.id not in self and item.id not in seen)
+            seen.add(item.id)
+
+        if len(items) > self._BULK_LOAD_THRESHOLD:
+            self.load_items(items)
+        else:
+            for item in items:
+                self._save_item(item)
+        self._invalidate(item.id for item in items)
+        for listener in self._listeners:
+            listener.items_saved(items)
+        return created
+
+    def delete_items(self, item_ids: list[int]) -> list[bool]:
+        """Delete a batch of items. Returns whether each one existed."""
+        deleted = [self._delete_item(item_id) for item_id in item_ids]
+        deleted_ids = [item_id for item_id, existed in zip(item_ids, deleted) if existed]
+        if deleted_ids:
+            self._invalidate(deleted_ids)
+            for listener in self._listeners:
+                listener.items_deleted(deleted_ids)
+        return deleted
+
+
+class ItemRepository(BaseItemRepository):
+    """Repository for the in-memory items store and its search index."""
+
+    def __init__(self, items: list[Item] | None = None):
+        super().__init__()
+        self.items: dict[int, Item] = {}
+        self.index = ItemSearchIndex()
+        # Insertion sequence of each item, mirroring the ordering of the items dict
+        self._sequence: dict[int, int] = {}
+        self._next_sequence = 0
+        if items:
+            self.load_items(items)
+
+    @classmethod
+    def restore(cls, columns: ItemColumns, state: ItemIndexState | None) -> "ItemRepository":
+        if state is None:
+            return cls(columns.to_items())
+        repository = cls()
+        ids = columns.ids.tolist()
+        repository.items = dict(zip(ids, columns.to_items()))
+        repository._sequence = dict(zip(ids, range(len(ids))))
+        repository._next_sequence = len(ids)
+        repository._sorted_ids = sorted(ids)
+        repository.index.restore(columns, state)
+        return repository
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self.items
+
+    def iter_items(self) -> Iterator[Item]:
+        return iter(self.items.values())
+
+    def load_items(self, items: list[Item]) -> None:
+        """Bulk load items, building the sorted indexes once instead of per item."""
+        for item in items:
+            if item.id not in self._sequence:
+                self._sequence[item.id] = self._next_sequence
+                self._next_sequence += 1
+            self.items[item.id] = item
+        self.index.add_many(items)
+        self._sorted_ids = sorted(self.items)
+
+    def list_items(self, skip: int = 0, limit: int = 10, sort: ItemSort | None = None) -> list[Item]:
+        """List items in insertion order, or in `sort` order, with offset pagination."""
+        skip, limit = max(skip, 0), max(limit, 0)
+        if sort is not None:
+            return [self.items[item_id] for item_id in self._sorted_page(sort, skip, limit)]
+        return list(islice(self.items.values(), skip, skip + limit))
+
+    def _sort_index(self, sort: ItemSort) -> SortIndex:
+        return self.index.names if sort == "name" else self.index.prices
+
+    def list_items_after(self, cursor: str | None = None, limit: int = 10) -> tuple[list[Item], str | None]:
+        """
+        List items in ascending ID order, resuming after the cursor.
+
+        Returns the page and the cursor of the next page, or None on the last page.
+        """
+        page_ids, next_cursor = _page_after(self._sorted_ids, cursor, limit)
+        return [self.items[item_id] for item_id in page_ids], next_cursor
+
+    def get_item(self, item_id: int) -> Item | None:
+        """Get an item by its ID, or None if it does not exist."""
+        return self.items.get(item_id)
+
+    def _save_item(self, item: Item) -> None:
+        if item.id not in self._sequence:
+            self._sequence[item.id] = self._next_sequence
+            self._next_sequence += 1
+            insort(self._sorted_ids, item.id)
+        self.items[item.id] = item
+        self.index.add(item)
+
+    def _delete_item(self, item_id: int) -> bool:
+        if self.items.pop(item_id, None) is None:
+            return False
+        del self._sequence[item_id]
+        del self._sorted_ids[bisect_left(self._sorted_ids, item_id)]
+        self.index.remove(item_id)
+        return True
+
+    def search_items(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        fuzzy: bool = False,
+        limit: int | None = None,
+        sort: ItemSort | None = None,
+    ) -> list[Item]:
+        """
+        Search items, preserving the insertion order of the store.
+
+        With `fuzzy`, `q` matches by trigram similarity instead of as a
+        substring, and results are ranked from the most similar. With `sort`,
+        results are ordered by that field instead.
+        """
+        if fuzzy and q:
+            levels = self.index.text.fuzzy_levels(q.lower())
+            candidates = self.index.search(min_price=min_price, max_price=max_price, tags=tags)
+            if sort is not None:
+                matched = _fuzzy_matches(levels, candidates)
+                ordered_ids = self._sorted_matches(
+                    sort, matched.__contains__, lambda: matched, len(matched), limit, min_price, max_price
+                )
+                return [self.items[item_id] for item_id in ordered_ids]
+            ranked = _fuzzy_ranking(
+                levels, limit, self._sequence.__getitem__, self.items.__iter__, len(self.items), candidates
+            )
+            return [self.items[item_id] for item_id in ranked]
+
+        if sort is not None:
+            # Test the filters lazily while walking the sort index rather than intersecting them upfront
+            match = self.index.match(q=q, min_price=min_price, max_price=max_price, tags=tags)
+            filtered, candidates, count = match or (None, self.items.__iter__, len(self.items))
+            text = q.lower() if q else None
+
+            def matches(item_id: int) -> bool:
+                if filtered is not None and not filtered(item_id):
+                    return False
+                if not text:
+                    return True
+                item = self.items[item_id]
+                return _matches_text(text, item.name, item.description)
+
+            ordered_ids = self._sorted_matches(sort, matches, candidates, count, limit, min_price, max_price)
+            return [self.items[item_id] for item_id in ordered_ids]
+
+        candidates = self.index.search(q=q, min_price=min_price, max_price=max_price, tags=tags)
+        if candidates is None:
+            results = list(self.items.values())
+        else:
+            ordered_ids = sorted(candidates, key=self._sequence.__getitem__)
+            results = [self.items[item_id] for item_id in ordered_ids]
+
+        if q:
+            q = q.lower()
+            results = [item for item in results if _matches_text(q, item.name, item.description)]
+        return results[:limit]
+
+    def facets(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        price_edges: tuple[float, ...] | list[float] = PRICE_BUCKET_EDGES,
+    ) -> ItemFacets:
+        """Tag counts and price buckets of the items `search_items` would return for the same filters."""
+        _check_price_edges(price_edges)
+        candidates = self.index.search(q=q, min_price=min_price, max_price=max_price, tags=tags)
+        if q:
+            q = q.lower()
+            matched = set()
+            for item_id in self.items if candidates is None else candidates:
+                item = self.items[item_id]
+                if _matches_text(q, item.name, item.description):
+                    matched.add(item_id)
+            candidates = matched
+        return self.index.facets(candidates, price_edges)
+
+
+class ColumnarItemRepository(BaseItemRepository):
+    """
+    Columnar items store backed by NumPy arrays.
+
+    IDs and prices live in NumPy columns and tag membership in one boolean
+    column per tag, so price and tag filters run as vectorised masks. Deleted
+    rows are tombstoned and compacted lazily, which keeps rows in insertion
+    order. Pydantic `Item`s are only built for the rows that are returned.
+    """
+
+    _INITIAL_CAPACITY = 1024
+
+    def __init__(self, items: list[Item] | None = None):
+        super().__init__()
+        self._size = 0
+        self._deleted = 0
+        self._ids = np.zeros(self._INITIAL_CAPACITY, dtype=np.int64)
+        self._prices = np.zeros(self._INITIAL_CAPACITY, dtype=np.float64)
+        self._alive = np.zeros(self._INITIAL_CAPACITY, dtype=bool)
+        self._tag_columns: dict[str, np.ndarray] = {}
+        self._tag_counts: dict[str, int] = {}
+        self._names: list[str] = []
+        self._descriptions: list[str | None] = []
+        self._tags: list[list[str]] = []
+        self._rows: dict[int, int] = {}
+        self.text = TextIndex()
+        self.prices = SortIndex()
+        self.names = SortIndex()
+        if items:
+            self.load_items(items)
+
+    @classmethod
+    def restore(cls, columns: ItemColumns, state: ItemIndexState | None) -> "ColumnarItemRepository":
+        if state is None:
+            return cls(columns.to_items())
+        repository = cls()
+        size = len(columns)
+        capacity = max(size, cls._INITIAL_CAPACITY)
+        repository._ids = np.zeros(capacity, dtype=np.int64)
+        repository._prices = np.zeros(capacity, dtype=np.float64)
+        repository._alive = np.zeros(capacity, dtype=bool)
+        repository._ids[:size] = columns.ids
+        repository._prices[:size] = columns.prices
+        repository._alive[:size] = True
+        repository._size = size
+        repository._names = columns.names
+        repository._descriptions = columns.descriptions
+        repository._tags = columns.tags
+
+        offsets = state.tag_offsets.tolist()
+        for tag, start, end in zip(state.tags, offsets, offsets[1:]):
+            column = repository._tag_columns[tag] = np.zeros(capacity, dtype=bool)
+            column[state.tag_rows[start:end]] = True
+            repository._tag_counts[tag] = end - start
+
+        ids = columns.ids.tolist()
+        repository._rows = dict(zip(ids, range(size)))
+        repository._sorted_ids = sorted(ids)
+        repository.text.restore(state, ids)
+        _restore_sort_indexes(repository.prices, repository.names, columns, state)
+        return repository
+
+    def snapshot_state(self) -> Callable[[], tuple[ItemColumns, ItemIndexState]]:
+        size = self._size
+        alive = self._alive[:size].copy()
+        ids, prices = self._ids[:size].copy(), self._prices[:size].copy()
+        # Rows of the string columns are replaced on write, never mutated, so copying the lists is enough
+        names, descriptions, tags = self._names[:size], self._descriptions[:size], self._tags[:size]
+        price_entries, name_entries = self.prices.copy_entries(), self.names.copy_entries()
+
+        def build() -> tuple[ItemColumns, ItemIndexState]:
+            rows = np.flatnonzero(alive)
+            columns = ItemColumns(
+                ids=ids[rows],
+                prices=prices[rows],
+                names=[names[row] for row in _ints(rows)],
+                descriptions=[descriptions[row] for row in _ints(rows)],
+                tags=[tags[row] for row in _ints(rows)],
+            )
+            clear_in_chunks(names, descriptions, tags)
+            state = _index_state(columns, price_entries, name_entries)
+            clear_in_chunks(price_entries, name_entries)
+            return columns, state
+
+        return build
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._rows
+
+    def load_items(self, items: list[Item]) -> None:
+        """Bulk load items, sorting the ID list and sort indexes once instead of per item."""
+        for item in items:
+            self._write(item)
+        self._sorted_ids = sorted(self._rows)
+        self.prices.add_many((item.id, item.price) for item in items)
+        self.names.add_many((item.id, item.name.lower()) for item in items)
+
+    def _item(self, row: int) -> Item:
+        # Values were validated on write, so skip re-validation when materialising rows
+        return Item.model_construct(
+            id=int(self._ids[row]),
+            name=self._names[row],
+            description=self._descriptions[row],
+            price=float(self._prices[row]),
+            tags=list(self._tags[row]),
+        )
+
+    def _grow(self) -> None:
+        capacity = len(self._ids) * 2
+
+        def resize(column: np.ndarray) -> np.ndarray:
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[: len(column)] = column
+            return grown
+
+        self._ids = resize(self._ids)
+        self._prices = resize(self._prices)
+        self._alive = resize(self._alive)
+        self._tag_columns = {tag: resize(column) for tag, column in self._tag_columns.items()}
+
+    def _compact(self) -> None:
+        """Drop tombstoned rows, preserving the order of the live ones."""
+        keep = np.flatnonzero(self._alive[: self._size])
+        size = len(keep)
+        for column in [self._ids, self._prices, self._alive, *self._tag_columns.values()]:
+            column[:size] = column[keep]
+            column[size : self._size] = 0
+        self._names = [self._names[row] for row in keep]
+        self._descriptions = [self._descriptions[row] for row in keep]
+        self._tags = [self._tags[row] for row in keep]
+        self._rows = {int(item_id): row for row, item_id in enumerate(self._ids[:size])}
+        self._size = size
+        self._deleted = 0
+
+    def _set_tags(self, row: int, tags: list[str], present: bool) -> None:
+        for tag in set(tags):
+            column = self._tag_columns.get(tag)
+            if column is None:
+                column = self._tag_columns[tag] = np.zeros(len(self._ids), dtype=bool)
+                self._tag_counts[tag] = 0
+            column[row] = present
+            self._tag_counts[tag] += 1 if present else -1
+            if not self._tag_counts[tag]:
+                del self._tag_columns[tag], self._tag_counts[tag]
+
+    def list_items(self, skip: int = 0, limit: int = 10, sort: ItemSort | None = None) -> list[Item]:
+        """List items in insertion order, or in `sort` order, with offset pagination."""
+        # A negative start would reach the unused slots at the end of the columns
+        skip, limit = max(skip, 0), max(limit, 0)
+        if sort is not None:
+            return [self._item(self._rows[item_id]) for item_id in self._sorted_page(sort, skip, limit)]
+        if self._deleted:
+            rows = np.flatnonzero(self._alive[: self._size])[skip : skip + limit]
+        else:
+            rows = range(min(skip, self._size), min(skip + limit, self._size))
+        return [self._item(row) for row in rows]
+
+    def list_items_after(self, cursor: str | None = None, limit: int = 10) -> tuple[list[Item], str | None]:
+        """
+        List items in ascending ID order, resuming after the cursor.
+
+        Returns the page and the cursor of the next page, or None on the last page.
+        """
+        page_ids, next_cursor = _page_after(self._sorted_ids, cursor, limit)
+        return [self._item(self._rows[item_id]) for item_id in page_ids], next_cursor
+
+    def get_item(self, item_id: int) -> Item | None:
+        """Get an item by its ID, or None if it does not exist."""
+        row = self._rows.get(item_id)
+        return None if row is None else self._item(row)
+
+    def _sort_index(self, sort: ItemSort) -> SortIndex:
+        return self.names if sort == "name" else self.prices
+
+    def _save_item(self, item: Item) -> None:
+        if self._write(item):
+            insort(self._sorted_ids, item.id)
+        self.prices.add(item.id, item.price)
+        self.names.add(item.id, item.name.lower())
+
+    def _write(self, item: Item) -> bool:
+        """Write an item into its row. Returns True if a new row was appended."""
+        row = self._rows.get(item.id)
+        created = row is None
+        if created:
+            if self._size == len(self._ids):
+                self._grow()
+            row = self._size
+            self._size += 1
+            self._names.append(item.name)
+            self._descriptions.append(item.description)
+            self._tags.append(list(item.tags))
+            self._rows[item.id] = row
+        else:
+            self._set_tags(row, self._tags[row], present=False)
+            self._names[row] = item.name
+            self._descriptions[row] = item.description
+            self._tags[row] = list(item.tags)
+
+        self._ids[row] = item.id
+        self._prices[row] = item.price
+        self._alive[row] = True
+        self._set_tags(row, item.tags, present=True)
+        self.text.add(item.id, item.name, item.description)
+        return created
+
+    def _delete_item(self, item_id: int) -> bool:
+        row = self._rows.pop(item_id, None)
+        if row is None:
+            return False
+        self._alive[row] = False
+        self._set_tags(row, self._tags[row], present=False)
+        self._names[row], self._descriptions[row], self._tags[row] = "", None, []
+        self.text.remove(item_id)
+        del self._sorted_ids[bisect_left(self._sorted_ids, item_id)]
+        self.prices.remove(item_id)
+        self.names.remove(item_id)
+
+        self._deleted += 1
+        if self._deleted > self._INITIAL_CAPACITY and self._deleted * 2 > self._size:
+            self._compact()
+        return True
+
+    def search_items(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        fuzzy: bool = False,
+        limit: int | None = None,
+        sort: ItemSort | None = None,
+    ) -> list[Item]:
+        """
+        Search items with vectorised price and tag masks, in insertion order.
+
+        With `fuzzy`, `q` matches by trigram similarity instead of as a
+        substring, and results are ranked from the most similar. With `sort`,
+        results are ordered by that field instead.
+        """
+        return [self._item(row) for row in self._search_rows(q, min_price, max_price, tags, fuzzy, limit, sort)]
+
+    def encode_search(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        fuzzy: bool = False,
+        limit: int | None = None,
+        sort: ItemSort | None = None,
+    ) -> bytes:
+        """
+        The JSON array of the items `search_items` would return.
+
+        Rows are encoded from their cached encodings, so an `Item` is only
+        built for rows that have not been served since they were last written.
+        """
+        encoded = self._encoded
+        ids = self._ids
+        return (
+            b"["
+            + b",".join(
+                encoded.get(int(ids[row])) or self.encode_item(self._item(row))
+                for row in self._search_rows(q, min_price, max_price, tags, fuzzy, limit, sort)
+            )
+            + b"]"
+        )
+
+    def _search_rows(
+        self,
+        q: str | None,
+        min_price: float | None,
+        max_price: float | None,
+        tags: list[str] | None,
+        fuzzy: bool,
+        limit: int | None,
+        sort: ItemSort | None,
+    ) -> list[int]:
+        """Rows of the items `search_items` returns, in result order and cut to `limit`."""
+        mask = self._filter_mask(min_price, max_price, tags)
+        if fuzzy and q:
+            candidates = None if mask is None else set(self._ids[np.flatnonzero(mask)].tolist())
+            if sort is not None:
+                matched = _fuzzy_matches(self.text.fuzzy_levels(q.lower()), candidates)
+                ordered_ids = self._sorted_matches(
+                    sort, matched.__contains__, lambda: matched, len(matched), limit, min_price, max_price
+                )
+                return [self._rows[item_id] for item_id in ordered_ids]
+            ranked = _fuzzy_ranking(
+                self.text.fuzzy_levels(q.lower()),
+                limit,
+                self._rows.__getitem__,
+                self._rows.__iter__,
+                len(self._rows),
+                candidates,
+            )
+            return [self._rows[item_id] for item_id in ranked]
+
+        rows = self._matching_rows(q, mask)
+        if sort is not None:
+            selected = np.zeros(self._size, dtype=bool)
+            selected[rows] = True
+            ordered_ids = self._sorted_matches(
+                sort,
+                lambda item_id: selected[self._rows[item_id]],
+                lambda: self._ids[rows].tolist(),
+                len(rows),
+                limit,
+                min_price,
+                max_price,
+            )
+            return [self._rows[item_id] for item_id in ordered_ids]
+        return rows[:limit].tolist()
+
+    def _filter_mask(
+        self, min_price: float | None, max_price: float | None, tags: list[str] | None
+    ) -> np.ndarray | None:
+        """Boolean mask of the live rows passing the price and tag filters, or None without filters."""
+        if min_price is None and max_price is None and not tags:
+            return None
+        size = self._size
+        mask = self._alive[:size].copy()
+        if min_price is not None:
+            mask &= self._prices[:size] >= min_price
+        if max_price is not None:
+            mask &= self._prices[:size] <= max_price
+        for tag in set(tags or []):
+            column = self._tag_columns.get(tag)
+            if column is None:
+                return np.zeros(size, dtype=bool)
+            mask &= column[:size]
+        return mask
+
+    def _matching_rows(self, q: str | None, mask: np.ndarray | None) -> np.ndarray:
+        """Rows matching the substring query within the mask, in insertion order."""
+        candidates = self.text.candidates(q.lower()) if q else None
+        if candidates is not None:
+            rows = np.sort(np.fromiter((self._rows[item_id] for item_id in candidates), dtype=np.int64))
+            if mask is not None:
+                rows = rows[mask[rows]]
+        elif mask is not None:
+            rows = np.flatnonzero(mask)
+        else:
+            rows = np.flatnonzero(self._alive[: self._size])
+
+        if q:
+            q = q.lower()
+            rows = np.fromiter(
+                (row for row in rows if _matches_text(q, self._names[row], self._descriptions[row])), dtype=np.int64
+            )
+        return rows
+
+    def facets(
+        self,
+        q: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        tags: list[str] | None = None,
+        price_edges: tuple[float, ...] | list[float] = PRICE_BUCKET_EDGES,
+    ) -> ItemFacets:
+        """
+        Tag counts and price buckets of the items `search_items` would return for the same filters.
+
+        Unfiltered facets come from the tag counts and the sorted price index
+        kept up to date on every write; filtered ones intersect the row mask
+        with each tag column.
+        """
+        _check_price_edges(price_edges)
+        mask = self._filter_mask(min_price, max_price, tags)
+        if mask is None and not q:
+            return _item_facets(len(self), self._tag_counts, price_edges, self.prices.histogram(price_edges))
+
+        if q:
+            rows = self._matching_rows(q, mask)
+            mask = np.zeros(self._size, dtype=bool)
+            mask[rows] = True
+        size = self._size
+        tag_counts = {tag: int(np.count_nonzero(column[:size] & mask)) for tag, column in self._tag_columns.items()}
+        buckets = np.searchsorted(np.asarray(price_edges), self._prices[:size][mask], side="right") - 1
+        bucket_counts = np.bincount(np.compress(buckets >= 0, buckets), minlength=len(price_edges))
+        return _item_facets(int(np.count_nonzero(mask)), tag_counts, price_edges, bucket_counts)
+
+
+def get_item_repository(items: list[Item] | None = None) -> BaseItemRepository:
+    """
+    Create the items repository selected by the `ITEMS_STORE` setting.
+
+    When `ITEMS_DATA_DIR` is set, the store and its search index are restored
+    from the snapshot and operation log, or seeded with `items` on first start,
+    and every write is persisted from then on. The `shared` store is backed by
+    its own file and is seeded only by the first worker to open it.
+    """
+    settings = get_items_settings()
+    if settings.items_store == "shared":
+        # fcntl is POSIX-only, so import the shared store only when it is selected
+        from template_fastapi.repositories.item_shared_memory import SharedItemRepository
+
+        return SharedItemRepository(settings.items_shared_path, items)
+
+    repository_class = ColumnarItemRepository if settings.items_store == "columnar" else ItemRepository
+    if not settings.items_data_dir:
+        return repository_class(items)
+
+    storage = ItemStorage(
+        settings.items_data_dir,
+        snapshot_interval=settings.items_snapshot_interval,
+        fsync=settings.items_log_fsync,
+    )
+    # Loading builds millions of long-lived objects; collecting them midway only costs time
+    gc.disable()
+    try:
+        seeded = not storage.exists()
+        repository = repository_class(items) if seeded else storage.restore(repository_class)
+    finally:
+        gc.enable()
+    storage.attach(repository)
+    if seeded:
+        storage.checkpoint(wait=True)
+    return repository
 
-# In-memory database for items
-items_db: dict[int, Item] = {}
 
 # Sample data initialization
 sample_items = [
@@ -12,6 +1554,9 @@ sample_items = [
     Item(id=5, name="Drill", description="A tool for drilling holes", price=49.99, tags=["tool", "hardware", "power"]),
 ]
 
-# Initialize database with sample data
-for item in sample_items:
-    items_db[item.id] = item
+# Initialize the in-memory database with sample data
+item_repo = get_item_repository(sample_items)
+
+# Recent changes of the items store, published on every write
+item_changes = ItemChangeFeed(get_items_settings().items_change_feed_size)
+item_repo.subscribe(item_changes)
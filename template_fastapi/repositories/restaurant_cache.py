@@ -0,0 +1,265 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Hashable
+from concurrent.futures import Future
+from typing import Any, TypeVar
+
+from template_fastapi.opentelemetry import get_meter
+
+meter = get_meter(__name__)
+
+lookup_counter = meter.create_counter(
+    "restaurants.cache.lookups",
+    description="The number of restaurant result cache lookups by result (hit, miss or coalesced)",
+)
+item_read_counter = meter.create_counter(
+    "restaurants.item_cache.reads",
+    description="The number of restaurant reads by ID by result (fresh, revalidated or fetched)",
+)
+
+T = TypeVar("T")
+
+
+def normalize_query(query: str) -> str:
+    """検索テキストの前後の空白を除き、連続する空白を1つにまとめる"""
+    return " ".join(query.split())
+
+
+class RestaurantResultCache:
+    """
+    レストランの検索結果を保持するTTL付きのLRUキャッシュ
+
+    同じキーの計算が進行中なら、後から来た呼び出しはその結果を待って共有する
+    （シングルフライト）ため、キャッシュが切れた瞬間に同じ検索が殺到しても
+    Azure OpenAIとCosmosDBへの問い合わせは1回で済む。`invalidate`は保持している
+    結果を捨て、その時点で進行中の計算の結果も保存しない。他のワーカーやプロセスの
+    書き込みでは無効化されないため、古い結果が返る期間は最大でTTLになる。
+    返す結果は呼び出し間で共有されるので、変更してはならない。
+    """
+
+    def __init__(self, ttl: float = 30.0, max_size: int = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, Future] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], T]) -> T:
+        """キャッシュ済みの結果を返し、なければ`compute`で計算して保存する"""
+        if not self.enabled:
+            return compute()
+        state, value = self._begin(key)
+        if state == "hit":
+            return value
+        if state == "coalesced":
+            return value.result()
+        try:
+            result = compute()
+        except BaseException as e:
+            self._finish(key, *value, error=e)
+            raise
+        self._finish(key, *value, result=result)
+        return result
+
+    async def aget_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[T]]) -> T:
+        """`get_or_compute`のイベントループ版"""
+        if not self.enabled:
+            return await compute()
+        state, value = self._begin(key)
+        if state == "hit":
+            return value
+        if state == "coalesced":
+            return await asyncio.wrap_future(value)
+        try:
+            result = await compute()
+        except BaseException as e:
+            self._finish(key, *value, error=e)
+            raise
+        self._finish(key, *value, result=result)
+        return result
+
+    def invalidate(self) -> None:
+        """保持している結果をすべて捨てる（書き込みの後に呼ぶ）"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            # 進行中の計算は書き込み前のデータを読んでいる可能性があるため、以降の呼び出しには共有しない
+            self._inflight.clear()
+
+    def _begin(self, key: Hashable) -> tuple[str, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._record("hit")
+                    return "hit", entry[1]
+                del self._entries[key]
+
+            future = self._inflight.get(key)
+            if future is not None:
+                self._record("coalesced")
+                return "coalesced", future
+
+            future = Future()
+            self._inflight[key] = future
+            self._record("miss")
+            return "miss", (future, self._generation)
+
+    def _finish(
+        self, key: Hashable, future: Future, generation: int, result: Any = None, error: BaseException | None = None
+    ) -> None:
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if error is None and generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def _record(self, result: str) -> None:
+        if result == "hit":
+            self.hits += 1
+        elif result == "miss":
+            self.misses += 1
+        else:
+            self.coalesced += 1
+        lookup_counter.add(1, {"result": result})
+
+
+class RestaurantItemCache:
+    """
+    IDで読み出したレストランを、アイテムのETagとともに保持するLRUキャッシュ
+
+    読み出してから`fresh_for`秒の間はメモリから返す。それ以降はETagを付けた条件付き読み出し
+    （If-None-Match）で再検証し、変更がなければ（304 Not Modified）本文を受け取らずに
+    キャッシュを使い続ける。このリポジトリ経由の書き込みは`invalidate`でエントリを捨てる。
+    他のワーカーやプロセスの書き込みが反映されるまでの期間は最大で`fresh_for`秒になる。
+    返すレストランは呼び出し間で共有されるので、変更してはならない。
+    """
+
+    def __init__(self, fresh_for: float = 5.0, max_size: int = 4096):
+        self.fresh_for = fresh_for
+        self.max_size = max_size
+        self.fresh = 0
+        self.revalidated = 0
+        self.fetched = 0
+        # ID -> (新鮮な期限, ETag, レストラン)
+        self._entries: OrderedDict[str, tuple[float, str | None, Any]] = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, restaurant_id: str, read: Callable[[str | None], tuple[str | None, T] | None]) -> T:
+        """
+        キャッシュ済みのレストランを返し、新鮮でなければ`read`で読み出す
+
+        `read`はキャッシュ済みのETag（なければNone）を受け取り、アイテムのETagとレストランを返す。
+        ETagが一致して本文のない応答の場合はNoneを返す。その応答を受け取るまでにエントリが
+        捨てられていれば、ETagを付けずに読み直す
+        """
+        if not self.enabled:
+            return _required(read(None))[1]
+        state, entry, generation = self._begin(restaurant_id)
+        if state == "fresh":
+            return entry[2]
+        etag = entry[1] if entry is not None else None
+        result = self._revalidate(restaurant_id, etag, read(etag))
+        if result is None:
+            self._record("fetched")
+            result = _required(read(None))
+        return self._finish(restaurant_id, generation, result)
+
+    async def aget(self, restaurant_id: str, read: Callable[[str | None], Awaitable[tuple[str | None, T] | None]]) -> T:
+        """`get`のイベントループ版"""
+        if not self.enabled:
+            return _required(await read(None))[1]
+        state, entry, generation = self._begin(restaurant_id)
+        if state == "fresh":
+            return entry[2]
+        etag = entry[1] if entry is not None else None
+        result = self._revalidate(restaurant_id, etag, await read(etag))
+        if result is None:
+            self._record("fetched")
+            result = _required(await read(None))
+        return self._finish(restaurant_id, generation, result)
+
+    def invalidate(self, restaurant_id: str) -> None:
+        """レストランのエントリを捨てる（書き込み・削除の後に呼ぶ）"""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(restaurant_id, None)
+
+    def _begin(self, restaurant_id: str) -> tuple[str, tuple[float, str | None, Any] | None, int]:
+        with self._lock:
+            entry = self._entries.get(restaurant_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(restaurant_id)
+                self._record("fresh")
+                return "fresh", entry, self._generation
+            return "stale", entry, self._generation
+
+    def _revalidate(
+        self, restaurant_id: str, etag: str | None, result: tuple[str | None, Any] | None
+    ) -> tuple[str | None, Any] | None:
+        if result is not None:
+            self._record("fetched")
+            return result
+        # 304 Not Modified: キャッシュ済みのレストランをもう一度新鮮なものとして扱う
+        with self._lock:
+            entry = self._entries.get(restaurant_id)
+        if entry is None or entry[1] != etag:
+            # 読み出している間にエントリが捨てられた（または置き換えられた）
+            return None
+        self._record("revalidated")
+        return entry[1:]
+
+    def _finish(self, restaurant_id: str, generation: int, result: tuple[str | None, Any]) -> Any:
+        with self._lock:
+            # 読み出している間に書き込まれていれば、書き込み前のアイテムかもしれないので保存しない
+            if generation == self._generation:
+                self._entries[restaurant_id] = (time.monotonic() + self.fresh_for, *result)
+                self._entries.move_to_end(restaurant_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return result[1]
+
+    def _record(self, result: str) -> None:
+        if result == "fresh":
+            self.fresh += 1
+        elif result == "revalidated":
+            self.revalidated += 1
+        else:
+            self.fetched += 1
+        item_read_counter.add(1, {"result": result})
+
+
+def _required(result: tuple[str | None, T] | None) -> tuple[str | None, T]:
+    """ETagを付けない読み出しの結果（本文のない応答は返らないはず）"""
+    if result is None:
+        raise ValueError("A read without an ETag returned no restaurant")
+    return result
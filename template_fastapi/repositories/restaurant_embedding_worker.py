@@ -0,0 +1,140 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+from template_fastapi.opentelemetry import get_meter
+from template_fastapi.settings.logging import get_logger
+
+logger = get_logger(__name__)
+meter = get_meter(__name__)
+
+queue_depth = meter.create_up_down_counter(
+    "restaurants.embedding.queue_depth",
+    description="The number of restaurants waiting for their write-behind embedding",
+)
+job_counter = meter.create_counter(
+    "restaurants.embedding.jobs",
+    description="Write-behind embedding jobs by result (embedded, superseded, rejected, retried or failed)",
+)
+
+
+@dataclass(frozen=True)
+class EmbeddingJob:
+    """ベクトルの書き込みを待つレストランと、埋め込むテキスト・そのハッシュ"""
+
+    restaurant_id: str
+    text: str
+    content_hash: str
+
+
+class EmbeddingWriteBehind:
+    """
+    レストランのベクトル埋め込みを書き込みの後にバックグラウンドで生成するワーカープール
+
+    `vector_status: pending`で書き込まれたレストランをキューで受け取り、`workers`個のタスクが
+    最大`batch_size`件ずつまとめて`embed`で埋め込み、`apply`でCosmosDBのアイテムにパッチする。
+    `apply`はアイテムのテキストが変わっていればFalseを返し、その結果は新しいジョブに任せる。
+    失敗したジョブは指数的に間隔を空けて最大`max_retries`回まで再試行し、それでも失敗したものは
+    pendingのまま残す（`reembed`ジョブが埋め込み直す）。プロセスの終了時に残ったジョブも同様。
+    `apply`がValueErrorを送出したジョブ（検証エラー）は再試行しても成功しないため、すぐに捨てる。
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[list[str]], Awaitable[list[list[float]]]],
+        apply: Callable[[EmbeddingJob, list[float]], Awaitable[bool]],
+        workers: int = 2,
+        batch_size: int = 16,
+        max_retries: int = 5,
+        retry_backoff: float = 0.5,
+    ):
+        self.embed = embed
+        self.apply = apply
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._queue: asyncio.Queue[EmbeddingJob] | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        """埋め込みを待っているジョブの数"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def enqueue(self, job: EmbeddingJob) -> None:
+        """ジョブをキューに積む（初回はイベントループ上でワーカーを起動する）"""
+        if not self._tasks:
+            self._queue = asyncio.Queue()
+            self._tasks = [
+                asyncio.create_task(self._work(), name=f"restaurant-embedding-{i}") for i in range(self.workers)
+            ]
+        self._queue.put_nowait(job)
+        queue_depth.add(1)
+
+    async def join(self) -> None:
+        """キューに積まれたジョブがすべて終わるまで待つ"""
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """最大`timeout`秒までキューを処理してからワーカーを停止する（残ったジョブはpendingのまま）"""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping embedding workers with {self.depth} restaurants still pending")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        queue_depth.add(-self.depth)
+        self._tasks, self._queue = [], None
+
+    async def _work(self) -> None:
+        while True:
+            jobs = [await self._queue.get()]
+            while len(jobs) < self.batch_size and not self._queue.empty():
+                jobs.append(self._queue.get_nowait())
+            queue_depth.add(-len(jobs))
+            try:
+                await self._process(jobs)
+            except Exception as e:
+                logger.exception(f"Embedding worker failed on {len(jobs)} restaurants: {e}")
+            finally:
+                for _ in jobs:
+                    self._queue.task_done()
+
+    async def _process(self, jobs: list[EmbeddingJob]) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                vectors = await self.embed([job.text for job in jobs])
+                outcomes = await asyncio.gather(
+                    *(self.apply(job, vector) for job, vector in zip(jobs, vectors)), return_exceptions=True
+                )
+            except Exception as e:
+                error, failed = e, jobs
+            else:
+                failed, error = [], None
+                for job, outcome in zip(jobs, outcomes):
+                    if isinstance(outcome, ValueError):
+                        # 検証エラーは再試行しても変わらないため、再試行せずに捨てる
+                        job_counter.add(1, {"result": "rejected"})
+                        logger.error(f"Dropped the embedding of restaurant {job.restaurant_id}: {outcome}")
+                    elif isinstance(outcome, BaseException):
+                        failed.append(job)
+                        error = error or outcome
+                    else:
+                        job_counter.add(1, {"result": "embedded" if outcome else "superseded"})
+            if not failed:
+                return
+            jobs = failed
+            if attempt < self.max_retries:
+                job_counter.add(len(jobs), {"result": "retried"})
+                logger.warning(f"Retrying the embedding of {len(jobs)} restaurants after: {error}")
+                await asyncio.sleep(self.retry_backoff * 2**attempt)
+
+        job_counter.add(len(jobs), {"result": "failed"})
+        logger.error(
+            f"Gave up embedding {len(jobs)} restaurants after {self.max_retries} retries; they stay pending: {error}"
+        )
@@ -0,0 +1,170 @@
+import math
+import threading
+from itertools import chain
+
+import numpy as np
+
+from template_fastapi.models.restaurant import Restaurant
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def haversine_km(latitude: float, longitude: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """1地点から複数地点までの大圏距離（キロメートル）をまとめて計算する"""
+    lat1 = math.radians(latitude)
+    lat2 = np.radians(latitudes)
+    sin_dlat = np.sin((lat2 - lat1) / 2)
+    sin_dlon = np.sin((np.radians(longitudes) - math.radians(longitude)) / 2)
+    a = sin_dlat**2 + math.cos(lat1) * np.cos(lat2) * sin_dlon**2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def bounding_box(latitude: float, longitude: float, distance_km: float) -> tuple[float, float, float, float]:
+    """
+    中心から`distance_km`以内の地点をすべて含む緯度経度の範囲（最小緯度, 最大緯度, 最小経度, 最大経度）を返す
+
+    極や日付変更線をまたぐ場合は経度の範囲を全周にする
+    """
+    delta_latitude = distance_km / KM_PER_DEGREE
+    min_latitude, max_latitude = latitude - delta_latitude, latitude + delta_latitude
+    if min_latitude <= -90 or max_latitude >= 90:
+        return max(min_latitude, -90.0), min(max_latitude, 90.0), -180.0, 180.0
+    # 範囲内で経度1度あたりの距離が最も短くなる、極に近い側の緯度で幅を求める
+    delta_longitude = delta_latitude / math.cos(math.radians(max(abs(min_latitude), abs(max_latitude))))
+    min_longitude, max_longitude = longitude - delta_longitude, longitude + delta_longitude
+    if min_longitude < -180 or max_longitude > 180:
+        return min_latitude, max_latitude, -180.0, 180.0
+    return min_latitude, max_latitude, min_longitude, max_longitude
+
+
+class RestaurantGeoIndex:
+    """
+    レストランの位置をプロセス内の格子で索引付けする地理空間インデックス
+
+    緯度経度を`cell_km`四方程度のセルに分け、検索範囲を覆うセルの候補だけについて
+    haversine距離をNumPyでまとめて計算し、距離の近い順に返す。位置情報のない
+    レストランは索引付けしない。`RestaurantVectorIndex`と同様に、他のワーカーや
+    プロセスによる書き込みは再読み込みするまで反映されない。
+    """
+
+    def __init__(self, cell_km: float = 5.0):
+        self.loaded = False
+        self.cell_degrees = cell_km / KM_PER_DEGREE
+        self._restaurants: list[Restaurant] = []
+        self._latitudes = np.empty(0)
+        self._longitudes = np.empty(0)
+        self._rows: dict[str, int] = {}
+        self._cells: dict[tuple[int, int], set[int]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._restaurants)
+
+    def __contains__(self, restaurant_id: str) -> bool:
+        return restaurant_id in self._rows
+
+    def load(self, restaurants: list[Restaurant]) -> None:
+        """CosmosDBから読み込んだ全件を登録する（読み込み中に書き込まれたレストランは上書きしない）"""
+        with self._lock:
+            for restaurant in restaurants:
+                if restaurant.id not in self._rows:
+                    self._add(restaurant)
+            self.loaded = True
+
+    def add_many(self, restaurants: list[Restaurant]) -> None:
+        """レストランを登録する（登録済みのIDは置き換え、位置情報がなければ削除する）"""
+        with self._lock:
+            for restaurant in restaurants:
+                self._remove(restaurant.id)
+                self._add(restaurant)
+
+    def remove(self, restaurant_id: str) -> None:
+        with self._lock:
+            self._remove(restaurant_id)
+
+    def search(
+        self, latitude: float, longitude: float, distance_km: float, limit: int = 10, offset: int = 0
+    ) -> list[tuple[Restaurant, float]]:
+        """`distance_km`以内のレストランを距離（キロメートル）とともに近い順に返す"""
+        with self._lock:
+            rows = np.fromiter(
+                chain.from_iterable(self._covering_cells(latitude, longitude, distance_km)), dtype=np.intp
+            )
+            distances = haversine_km(latitude, longitude, self._latitudes[rows], self._longitudes[rows])
+            within = distances <= distance_km
+            rows, distances = rows[within], distances[within]
+            top = min(offset + limit, len(rows))
+            if top <= offset:
+                return []
+            if top < len(rows):
+                candidates = np.argpartition(distances, top - 1)[:top]
+                order = candidates[np.argsort(distances[candidates], kind="stable")]
+            else:
+                order = np.argsort(distances, kind="stable")
+            return [(self._restaurants[rows[i]], float(distances[i])) for i in order[offset:top]]
+
+    def _covering_cells(self, latitude: float, longitude: float, distance_km: float) -> list[set[int]]:
+        min_latitude, max_latitude, min_longitude, max_longitude = bounding_box(latitude, longitude, distance_km)
+        first_row, last_row = self._cell(min_latitude), self._cell(max_latitude)
+        first_column, last_column = self._cell(min_longitude), self._cell(max_longitude)
+        if (last_row - first_row + 1) * (last_column - first_column + 1) > len(self._cells):
+            # 範囲が広い場合は、覆うセルを列挙するより使われているセルを走査したほうが速い
+            return [
+                rows
+                for (row, column), rows in self._cells.items()
+                if first_row <= row <= last_row and first_column <= column <= last_column
+            ]
+        return [
+            self._cells[cell]
+            for cell in (
+                (row, column)
+                for row in range(first_row, last_row + 1)
+                for column in range(first_column, last_column + 1)
+            )
+            if cell in self._cells
+        ]
+
+    def _cell(self, degrees: float) -> int:
+        return math.floor(degrees / self.cell_degrees)
+
+    def _add(self, restaurant: Restaurant) -> None:
+        if restaurant.latitude is None or restaurant.longitude is None:
+            return
+        row = len(self._restaurants)
+        if row == len(self._latitudes):
+            # 容量を倍々で増やし、追加のたびに配列をコピーしない
+            capacity = max(16, 2 * row)
+            self._latitudes = np.resize(self._latitudes, capacity)
+            self._longitudes = np.resize(self._longitudes, capacity)
+        self._latitudes[row] = restaurant.latitude
+        self._longitudes[row] = restaurant.longitude
+        self._restaurants.append(restaurant)
+        self._rows[restaurant.id] = row
+        self._cells.setdefault(self._cell_of(row), set()).add(row)
+
+    def _remove(self, restaurant_id: str) -> None:
+        row = self._rows.pop(restaurant_id, None)
+        if row is None:
+            return
+        self._discard(self._cell_of(row), row)
+        # 末尾の行を空いた行に移し、配列を詰めたまま保つ
+        last = len(self._restaurants) - 1
+        if row != last:
+            self._discard(self._cell_of(last), last)
+            moved = self._restaurants[last]
+            self._restaurants[row] = moved
+            self._latitudes[row] = self._latitudes[last]
+            self._longitudes[row] = self._longitudes[last]
+            self._rows[moved.id] = row
+            self._cells.setdefault(self._cell_of(row), set()).add(row)
+        self._restaurants.pop()
+
+    def _cell_of(self, row: int) -> tuple[int, int]:
+        return self._cell(self._latitudes[row]), self._cell(self._longitudes[row])
+
+    def _discard(self, cell: tuple[int, int], row: int) -> None:
+        rows = self._cells[cell]
+        rows.discard(row)
+        if not rows:
+            del self._cells[cell]
@@ -0,0 +1,136 @@
+import csv
+import json
+import os
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from template_fastapi.models.restaurant import Restaurant
+from template_fastapi.repositories.restaurants import RestaurantRepository
+from template_fastapi.settings.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class ImportProgress(BaseModel):
+    """インポートの進捗（チェックポイントから再開した行も含む）"""
+
+    rows: int
+    resumed_rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        """今回の実行で取り込んだ行の毎秒処理件数"""
+        return (self.rows - self.resumed_rows) / self.seconds if self.seconds else 0.0
+
+
+def restaurant_from_csv_row(row: dict[str, str]) -> Restaurant:
+    """CSVの1行をレストランに変換する"""
+    return Restaurant(
+        id=row["id"],
+        name=row["name"],
+        description=row["description"],
+        price=float(row["price"]),
+        latitude=float(row["latitude"]) if row["latitude"] else None,
+        longitude=float(row["longitude"]) if row["longitude"] else None,
+        # タグをリストに変換
+        tags=row["tags"].strip('"').split(",") if row["tags"] else [],
+    )
+
+
+def read_csv_rows(csv_file: str | Path, skip: int = 0) -> Iterator[Restaurant]:
+    """CSVファイルからレストランを1行ずつ読み込む（先頭の`skip`行は読み飛ばす）"""
+    with open(csv_file, encoding="utf-8", newline="") as f:
+        yield from map(restaurant_from_csv_row, islice(csv.DictReader(f), skip, None))
+
+
+class ImportCheckpoint:
+    """
+    中断したインポートを再開するためのチェックポイントファイル
+
+    書き込みが完了した先頭からの行数を、CSVファイルのパスとともにJSONで記録する。
+    一時ファイルに書いてから置き換えるため、書き込み途中で中断しても壊れない。
+    """
+
+    def __init__(self, path: str | Path, csv_file: str | Path):
+        self.path = Path(path)
+        self.csv_file = str(Path(csv_file).resolve())
+
+    def load(self) -> int:
+        """記録済みの行数を返す（チェックポイントがない、または別のCSVのものなら0）"""
+        if not self.path.exists():
+            return 0
+        state = json.loads(self.path.read_text())
+        if state.get("csv_file") != self.csv_file:
+            logger.warning(f"Ignoring checkpoint {self.path} recorded for another file: {state.get('csv_file')}")
+            return 0
+        return state["rows"]
+
+    def save(self, rows: int) -> None:
+        temporary_path = self.path.with_name(self.path.name + ".tmp")
+        temporary_path.write_text(json.dumps({"csv_file": self.csv_file, "rows": rows}))
+        os.replace(temporary_path, self.path)
+
+    def clear(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+def import_restaurants(
+    repository: RestaurantRepository,
+    csv_file: str | Path,
+    batch_size: int = 100,
+    concurrency: int = 8,
+    checkpoint_file: str | Path | None = None,
+    on_progress: Callable[[ImportProgress], None] | None = None,
+) -> ImportProgress:
+    """
+    CSVファイルのレストランをバッチ単位でベクトル埋め込みしてCosmosDBにupsertする
+
+    行はストリームで読み込み、各バッチの埋め込みは1回の要求にまとめて生成し、書き込みは
+    最大`concurrency`件を並行して行う。あるバッチの書き込み中に次のバッチの埋め込みを
+    進める。`checkpoint_file`を指定すると書き込みが完了したバッチまでを記録し、中断後は
+    その続きから再開する（完了時に削除）。upsertのため、再開時に重複して書き込んでも安全。
+    """
+    checkpoint = ImportCheckpoint(checkpoint_file, csv_file) if checkpoint_file else None
+    resumed_rows = checkpoint.load() if checkpoint else 0
+    if resumed_rows:
+        logger.info(f"Resuming import of {csv_file} after {resumed_rows} rows")
+    rows = resumed_rows
+    start = time.perf_counter()
+
+    def progress() -> ImportProgress:
+        return ImportProgress(rows=rows, resumed_rows=resumed_rows, seconds=time.perf_counter() - start)
+
+    def commit(batch_rows: int, futures: list[Future]) -> None:
+        nonlocal rows
+        wait(futures)
+        for future in futures:
+            # 失敗した書き込みがあれば、このバッチを記録せずに中断する
+            future.result()
+        rows += batch_rows
+        if checkpoint:
+            checkpoint.save(rows)
+        if on_progress:
+            on_progress(progress())
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="restaurant-import") as pool:
+        pending: tuple[int, list[Future]] | None = None
+        restaurants = read_csv_rows(csv_file, skip=resumed_rows)
+        while batch := list(islice(restaurants, batch_size)):
+            items = repository.to_cosmos_items(batch)
+            if pending:
+                commit(*pending)
+            pending = len(batch), [pool.submit(repository.container.upsert_item, body=item) for item in items]
+        if pending:
+            commit(*pending)
+
+    if checkpoint:
+        checkpoint.clear()
+    result = progress()
+    logger.info(f"Imported {result.rows - resumed_rows} restaurants ({result.rows_per_second:.1f} rows/sec)")
+    return result
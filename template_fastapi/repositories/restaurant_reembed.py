@@ -0,0 +1,142 @@
+import json
+import os
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
+from pydantic import BaseModel
+
+from template_fastapi.repositories.restaurants import RestaurantRepository, embedding_model_version
+from template_fastapi.settings.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class ReembedProgress(BaseModel):
+    """再埋め込みの進捗（チェックポイントから再開した場合は、それまでの件数も含む）"""
+
+    scanned: int
+    reembedded: int
+    conflicts: int
+    seconds: float
+
+    @property
+    def scanned_per_second(self) -> float:
+        return self.scanned / self.seconds if self.seconds else 0.0
+
+
+class ReembedCheckpoint:
+    """
+    中断した再埋め込みを再開するためのチェックポイントファイル
+
+    書き戻しが完了したページの続きを読み出す継続トークンと件数を、埋め込みモデルとともにJSONで記録する。
+    一時ファイルに書いてから置き換えるため、書き込み途中で中断しても壊れない。
+    """
+
+    def __init__(self, path: str | Path, embedding_model: str):
+        self.path = Path(path)
+        self.embedding_model = embedding_model
+
+    def load(self) -> dict:
+        """記録済みの状態を返す（チェックポイントがない、または別の埋め込みモデルのものなら空）"""
+        if not self.path.exists():
+            return {}
+        state = json.loads(self.path.read_text())
+        if state.get("embedding_model") != self.embedding_model:
+            logger.warning(
+                f"Ignoring checkpoint {self.path} recorded for another model: {state.get('embedding_model')}"
+            )
+            return {}
+        return state
+
+    def save(self, continuation: str, progress: ReembedProgress) -> None:
+        state = {
+            "embedding_model": self.embedding_model,
+            "continuation": continuation,
+            **progress.model_dump(include={"scanned", "reembedded", "conflicts"}),
+        }
+        temporary_path = self.path.with_name(self.path.name + ".tmp")
+        temporary_path.write_text(json.dumps(state))
+        os.replace(temporary_path, self.path)
+
+    def clear(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+def reembed_restaurants(
+    repository: RestaurantRepository,
+    batch_size: int = 100,
+    concurrency: int = 8,
+    checkpoint_file: str | Path | None = None,
+    force: bool = False,
+    on_progress: Callable[[ReembedProgress], None] | None = None,
+) -> ReembedProgress:
+    """
+    ベクトルが古くなったレストランだけを埋め込み直してCosmosDBに書き戻す
+
+    コンテナを`batch_size`件ずつのページでストリーム読み出しし、保存されたテキストのハッシュと
+    埋め込みモデルが今のものと異なるアイテム（`force`の場合はすべて）をページ単位でまとめて埋め込む。
+    書き戻しは最大`concurrency`件を並行して行い、あるページの書き戻し中に次のページの埋め込みを進める。
+    読み出した時のETagを条件に置き換えるため、その間に更新されたアイテムは上書きせずに数えるだけにする
+    （更新時に埋め込み直されている）。`checkpoint_file`を指定すると書き戻しが完了したページまでを
+    記録し、中断後はその続きから再開する（完了時に削除）。
+    """
+    checkpoint = ReembedCheckpoint(checkpoint_file, embedding_model_version()) if checkpoint_file else None
+    state = checkpoint.load() if checkpoint else {}
+    if state:
+        logger.info(f"Resuming re-embedding after {state['scanned']} restaurants")
+    scanned, reembedded, conflicts = state.get("scanned", 0), state.get("reembedded", 0), state.get("conflicts", 0)
+    start = time.perf_counter()
+
+    def progress() -> ReembedProgress:
+        return ReembedProgress(
+            scanned=scanned, reembedded=reembedded, conflicts=conflicts, seconds=time.perf_counter() - start
+        )
+
+    def replace(item: dict, etag: str) -> dict | None:
+        try:
+            return repository.container.replace_item(
+                item=item["id"], body=item, etag=etag, match_condition=MatchConditions.IfNotModified
+            )
+        except CosmosAccessConditionFailedError:
+            return None
+
+    def commit(page_size: int, continuation: str | None, futures: list[Future]) -> None:
+        nonlocal scanned, reembedded, conflicts
+        wait(futures)
+        # 失敗した書き戻しがあれば、このページを記録せずに中断する
+        written = [result for result in (future.result() for future in futures) if result is not None]
+        scanned += page_size
+        reembedded += len(written)
+        conflicts += len(futures) - len(written)
+        if checkpoint and continuation:
+            checkpoint.save(continuation, progress())
+        if on_progress:
+            on_progress(progress())
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="restaurant-reembed") as pool:
+        pending: tuple[int, str | None, list[Future]] | None = None
+        for page, continuation in repository.scan_embedding_states(batch_size, state.get("continuation")):
+            stale = [item for item in page if force or repository.is_embedding_stale(item)]
+            items = repository.reembed_items(stale) if stale else []
+            if pending:
+                commit(*pending)
+            pending = (
+                len(page),
+                continuation,
+                [pool.submit(replace, item, original["_etag"]) for item, original in zip(items, stale)],
+            )
+        if pending:
+            commit(*pending)
+
+    if checkpoint:
+        checkpoint.clear()
+    result = progress()
+    logger.info(
+        f"Re-embedded {result.reembedded} of {result.scanned} restaurants "
+        f"({result.conflicts} changed concurrently, {result.scanned_per_second:.1f} scanned/sec)"
+    )
+    return result
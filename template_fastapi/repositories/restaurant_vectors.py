@@ -0,0 +1,263 @@
+import base64
+import threading
+from typing import Literal
+
+import numpy as np
+
+from template_fastapi.models.restaurant import Restaurant
+
+VectorStorage = Literal["float32", "float16", "int8"]
+
+_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+# 量子化した行列をfloat32に戻して内積を求める際に、一度に変換する行数（一時的なメモリ使用量を抑える）
+_CHUNK_ROWS = 8192
+
+
+def quantize_vector(vector: list[float], storage: VectorStorage, exact: bool = False) -> dict:
+    """
+    ベクトルを保存形式に変換し、CosmosDBのアイテムに加えるフィールドを返す
+
+    `float16`は値をfloat16の精度に丸めて短い10進数で表す。`int8`は絶対値の最大値が127になるよう
+    整数に丸め、元に戻すための倍率を`vector_scale`に持つ。コサイン類似度は倍率によらないため、
+    どちらの形式でもCosmosDBのVectorDistanceでそのまま検索できる。
+    `exact`を指定すると、量子化で失われた順位を再ランキングで取り戻せるよう、float32のベクトルを
+    base64で`vector_exact`にも持つ（JSONの数値の配列の1/3程度の大きさになる）
+    """
+    if storage == "float32":
+        return {"vector": vector}
+    array = np.asarray(vector, dtype=np.float32)
+    if storage == "float16":
+        fields = {"vector": [float(value) for value in array.astype(np.float16).astype(str)]}
+    else:
+        peak = float(np.abs(array).max())
+        scale = peak / 127 if peak > 0 else 1.0
+        fields = {"vector": np.rint(array / scale).astype(np.int8).tolist(), "vector_scale": scale}
+    if exact:
+        fields["vector_exact"] = base64.b64encode(array.astype("<f4").tobytes()).decode()
+    return fields
+
+
+def dequantize_vector(item: dict) -> list[float] | None:
+    """CosmosDBのアイテムに保存されたベクトルを、保存形式によらずfloatのリストに戻す"""
+    vector = item.get("vector")
+    if vector is None or "vector_scale" not in item:
+        return vector
+    return (np.asarray(vector, dtype=np.float32) * item["vector_scale"]).tolist()
+
+
+def exact_vector(item: dict) -> list[float] | None:
+    """CosmosDBのアイテムに`vector_exact`として保存された、精度を落としていないベクトル（なければNone）"""
+    encoded = item.get("vector_exact")
+    if encoded is None:
+        return None
+    return np.frombuffer(base64.b64decode(encoded), dtype="<f4").tolist()
+
+
+def rerank(query: list[float], vectors: list[list[float]]) -> list[int]:
+    """候補のベクトルをクエリとの正確なコサイン類似度で並べ替え、類似度の高い順の位置を返す"""
+    if not vectors:
+        return []
+    scores = _normalize(np.asarray(vectors, dtype=np.float32)) @ _normalize(np.asarray([query], dtype=np.float32))[0]
+    return np.argsort(-scores, kind="stable").tolist()
+
+
+class RestaurantVectorIndex:
+    """
+    レストランの埋め込みベクトルをプロセス内に保持する総当たりのベクトルインデックス
+
+    正規化したベクトルを連続した行列に並べ、クエリとの内積（コサイン類似度）を
+    1回の行列演算で求め、`argpartition`で上位k件だけを並べ替える。レストラン自体も
+    保持するため、検索はCosmosDBへの往復なしで完結する。書き込みはリポジトリから
+    反映されるが、他のワーカーやプロセスによる書き込みは再読み込みするまで反映されない。
+
+    `storage`に`float16`・`int8`を指定すると行列をその精度で保持し、メモリ使用量を1/2・1/4にする。
+    検索時は行列を少しずつfloat32に戻し、精度を落としていないクエリと内積を求める。
+
+    `search_dimensions`を指定すると2段階で検索する。text-embedding-3のようなMatryoshka表現学習の
+    埋め込みは先頭の次元ほど多くの情報を持つため、先頭`search_dimensions`次元だけの行列で全件から
+    上位`k × rerank_factor`件の候補を選び、候補だけを全次元のベクトルで並べ替える
+    """
+
+    def __init__(
+        self, storage: VectorStorage = "float32", search_dimensions: int | None = None, rerank_factor: int = 4
+    ):
+        self.loaded = False
+        self.storage = storage
+        self.search_dimensions = search_dimensions
+        self.rerank_factor = rerank_factor
+        self._vectors = _VectorMatrix(storage, 0)
+        # 1段目の検索に使う、先頭の次元だけを正規化し直した行列（2段階で検索しない場合はNone）
+        self._prefixes: _VectorMatrix | None = None
+        self._restaurants: list[Restaurant] = []
+        self._rows: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._restaurants)
+
+    def __contains__(self, restaurant_id: str) -> bool:
+        return restaurant_id in self._rows
+
+    @property
+    def nbytes(self) -> int:
+        """保持しているベクトルのバイト数"""
+        count = len(self._restaurants)
+        return self._vectors.nbytes(count) + (self._prefixes.nbytes(count) if self._prefixes is not None else 0)
+
+    def load(self, entries: list[tuple[Restaurant, list[float] | None]]) -> None:
+        """CosmosDBから読み込んだ全件を登録する（読み込み中に書き込まれたレストランは上書きしない）"""
+        with self._lock:
+            self._add([(restaurant, vector) for restaurant, vector in entries if restaurant.id not in self._rows])
+            self.loaded = True
+
+    def add_many(self, entries: list[tuple[Restaurant, list[float] | None]]) -> None:
+        """レストランとベクトルを登録する（登録済みのIDは置き換え、ベクトルがなければ削除する）"""
+        with self._lock:
+            for restaurant, vector in entries:
+                if vector is None:
+                    self._remove(restaurant.id)
+            self._add([(restaurant, vector) for restaurant, vector in entries if vector is not None])
+
+    def remove(self, restaurant_id: str) -> None:
+        with self._lock:
+            self._remove(restaurant_id)
+
+    def search(self, vector: list[float], k: int = 3, offset: int = 0) -> list[Restaurant]:
+        """クエリベクトルとのコサイン類似度が高い順に、`offset`件目から`k`件を返す"""
+        return self.search_many([vector], k, offset)[0]
+
+    def search_many(self, vectors: list[list[float]], k: int = 3, offset: int = 0) -> list[list[Restaurant]]:
+        """複数のクエリをまとめて1回の行列積で検索する"""
+        with self._lock:
+            count = len(self._restaurants)
+            top = min(offset + k, count)
+            if top <= offset:
+                return [[] for _ in vectors]
+            queries = _normalize(np.asarray(vectors, dtype=np.float32))
+            shortlist = top * self.rerank_factor
+            if self._prefixes is not None and self.rerank_factor > 1 and shortlist < count:
+                # 1段目: 先頭の次元だけで候補を絞り、2段目: 候補だけを全次元の類似度で並べ替える
+                prefix_scores = self._prefixes.scores(_normalize(queries[:, : self.search_dimensions]), count)
+                candidates = np.argpartition(-prefix_scores, shortlist - 1, axis=1)[:, :shortlist]
+                scores = self._vectors.scores_of(queries, candidates)
+                top_candidates = np.argsort(-scores, axis=1, kind="stable")[:, :top]
+                order = np.take_along_axis(candidates, top_candidates, axis=1)
+                return [[self._restaurants[row] for row in rows[offset:top]] for rows in order.tolist()]
+
+            scores = self._vectors.scores(queries, count)
+            if top < count:
+                # 上位top件を線形時間で選び、その中だけを並べ替える
+                candidates = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            else:
+                candidates = np.broadcast_to(np.arange(count), (len(vectors), count))
+            order = np.take_along_axis(
+                candidates, np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1), axis=1
+            )
+            return [[self._restaurants[row] for row in rows[offset:top]] for rows in order.tolist()]
+
+    def _add(self, entries: list[tuple[Restaurant, list[float]]]) -> None:
+        if not entries:
+            return
+        vectors = _normalize(np.asarray([vector for _, vector in entries], dtype=np.float32))
+        dimensions = vectors.shape[1]
+        if not self._restaurants and self._vectors.dimensions != dimensions:
+            self._vectors = _VectorMatrix(self.storage, dimensions)
+            if self.search_dimensions and self.search_dimensions < dimensions:
+                self._prefixes = _VectorMatrix(self.storage, self.search_dimensions)
+        elif self._vectors.dimensions != dimensions:
+            raise ValueError(f"Expected {self._vectors.dimensions}-dimensional vectors, got {dimensions}")
+        encoded = self._vectors.encode(vectors)
+        prefixes = (
+            self._prefixes.encode(_normalize(vectors[:, : self.search_dimensions]))
+            if self._prefixes is not None
+            else None
+        )
+
+        for i, (restaurant, _) in enumerate(entries):
+            row = self._rows.get(restaurant.id)
+            if row is None:
+                row = len(self._restaurants)
+                self._rows[restaurant.id] = row
+                self._restaurants.append(restaurant)
+            else:
+                self._restaurants[row] = restaurant
+            self._vectors.put(row, encoded, i)
+            if self._prefixes is not None:
+                self._prefixes.put(row, prefixes, i)
+
+    def _remove(self, restaurant_id: str) -> None:
+        row = self._rows.pop(restaurant_id, None)
+        if row is None:
+            return
+        # 末尾の行を空いた行に移し、行列を詰めたまま保つ
+        last = len(self._restaurants) - 1
+        if row != last:
+            moved = self._restaurants[last]
+            self._restaurants[row] = moved
+            for matrix in (self._vectors, self._prefixes):
+                if matrix is not None:
+                    matrix.move(last, row)
+            self._rows[moved.id] = row
+        self._restaurants.pop()
+
+
+class _VectorMatrix:
+    """正規化したベクトルを保存精度で並べた行列（int8の場合は行ごとの倍率も持つ）"""
+
+    def __init__(self, storage: VectorStorage, dimensions: int):
+        self.storage = storage
+        self.dimensions = dimensions
+        self._dtype = _DTYPES[storage]
+        self._rows = np.empty((0, dimensions), dtype=self._dtype)
+        # int8で保持する行の倍率（行ごとの絶対値の最大値 / 127）
+        self._scales = np.empty(0, dtype=np.float32)
+
+    def nbytes(self, count: int) -> int:
+        return self._rows[:count].nbytes + (self._scales[:count].nbytes if self.storage == "int8" else 0)
+
+    def encode(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """正規化したベクトルを保存精度に変換し、倍率とともに返す"""
+        scales = np.ones(len(vectors), dtype=np.float32)
+        if self.storage == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            vectors = np.rint(vectors / np.where(scales == 0, 1, scales)[:, None])
+        return vectors.astype(self._dtype), scales
+
+    def put(self, row: int, encoded: tuple[np.ndarray, np.ndarray], i: int) -> None:
+        """`encode`の結果のi番目を`row`行目に書き込む"""
+        if row >= len(self._rows):
+            # 容量を倍々で増やし、追加のたびに行列をコピーしない
+            grown = np.empty((max(16, 2 * row), self.dimensions), dtype=self._dtype)
+            grown[: len(self._rows)] = self._rows
+            self._rows = grown
+            self._scales = np.resize(self._scales, len(grown))
+        self._rows[row] = encoded[0][i]
+        self._scales[row] = encoded[1][i]
+
+    def move(self, source: int, target: int) -> None:
+        self._rows[target] = self._rows[source]
+        self._scales[target] = self._scales[source]
+
+    def scores(self, queries: np.ndarray, count: int) -> np.ndarray:
+        """先頭`count`行すべてとクエリとの内積"""
+        if self.storage == "float32":
+            return queries @ self._rows[:count].T
+        scores = np.empty((len(queries), count), dtype=np.float32)
+        for start in range(0, count, _CHUNK_ROWS):
+            end = min(start + _CHUNK_ROWS, count)
+            scores[:, start:end] = queries @ self._rows[start:end].astype(np.float32).T
+        if self.storage == "int8":
+            scores *= self._scales[:count]
+        return scores
+
+    def scores_of(self, queries: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+        """クエリごとの候補の行（クエリ数 × 候補数）とクエリとの内積"""
+        scores = np.einsum("qcd,qd->qc", self._rows[candidates].astype(np.float32), queries)
+        if self.storage == "int8":
+            scores *= self._scales[candidates]
+        return scores
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
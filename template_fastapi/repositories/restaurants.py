@@ -1,50 +1,267 @@
+import base64
+import hashlib
+import json
+import re
 import uuid
+from collections.abc import Callable, Iterator
 
+import numpy as np
+from azure.core import MatchConditions
 from azure.cosmos import CosmosClient
-from langchain_core.documents import Document
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceNotFoundError
 from langchain_openai import AzureOpenAIEmbeddings
 
-from template_fastapi.models.restaurant import Restaurant
+from template_fastapi.models.restaurant import NearbyRestaurant, Restaurant
+from template_fastapi.repositories.embeddings import EmbeddingBatcher, EmbeddingCache
+from template_fastapi.repositories.restaurant_cache import (
+    RestaurantItemCache,
+    RestaurantResultCache,
+    normalize_query,
+)
+from template_fastapi.repositories.restaurant_embedding_worker import EmbeddingJob, EmbeddingWriteBehind
+from template_fastapi.repositories.restaurant_geo import RestaurantGeoIndex, bounding_box, haversine_km
+from template_fastapi.repositories.restaurant_vectors import (
+    RestaurantVectorIndex,
+    dequantize_vector,
+    exact_vector,
+    quantize_vector,
+    rerank,
+)
 from template_fastapi.settings.azure_cosmosdb import get_azure_cosmosdb_settings
 from template_fastapi.settings.azure_openai import get_azure_openai_settings
+from template_fastapi.settings.embeddings import get_embeddings_settings
+from template_fastapi.settings.restaurants import get_restaurants_settings
 
 # 設定の取得
 azure_cosmosdb_settings = get_azure_cosmosdb_settings()
 azure_openai_settings = get_azure_openai_settings()
+embeddings_settings = get_embeddings_settings()
+restaurants_settings = get_restaurants_settings()
+
+
+# クエリはパラメーター化し、値が変わってもCosmosDBがクエリプランを再利用できるようにする。
+# また、APIが返すフィールドだけを射影し、1件あたり数十KBになるベクトル埋め込みを転送しない
+_RESTAURANT_FIELDS = "c.id, c.name, c.description, c.price, c.location, c.tags"
+_ALL_QUERY = f"SELECT {_RESTAURANT_FIELDS} FROM c"
+_LIST_QUERY = f"SELECT {_RESTAURANT_FIELDS} FROM c OFFSET @offset LIMIT @limit"
+# 埋め込みの鮮度を確認するクエリ（ベクトルは読まず、条件付きの書き戻しに使うETagを取得する）
+_EMBEDDING_STATE_QUERY = (
+    f"SELECT {_RESTAURANT_FIELDS}, c.content_hash, c.embedding_model, c.vector_status, c._etag FROM c"
+)
+# パッチの条件（filter_predicate）はパラメーター化できないため、文字列に埋め込むハッシュの形式を検証する
+_CONTENT_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+# ローカルのインデックスに読み込むクエリ（ベクトルも取得する）
+_INDEX_QUERY = f"SELECT {_RESTAURANT_FIELDS}, c.vector, c.vector_scale FROM c"
+# ベクトル検索クエリ（オフセットとリミットを適用）
+_SEARCH_QUERY = f"""
+    SELECT {_RESTAURANT_FIELDS}
+    FROM c
+    ORDER BY VectorDistance(c.vector, @queryVector)
+    OFFSET @offset LIMIT @limit
+    """
+# 継続トークンでページをたどるベクトル検索クエリ（類似度の高い上位@top件まで）
+_SEARCH_TOP_QUERY = f"""
+    SELECT TOP @top {_RESTAURANT_FIELDS}
+    FROM c
+    ORDER BY VectorDistance(c.vector, @queryVector)
+    """
+# 量子化したベクトルで選んだ上位@top件の候補を、精度を落としていないベクトル（base64）とともに取得し、
+# 正確な類似度で並べ替えるクエリ（量子化したベクトル自体は取得しない）
+_SEARCH_RERANK_QUERY = f"""
+    SELECT TOP @top {_RESTAURANT_FIELDS}, c.vector_exact
+    FROM c
+    ORDER BY VectorDistance(c.vector, @queryVector)
+    """
+
+
+_NEARBY_QUERY = f"""
+    SELECT {_RESTAURANT_FIELDS}
+    FROM c
+    WHERE c.location.coordinates[1] BETWEEN @minLatitude AND @maxLatitude
+    AND c.location.coordinates[0] BETWEEN @minLongitude AND @maxLongitude
+    AND ST_DISTANCE(c.location, {{"type": "Point", "coordinates": [@longitude, @latitude]}}) < @distance
+    """
+
+
+def _nearby_parameters(latitude: float, longitude: float, distance_km: float) -> list[dict]:
+    # 範囲インデックスが効く緯度経度の範囲で候補を絞ってから、地理空間関数で距離を判定する（メートル単位）
+    min_latitude, max_latitude, min_longitude, max_longitude = bounding_box(latitude, longitude, distance_km)
+    return [
+        {"name": "@minLatitude", "value": min_latitude},
+        {"name": "@maxLatitude", "value": max_latitude},
+        {"name": "@minLongitude", "value": min_longitude},
+        {"name": "@maxLongitude", "value": max_longitude},
+        {"name": "@latitude", "value": latitude},
+        {"name": "@longitude", "value": longitude},
+        {"name": "@distance", "value": distance_km * 1000},
+    ]
+
+
+def _page_parameters(limit: int, offset: int) -> list[dict]:
+    return [{"name": "@offset", "value": offset}, {"name": "@limit", "value": limit}]
+
+
+def _search_top_parameters(query_embedding: list[float], top: int | None = None) -> list[dict]:
+    return [
+        {"name": "@queryVector", "value": query_embedding},
+        {"name": "@top", "value": top or restaurants_settings.restaurant_search_max_results},
+    ]
+
+
+def _reranks() -> bool:
+    """
+    ベクトルを精度を落として保存している場合、精度を落としていないベクトルも保存し、
+    CosmosDBの検索結果をそのベクトルとの正確な類似度で並べ替える
+    """
+    return (
+        restaurants_settings.restaurant_vector_storage != "float32"
+        and restaurants_settings.restaurant_search_rerank_factor > 1
+    )
+
+
+def _search_top_query() -> str:
+    return _SEARCH_RERANK_QUERY if _reranks() else _SEARCH_TOP_QUERY
+
+
+def content_hash(text: str) -> str:
+    """埋め込んだテキストのハッシュ。保存されたベクトルがどのテキストから生成されたかを記録する"""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def embedding_model_version() -> str:
+    """ベクトルを生成した埋め込みモデル（デプロイ名と次元数）を表す文字列"""
+    dimensions = azure_openai_settings.azure_openai_embedding_dimensions
+    return f"{azure_openai_settings.azure_openai_model_embedding}@{dimensions or 'native'}"
+
+
+def embedding_text(restaurant: Restaurant) -> str:
+    """レストランのベクトル埋め込みを生成するテキスト"""
+    return restaurant.description or restaurant.name
+
+
+class InvalidCursorError(ValueError):
+    """ページネーションのカーソルを復号できない、または別の検索条件のカーソルである場合に送出する"""
+
+
+def _fingerprint(query: tuple) -> str:
+    return hashlib.sha256(json.dumps(query).encode()).hexdigest()[:16]
+
+
+def encode_cursor(query: tuple, position: dict) -> str:
+    """
+    検索条件と続きの位置（CosmosDBの継続トークン`c`、またはローカル検索のオフセット`o`）を
+    不透明なカーソルに符号化する
+    """
+    payload = json.dumps({"q": _fingerprint(query), **position}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str | None, query: tuple) -> dict:
+    """カーソルを続きの位置に復号する（Noneや空文字列は先頭のページ）"""
+    if not cursor:
+        return {}
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError as e:
+        raise InvalidCursorError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(position, dict) or position.pop("q", None) != _fingerprint(query):
+        raise InvalidCursorError(f"Cursor does not belong to this query: {cursor}")
+    return position
 
 
-class RestaurantRepository:
-    """レストランデータを管理するリポジトリクラス"""
+class BaseRestaurantRepository:
+    """同期版・非同期版のリポジトリに共通するベクトル埋め込みとアイテム変換"""
 
-    def __init__(self):
-        self._container = None
+    def __init__(
+        self,
+        container=None,
+        embed_documents: Callable[[list[str]], list[list[float]]] | None = None,
+        embedding_cache: EmbeddingCache | None = None,
+        vector_index: RestaurantVectorIndex | None = None,
+        geo_index: RestaurantGeoIndex | None = None,
+        result_cache: RestaurantResultCache | None = None,
+        item_cache: RestaurantItemCache | None = None,
+    ):
+        """
+        引数を省略するとAzure Cosmos DB・Azure OpenAI・設定どおりのキャッシュと検索バックエンドを使う。
+        テストではインメモリのコンテナや偽の埋め込み生成器に差し替えられる
+        """
+        self._container = container
+        # ローカルのベクトルインデックス（Noneの場合はCosmosDBのVectorDistanceで検索する）
+        if vector_index is None and restaurants_settings.restaurant_search_backend == "local":
+            vector_index = RestaurantVectorIndex(
+                restaurants_settings.restaurant_vector_storage,
+                search_dimensions=azure_openai_settings.azure_openai_embedding_search_dimensions,
+                rerank_factor=restaurants_settings.restaurant_search_rerank_factor,
+            )
+        self.vector_index = vector_index
+        # ローカルの地理空間インデックス（Noneの場合はCosmosDBのST_DISTANCEで検索する）
+        if geo_index is None and restaurants_settings.restaurant_geo_backend == "local":
+            geo_index = RestaurantGeoIndex(restaurants_settings.restaurant_geo_cell_km)
+        self.geo_index = geo_index
+        # 一覧・検索結果のキャッシュ（このリポジトリ経由の書き込みで無効化する）
+        if result_cache is None:
+            result_cache = RestaurantResultCache(
+                ttl=restaurants_settings.restaurant_cache_ttl_seconds,
+                max_size=restaurants_settings.restaurant_cache_size,
+            )
+        self.result_cache = result_cache
+        # IDで読み出したレストランのキャッシュ（ETagで再検証し、このリポジトリ経由の書き込みで無効化する）
+        if item_cache is None:
+            item_cache = RestaurantItemCache(
+                fresh_for=restaurants_settings.restaurant_item_cache_fresh_seconds,
+                max_size=restaurants_settings.restaurant_item_cache_size,
+            )
+        self.item_cache = item_cache
+        self._embedding_model = None
+        self.embedding_cache = embedding_cache or EmbeddingCache(
+            embeddings_settings.embedding_cache_path,
+            memory_size=embeddings_settings.embedding_cache_memory_size,
+            disk_size=embeddings_settings.embedding_cache_disk_size,
+        )
+        # 同時に届いた埋め込み要求をまとめ、1つのクライアントで呼び出す
+        self.embedding_batcher = EmbeddingBatcher(
+            embed_documents or (lambda texts: self.embedding_model.embed_documents(texts)),
+            max_batch_size=embeddings_settings.embedding_batch_size,
+            max_wait=embeddings_settings.embedding_batch_wait_ms / 1000,
+            max_concurrency=embeddings_settings.embedding_batch_concurrency,
+        )
 
     @property
-    def container(self):
-        """コンテナを遅延初期化するプロパティ"""
-        if self._container is None:
-            self._container = self._setup_cosmos_client()
-        return self._container
-
-    def _setup_cosmos_client(self):
-        """Azure Cosmos DBに接続するクライアントを設定する"""
-        client = CosmosClient.from_connection_string(azure_cosmosdb_settings.azure_cosmosdb_connection_string)
-        db = client.get_database_client(azure_cosmosdb_settings.azure_cosmosdb_database_name)
-        container = db.get_container_client(azure_cosmosdb_settings.azure_cosmosdb_container_name)
-        return container
+    def embedding_model(self) -> AzureOpenAIEmbeddings:
+        """埋め込みモデルのクライアントを遅延初期化するプロパティ"""
+        if self._embedding_model is None:
+            self._embedding_model = AzureOpenAIEmbeddings(
+                azure_endpoint=azure_openai_settings.azure_openai_endpoint,
+                api_key=azure_openai_settings.azure_openai_api_key,
+                azure_deployment=azure_openai_settings.azure_openai_model_embedding,
+                api_version=azure_openai_settings.azure_openai_api_version,
+                dimensions=azure_openai_settings.azure_openai_embedding_dimensions,
+            )
+        return self._embedding_model
 
     def _get_embeddings(self, text: str) -> list[float]:
-        """Azure OpenAIを使用してテキストのベクトル埋め込みを生成する"""
-        embedding_model = AzureOpenAIEmbeddings(
-            azure_endpoint=azure_openai_settings.azure_openai_endpoint,
-            api_key=azure_openai_settings.azure_openai_api_key,
-            azure_deployment=azure_openai_settings.azure_openai_model_embedding,
-            api_version=azure_openai_settings.azure_openai_api_version,
+        """Azure OpenAIを使用してテキストのベクトル埋め込みを生成する（同じテキストはキャッシュから返す）"""
+        return self._get_embeddings_many([text])[0]
+
+    def _get_embeddings_many(self, texts: list[str]) -> list[list[float]]:
+        """複数テキストのベクトル埋め込みを、キャッシュにないものだけまとめて生成する"""
+        return self.embedding_cache.embed(
+            texts,
+            deployment=azure_openai_settings.azure_openai_model_embedding,
+            dimensions=azure_openai_settings.azure_openai_embedding_dimensions,
+            embed_documents=self.embedding_batcher.embed,
         )
 
-        document = Document(page_content=text)
-        embedding = embedding_model.embed_documents([document.page_content])[0]
-        return embedding
+    async def _aget_embeddings_many(self, texts: list[str]) -> list[list[float]]:
+        """`_get_embeddings_many`の非同期版。埋め込みを待つ間イベントループをブロックしない"""
+        return await self.embedding_cache.aembed(
+            texts,
+            deployment=azure_openai_settings.azure_openai_model_embedding,
+            dimensions=azure_openai_settings.azure_openai_embedding_dimensions,
+            aembed_documents=self.embedding_batcher.aembed,
+        )
 
     def _cosmos_item_to_restaurant(self, item: dict) -> Restaurant:
         """CosmosDBのアイテムをRestaurantモデルに変換する"""
@@ -64,48 +281,257 @@ class RestaurantRepository:
             tags=item.get("tags", []),
         )
 
-    def list_restaurants(self, limit: int = 10, offset: int = 0) -> list[Restaurant]:
-        """レストラン一覧を取得する（ページネーション対応）"""
-        query = f"SELECT * FROM c OFFSET {offset} LIMIT {limit}"
-        items = list(self.container.query_items(query=query, enable_cross_partition_query=True))
-        return [self._cosmos_item_to_restaurant(item) for item in items]
-
-    def get_restaurant(self, restaurant_id: str) -> Restaurant:
-        """指定されたIDのレストラン情報を取得する"""
-        item = self.container.read_item(item=restaurant_id, partition_key=restaurant_id)
-        return self._cosmos_item_to_restaurant(item)
-
-    def create_restaurant(self, restaurant: Restaurant) -> Restaurant:
-        """新しいレストランを作成する"""
-        # IDが指定されていない場合は自動生成
-        if not restaurant.id:
-            restaurant.id = str(uuid.uuid4())
-
-        # ベクトル埋め込みの生成
-        description = restaurant.description or restaurant.name
-        vector_embedding = self._get_embeddings(description)
-
-        # 位置情報の構築
-        location = None
-        if restaurant.latitude is not None and restaurant.longitude is not None:
-            location = {"type": "Point", "coordinates": [restaurant.longitude, restaurant.latitude]}
+    def _restaurant_to_cosmos_item(self, restaurant: Restaurant, vector_embedding: list[float] | None) -> dict:
+        """
+        RestaurantモデルをCosmosDBに保存するアイテムに変換する
 
-        # CosmosDBに保存するアイテムの作成
+        ベクトルがNoneの場合は`vector_status: pending`とし、書き込み後にバックグラウンドで埋め込む
+        """
         item = {
             "id": restaurant.id,
             "name": restaurant.name,
             "description": restaurant.description,
             "price": restaurant.price,
             "tags": restaurant.tags,
-            "vector": vector_embedding,
+            "content_hash": content_hash(embedding_text(restaurant)),
+            "embedding_model": embedding_model_version(),
         }
+        if vector_embedding is None:
+            item["vector_status"] = "pending"
+        else:
+            item.update(
+                quantize_vector(vector_embedding, restaurants_settings.restaurant_vector_storage, exact=_reranks())
+            )
 
-        if location:
-            item["location"] = location
+        # 位置情報の構築
+        if restaurant.latitude is not None and restaurant.longitude is not None:
+            item["location"] = {"type": "Point", "coordinates": [restaurant.longitude, restaurant.latitude]}
+        return item
+
+    def is_embedding_stale(self, item: dict) -> bool:
+        """アイテムのベクトルが、今のテキストと埋め込みモデルから生成されたもの（で書き込み済み）でなければTrue"""
+        return (
+            item.get("content_hash") != content_hash(embedding_text(self._cosmos_item_to_restaurant(item)))
+            or item.get("embedding_model") != embedding_model_version()
+            or item.get("vector_status") == "pending"
+        )
 
-        # CosmosDBに保存
-        created_item = self.container.create_item(body=item)
-        return self._cosmos_item_to_restaurant(created_item)
+    def _after_write(self, items: list[dict]) -> None:
+        """書き込んだアイテムをローカルのインデックスに反映し、結果のキャッシュを無効化する"""
+        self.result_cache.invalidate()
+        for item in items:
+            self.item_cache.invalidate(item["id"])
+        entries = [(self._cosmos_item_to_restaurant(item), dequantize_vector(item)) for item in items]
+        if self.vector_index is not None:
+            self.vector_index.add_many(entries)
+        if self.geo_index is not None:
+            self.geo_index.add_many([restaurant for restaurant, _ in entries])
+
+    def _after_delete(self, restaurant_id: str) -> None:
+        self.result_cache.invalidate()
+        self.item_cache.invalidate(restaurant_id)
+        for index in (self.vector_index, self.geo_index):
+            if index is not None:
+                index.remove(restaurant_id)
+
+    @staticmethod
+    def _if_none_match(etag: str | None) -> dict:
+        """キャッシュ済みのETagがあれば、変更がない場合に本文を返さない条件付き読み出しの引数を返す"""
+        return {"etag": etag, "match_condition": MatchConditions.IfModified} if etag else {}
+
+    def _read_result(self, item: dict) -> tuple[str | None, Restaurant] | None:
+        """読み出したアイテムのETagとレストランを返す（304 Not Modifiedの本文は空なのでNone）"""
+        if not item:
+            return None
+        return item.get("_etag"), self._cosmos_item_to_restaurant(item)
+
+    def _unloaded_indexes(self) -> bool:
+        return any(index is not None and not index.loaded for index in (self.vector_index, self.geo_index))
+
+    def _load_indexes(self, items: list[dict]) -> None:
+        """全件のアイテムを、まだ読み込んでいないローカルのインデックスに読み込む"""
+        entries = [(self._cosmos_item_to_restaurant(item), dequantize_vector(item)) for item in items]
+        if self.vector_index is not None and not self.vector_index.loaded:
+            self.vector_index.load(entries)
+        if self.geo_index is not None and not self.geo_index.loaded:
+            self.geo_index.load([restaurant for restaurant, _ in entries])
+
+    def _nearby_key(
+        self, latitude: float, longitude: float, distance_km: float, limit: int, offset: int
+    ) -> tuple[str, float, float, float, int, int]:
+        """近傍検索のキャッシュキー。座標は設定の桁数に丸め、同じキーの検索は丸めた座標で実行する"""
+        precision = restaurants_settings.restaurant_cache_coordinate_precision
+        return "nearby", round(latitude, precision), round(longitude, precision), distance_km, limit, offset
+
+    def _page(self, query: tuple, results: list, offset: int, limit: int) -> tuple[list, str | None]:
+        """`limit`より1件多く取得した結果から、ページと次のページのカーソルを作る"""
+        next_cursor = encode_cursor(query, {"o": offset + limit}) if len(results) > limit else None
+        return results[:limit], next_cursor
+
+    def _continued_page(
+        self, query: tuple, items: list[dict], continuation: str | None
+    ) -> tuple[list[Restaurant], str | None]:
+        """CosmosDBの1ページ分の結果と継続トークンから、ページと次のページのカーソルを作る"""
+        next_cursor = encode_cursor(query, {"c": continuation}) if continuation else None
+        return [self._cosmos_item_to_restaurant(item) for item in items], next_cursor
+
+    def _rerank(self, items: list[dict], query_embedding: list[float]) -> list[dict]:
+        """
+        量子化したベクトルで選ばれた候補を、保存しておいた精度を落としていないベクトルとクエリとの
+        正確な類似度で並べ替える
+
+        量子化したベクトルで並べ替えてもCosmosDBと同じ類似度を求め直すだけなので、精度を落としていない
+        ベクトルがない候補（再ランキングを有効にする前に書き込まれたもの）があればCosmosDBの順位のまま返す
+        """
+        vectors = [vector for vector in map(exact_vector, items) if vector is not None]
+        if len(vectors) < len(items):
+            return items
+        order = rerank(query_embedding, vectors)
+        return [items[i] for i in order]
+
+    def _rerank_candidates(self, k: int, offset: int) -> int:
+        return (offset + k) * restaurants_settings.restaurant_search_rerank_factor
+
+    def _sort_by_distance(
+        self, items: list[dict], latitude: float, longitude: float, limit: int, offset: int
+    ) -> list[NearbyRestaurant]:
+        """CosmosDBが返した範囲内のアイテムを距離の近い順に並べ、ページを切り出す"""
+        restaurants = [self._cosmos_item_to_restaurant(item) for item in items]
+        distances = haversine_km(
+            latitude,
+            longitude,
+            np.array([restaurant.latitude for restaurant in restaurants], dtype=float),
+            np.array([restaurant.longitude for restaurant in restaurants], dtype=float),
+        )
+        order = np.argsort(distances, kind="stable")[offset : offset + limit]
+        return [_nearby(restaurants[i], float(distances[i])) for i in order]
+
+    def _assign_ids(self, restaurants: list[Restaurant]) -> list[str]:
+        """IDが指定されていない場合は自動生成し、埋め込むテキストを返す"""
+        for restaurant in restaurants:
+            if not restaurant.id:
+                restaurant.id = str(uuid.uuid4())
+        return [embedding_text(restaurant) for restaurant in restaurants]
+
+    def _embedding_for_update(self, restaurant: Restaurant, existing_item: dict) -> tuple[str, list[float] | None]:
+        """
+        テキストか埋め込みモデルが変わった場合だけ埋め込み直すよう、テキストと既存のベクトルを返す
+
+        既存のベクトルを使えない場合はベクトルの代わりにNoneを返す
+        """
+        text = embedding_text(restaurant)
+        if existing_item.get("content_hash") != content_hash(text) or (
+            existing_item.get("embedding_model") != embedding_model_version()
+        ):
+            return text, None
+        # 量子化したベクトルを戻したものより、保存しておいた精度を落としていないベクトルを優先する
+        return text, exact_vector(existing_item) or dequantize_vector(existing_item)
+
+
+class RestaurantRepository(BaseRestaurantRepository):
+    """レストランデータを管理するリポジトリクラス"""
+
+    @property
+    def container(self):
+        """コンテナを遅延初期化するプロパティ"""
+        if self._container is None:
+            self._container = self._setup_cosmos_client()
+        return self._container
+
+    def _setup_cosmos_client(self):
+        """Azure Cosmos DBに接続するクライアントを設定する"""
+        client = CosmosClient.from_connection_string(azure_cosmosdb_settings.azure_cosmosdb_connection_string)
+        db = client.get_database_client(azure_cosmosdb_settings.azure_cosmosdb_database_name)
+        container = db.get_container_client(azure_cosmosdb_settings.azure_cosmosdb_container_name)
+        return container
+
+    def list_restaurants(self, limit: int = 10, offset: int = 0) -> list[Restaurant]:
+        """レストラン一覧を取得する（ページネーション対応）"""
+        return self.result_cache.get_or_compute(("list", limit, offset), lambda: self._list_restaurants(limit, offset))
+
+    def _list_restaurants(self, limit: int, offset: int) -> list[Restaurant]:
+        items = list(
+            self.container.query_items(
+                query=_LIST_QUERY, parameters=_page_parameters(limit, offset), enable_cross_partition_query=True
+            )
+        )
+        return [self._cosmos_item_to_restaurant(item) for item in items]
+
+    def list_restaurants_after(self, cursor: str | None = None, limit: int = 10) -> tuple[list[Restaurant], str | None]:
+        """
+        レストラン一覧をカーソルの続きから取得する
+
+        CosmosDBの継続トークンでページをたどるため、OFFSETと違い深いページでもコストが増えない。
+        ページと次のページのカーソル（最後のページではNone）を返す
+        """
+        continuation = decode_cursor(cursor, ("list",)).get("c")
+        return self.result_cache.get_or_compute(
+            ("list_after", continuation, limit), lambda: self._list_restaurants_after(continuation, limit)
+        )
+
+    def _list_restaurants_after(self, continuation: str | None, limit: int) -> tuple[list[Restaurant], str | None]:
+        items, continuation = self._query_page(_ALL_QUERY, None, limit, continuation)
+        return self._continued_page(("list",), items, continuation)
+
+    def _query_page(
+        self, query: str, parameters: list[dict] | None, limit: int, continuation: str | None
+    ) -> tuple[list[dict], str | None]:
+        """クエリ結果の1ページ分と、続きを取得する継続トークンを返す"""
+        pager = self.container.query_items(
+            query=query, parameters=parameters, enable_cross_partition_query=True, max_item_count=limit
+        ).by_page(continuation)
+        items = list(next(pager, []))
+        return items, pager.continuation_token
+
+    def scan_embedding_states(
+        self, page_size: int = 100, continuation: str | None = None
+    ) -> Iterator[tuple[list[dict], str | None]]:
+        """
+        埋め込みの鮮度の確認に必要なフィールドを、ページ単位でストリーム読み出しする
+
+        ページとともに、そのページの続きから読み出しを再開できる継続トークン（最後のページではNone）を返す
+        """
+        pager = self.container.query_items(
+            query=_EMBEDDING_STATE_QUERY, enable_cross_partition_query=True, max_item_count=page_size
+        ).by_page(continuation)
+        for page in pager:
+            yield list(page), pager.continuation_token
+
+    def reembed_items(self, items: list[dict]) -> list[dict]:
+        """アイテムのベクトルを今の埋め込みモデルでまとめて生成し直した、書き戻すアイテムを返す"""
+        restaurants = [self._cosmos_item_to_restaurant(item) for item in items]
+        vector_embeddings = self._get_embeddings_many([embedding_text(restaurant) for restaurant in restaurants])
+        return [
+            self._restaurant_to_cosmos_item(restaurant, vector_embedding)
+            for restaurant, vector_embedding in zip(restaurants, vector_embeddings)
+        ]
+
+    def get_restaurant(self, restaurant_id: str) -> Restaurant:
+        """指定されたIDのレストラン情報を取得する（キャッシュ済みならETagで再検証する）"""
+        return self.item_cache.get(
+            restaurant_id,
+            lambda etag: self._read_result(
+                self.container.read_item(item=restaurant_id, partition_key=restaurant_id, **self._if_none_match(etag))
+            ),
+        )
+
+    def create_restaurant(self, restaurant: Restaurant) -> Restaurant:
+        """新しいレストランを作成する"""
+        return self.create_restaurants([restaurant])[0]
+
+    def create_restaurants(self, restaurants: list[Restaurant]) -> list[Restaurant]:
+        """複数のレストランを作成する（ベクトル埋め込みはまとめて生成する）"""
+        created_items = [self.container.create_item(body=item) for item in self.to_cosmos_items(restaurants)]
+        self._after_write(created_items)
+        return [self._cosmos_item_to_restaurant(item) for item in created_items]
+
+    def to_cosmos_items(self, restaurants: list[Restaurant]) -> list[dict]:
+        """レストランをベクトル埋め込み付きのCosmosDBアイテムに変換する（埋め込みはまとめて生成する）"""
+        vector_embeddings = self._get_embeddings_many(self._assign_ids(restaurants))
+        return [
+            self._restaurant_to_cosmos_item(restaurant, vector_embedding)
+            for restaurant, vector_embedding in zip(restaurants, vector_embeddings)
+        ]
 
     def update_restaurant(self, restaurant_id: str, restaurant: Restaurant) -> Restaurant:
         """既存のレストラン情報を更新する"""
@@ -113,72 +539,371 @@ class RestaurantRepository:
         existing_item = self.container.read_item(item=restaurant_id, partition_key=restaurant_id)
 
         # 説明文が変更された場合、新しいベクトル埋め込みを生成
-        description = restaurant.description or restaurant.name
-        if description != (existing_item.get("description") or existing_item.get("name")):
+        description, vector_embedding = self._embedding_for_update(restaurant, existing_item)
+        if vector_embedding is None:
             vector_embedding = self._get_embeddings(description)
-        else:
-            vector_embedding = existing_item.get("vector")
-
-        # 位置情報の構築
-        location = None
-        if restaurant.latitude is not None and restaurant.longitude is not None:
-            location = {"type": "Point", "coordinates": [restaurant.longitude, restaurant.latitude]}
-
-        # 更新するアイテムの作成
-        updated_item = {
-            "id": restaurant_id,
-            "name": restaurant.name,
-            "description": restaurant.description,
-            "price": restaurant.price,
-            "tags": restaurant.tags,
-            "vector": vector_embedding,
-        }
-
-        if location:
-            updated_item["location"] = location
 
         # CosmosDBのアイテムを更新
+        updated_item = self._restaurant_to_cosmos_item(
+            restaurant.model_copy(update={"id": restaurant_id}), vector_embedding
+        )
         result = self.container.replace_item(item=restaurant_id, body=updated_item)
+        self._after_write([result])
         return self._cosmos_item_to_restaurant(result)
 
     def delete_restaurant(self, restaurant_id: str) -> None:
         """指定されたIDのレストランを削除する"""
         self.container.delete_item(item=restaurant_id, partition_key=restaurant_id)
+        self._after_delete(restaurant_id)
 
     def search_restaurants(self, query: str, k: int = 3, offset: int = 0) -> list[Restaurant]:
         """キーワードによるレストランのベクトル検索を実行する（ページネーション対応）"""
+        query = normalize_query(query)
+        return self.result_cache.get_or_compute(
+            ("search", query, k, offset), lambda: self._search_restaurants(query, k, offset)
+        )
+
+    def _search_restaurants(self, query: str, k: int, offset: int) -> list[Restaurant]:
         # クエリテキストのベクトル埋め込みを生成
         query_embedding = self._get_embeddings(query)
+        if self.vector_index is not None:
+            self._load_local_indexes()
+            return self.vector_index.search(query_embedding, k, offset)
+
+        if _reranks():
+            parameters = _search_top_parameters(query_embedding, self._rerank_candidates(k, offset))
+            candidates = self.container.query_items(
+                query=_SEARCH_RERANK_QUERY, parameters=parameters, enable_cross_partition_query=True
+            )
+            items = self._rerank(list(candidates), query_embedding)[offset : offset + k]
+        else:
+            parameters = [{"name": "@queryVector", "value": query_embedding}, *_page_parameters(k, offset)]
+            items = list(
+                self.container.query_items(
+                    query=_SEARCH_QUERY, parameters=parameters, enable_cross_partition_query=True
+                )
+            )
+        return [self._cosmos_item_to_restaurant(item) for item in items]
 
-        # ベクトル検索クエリの実行（オフセットとリミットを適用）
-        query_text = f"""
-        SELECT *
-        FROM c
-        ORDER BY VectorDistance(c.vector, @queryVector)
-        OFFSET {offset} LIMIT {k}
-        """
+    def search_restaurants_after(
+        self, query: str, cursor: str | None = None, k: int = 3
+    ) -> tuple[list[Restaurant], str | None]:
+        """キーワードによるベクトル検索の結果をカーソルの続きから取得する（継続トークンによるページネーション）"""
+        query = normalize_query(query)
+        position = decode_cursor(cursor, ("search", query))
+        return self.result_cache.get_or_compute(
+            ("search_after", query, cursor or "", k), lambda: self._search_restaurants_after(query, position, k)
+        )
 
-        parameters = [{"name": "@queryVector", "value": query_embedding}]
-        items = list(
-            self.container.query_items(query=query_text, parameters=parameters, enable_cross_partition_query=True)
+    def _search_restaurants_after(self, query: str, position: dict, k: int) -> tuple[list[Restaurant], str | None]:
+        query_embedding = self._get_embeddings(query)
+        if self.vector_index is not None:
+            # ローカルのインデックスではオフセットのコストが小さいため、カーソルにオフセットを持たせる
+            self._load_local_indexes()
+            offset = position.get("o", 0)
+            return self._page(("search", query), self.vector_index.search(query_embedding, k + 1, offset), offset, k)
+
+        items, continuation = self._query_page(
+            _search_top_query(), _search_top_parameters(query_embedding), k, position.get("c")
         )
-        return [self._cosmos_item_to_restaurant(item) for item in items]
+        if _reranks():
+            # 継続トークンの位置はCosmosDBの順位で決まるため、ページの中だけを並べ替える
+            items = self._rerank(items, query_embedding)
+        return self._continued_page(("search", query), items, continuation)
+
+    def _load_local_indexes(self) -> None:
+        """初回の検索時に全レストランをローカルのインデックスに読み込む"""
+        if self._unloaded_indexes():
+            self._load_indexes(list(self.container.query_items(query=_INDEX_QUERY, enable_cross_partition_query=True)))
 
     def find_nearby_restaurants(
         self, latitude: float, longitude: float, distance_km: float = 5.0, limit: int = 10, offset: int = 0
-    ) -> list[Restaurant]:
-        """指定した位置の近くにあるレストランを検索する（ページネーション対応）"""
-        # 地理空間クエリの実行（メートル単位で距離を指定）
-        distance_meters = distance_km * 1000
-        query_text = f"""
-        SELECT *
-        FROM c
-        WHERE ST_DISTANCE(c.location, {{
-            "type": "Point",
-            "coordinates": [{longitude}, {latitude}]
-        }}) < {distance_meters}
-        OFFSET {offset} LIMIT {limit}
+    ) -> list[NearbyRestaurant]:
+        """指定した位置の近くにあるレストランを距離の近い順に検索する（ページネーション対応）"""
+        key = self._nearby_key(latitude, longitude, distance_km, limit, offset)
+        return self.result_cache.get_or_compute(key, lambda: self._find_nearby_restaurants(*key[1:]))
+
+    def _find_nearby_restaurants(
+        self, latitude: float, longitude: float, distance_km: float, limit: int, offset: int
+    ) -> list[NearbyRestaurant]:
+        if self.geo_index is not None:
+            self._load_local_indexes()
+            return [_nearby(*entry) for entry in self.geo_index.search(latitude, longitude, distance_km, limit, offset)]
+
+        items = self.container.query_items(
+            query=_NEARBY_QUERY,
+            parameters=_nearby_parameters(latitude, longitude, distance_km),
+            enable_cross_partition_query=True,
+        )
+        return self._sort_by_distance(list(items), latitude, longitude, limit, offset)
+
+    def find_nearby_restaurants_after(
+        self, latitude: float, longitude: float, cursor: str | None = None, distance_km: float = 5.0, limit: int = 10
+    ) -> tuple[list[NearbyRestaurant], str | None]:
+        """近くにあるレストランを距離の近い順に、カーソルの続きから取得する"""
+        query = self._nearby_key(latitude, longitude, distance_km, 0, 0)[:4]
+        offset = decode_cursor(cursor, query).get("o", 0)
+        return self._page(
+            query, self.find_nearby_restaurants(latitude, longitude, distance_km, limit + 1, offset), offset, limit
+        )
+
+
+class AsyncRestaurantRepository(BaseRestaurantRepository):
+    """
+    azure.cosmos.aioを使う非同期版のレストランリポジトリ
+
+    CosmosDBへの往復を待つ間もイベントループを塞がないため、遅いクエリが同じワーカーの
+    他のリクエストを止めない。クライアントは1つだけ作り、アプリのlifespanで`open`・`close`する。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._client = None
+        # write-behindの場合に、書き込んだレストランをバックグラウンドで埋め込むワーカープール
+        self.embedding_worker = None
+        if restaurants_settings.restaurant_embedding_mode == "write_behind":
+            self.embedding_worker = EmbeddingWriteBehind(
+                self._aget_embeddings_many,
+                self.apply_embedding,
+                workers=restaurants_settings.restaurant_embedding_workers,
+                batch_size=embeddings_settings.embedding_batch_size,
+                max_retries=restaurants_settings.restaurant_embedding_max_retries,
+                retry_backoff=restaurants_settings.restaurant_embedding_retry_backoff_seconds,
+            )
+
+    async def open(self) -> None:
+        """CosmosDBのクライアントを作成する（接続は最初のリクエストで確立される）"""
+        if self._container is not None:
+            return
+        self._client = AsyncCosmosClient.from_connection_string(
+            azure_cosmosdb_settings.azure_cosmosdb_connection_string
+        )
+        db = self._client.get_database_client(azure_cosmosdb_settings.azure_cosmosdb_database_name)
+        self._container = db.get_container_client(azure_cosmosdb_settings.azure_cosmosdb_container_name)
+
+    async def close(self) -> None:
+        """埋め込みを待つレストランを処理してから、クライアントの接続プールを閉じる"""
+        if self.embedding_worker is not None:
+            await self.embedding_worker.stop()
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+            self._container = None
+
+    async def get_container(self):
+        """コンテナを返す（lifespanの外で使われた場合はここでクライアントを作成する）"""
+        if self._container is None:
+            await self.open()
+        return self._container
+
+    async def _query(self, query: str, parameters: list[dict] | None = None) -> list[Restaurant]:
+        container = await self.get_container()
+        return [
+            self._cosmos_item_to_restaurant(item)
+            async for item in container.query_items(query=query, parameters=parameters)
+        ]
+
+    async def list_restaurants(self, limit: int = 10, offset: int = 0) -> list[Restaurant]:
+        """レストラン一覧を取得する（ページネーション対応）"""
+        return await self.result_cache.aget_or_compute(
+            ("list", limit, offset), lambda: self._query(_LIST_QUERY, _page_parameters(limit, offset))
+        )
+
+    async def list_restaurants_after(
+        self, cursor: str | None = None, limit: int = 10
+    ) -> tuple[list[Restaurant], str | None]:
+        """レストラン一覧をカーソルの続きから取得する（継続トークンによるページネーション）"""
+        continuation = decode_cursor(cursor, ("list",)).get("c")
+        return await self.result_cache.aget_or_compute(
+            ("list_after", continuation, limit), lambda: self._list_restaurants_after(continuation, limit)
+        )
+
+    async def _list_restaurants_after(
+        self, continuation: str | None, limit: int
+    ) -> tuple[list[Restaurant], str | None]:
+        items, continuation = await self._query_page(_ALL_QUERY, None, limit, continuation)
+        return self._continued_page(("list",), items, continuation)
+
+    async def _query_page(
+        self, query: str, parameters: list[dict] | None, limit: int, continuation: str | None
+    ) -> tuple[list[dict], str | None]:
+        """クエリ結果の1ページ分と、続きを取得する継続トークンを返す"""
+        container = await self.get_container()
+        pager = container.query_items(query=query, parameters=parameters, max_item_count=limit).by_page(continuation)
+        items = []
+        async for page in pager:
+            items = [item async for item in page]
+            break
+        return items, pager.continuation_token
+
+    async def get_restaurant(self, restaurant_id: str) -> Restaurant:
+        """指定されたIDのレストラン情報を取得する（キャッシュ済みならETagで再検証する）"""
+        return await self.item_cache.aget(restaurant_id, lambda etag: self._aread_item(restaurant_id, etag))
+
+    async def _aread_item(self, restaurant_id: str, etag: str | None) -> tuple[str | None, Restaurant] | None:
+        container = await self.get_container()
+        item = await container.read_item(item=restaurant_id, partition_key=restaurant_id, **self._if_none_match(etag))
+        return self._read_result(item)
+
+    async def create_restaurant(self, restaurant: Restaurant) -> Restaurant:
+        """新しいレストランを作成する（write-behindの場合は埋め込みを待たずに書き込む）"""
+        (text,) = self._assign_ids([restaurant])
+        vector_embedding = None
+        if self.embedding_worker is None:
+            (vector_embedding,) = await self._aget_embeddings_many([text])
+        container = await self.get_container()
+        created_item = await container.create_item(body=self._restaurant_to_cosmos_item(restaurant, vector_embedding))
+        self._after_write([created_item])
+        self._embed_later(created_item, text)
+        return self._cosmos_item_to_restaurant(created_item)
+
+    async def update_restaurant(self, restaurant_id: str, restaurant: Restaurant) -> Restaurant:
+        """既存のレストラン情報を更新する"""
+        container = await self.get_container()
+        existing_item = await container.read_item(item=restaurant_id, partition_key=restaurant_id)
+
+        # 説明文が変更された場合、新しいベクトル埋め込みを生成（write-behindの場合は書き込み後に生成）
+        description, vector_embedding = self._embedding_for_update(restaurant, existing_item)
+        if vector_embedding is None and self.embedding_worker is None:
+            (vector_embedding,) = await self._aget_embeddings_many([description])
+
+        updated_item = self._restaurant_to_cosmos_item(
+            restaurant.model_copy(update={"id": restaurant_id}), vector_embedding
+        )
+        result = await container.replace_item(item=restaurant_id, body=updated_item)
+        self._after_write([result])
+        self._embed_later(result, description)
+        return self._cosmos_item_to_restaurant(result)
+
+    def _embed_later(self, item: dict, text: str) -> None:
+        if item.get("vector_status") == "pending":
+            self.embedding_worker.enqueue(EmbeddingJob(item["id"], text, item["content_hash"]))
+
+    async def apply_embedding(self, job: EmbeddingJob, vector_embedding: list[float]) -> bool:
         """
+        write-behindで生成したベクトルをアイテムにパッチする
 
-        items = list(self.container.query_items(query=query_text, enable_cross_partition_query=True))
-        return [self._cosmos_item_to_restaurant(item) for item in items]
+        埋め込んだテキストのハッシュを条件にするため、その間にテキストが変更・削除されたアイテムには
+        書き込まずFalseを返す（変更後のテキストは別のジョブが埋め込む）。
+        ハッシュは条件の文字列に埋め込むため、`content_hash`の形式でなければValueErrorを送出する
+        """
+        if not _CONTENT_HASH_PATTERN.fullmatch(job.content_hash):
+            raise ValueError(f"Invalid content hash for restaurant {job.restaurant_id}: {job.content_hash!r}")
+        operations = [
+            {"op": "set", "path": f"/{field}", "value": value}
+            for field, value in quantize_vector(
+                vector_embedding, restaurants_settings.restaurant_vector_storage, exact=_reranks()
+            ).items()
+        ]
+        operations.append({"op": "remove", "path": "/vector_status"})
+        container = await self.get_container()
+        try:
+            item = await container.patch_item(
+                item=job.restaurant_id,
+                partition_key=job.restaurant_id,
+                patch_operations=operations,
+                filter_predicate=f'FROM c WHERE c.content_hash = "{job.content_hash}"',
+            )
+        except (CosmosAccessConditionFailedError, CosmosResourceNotFoundError):
+            return False
+        self._after_write([item])
+        return True
+
+    async def delete_restaurant(self, restaurant_id: str) -> None:
+        """指定されたIDのレストランを削除する"""
+        container = await self.get_container()
+        await container.delete_item(item=restaurant_id, partition_key=restaurant_id)
+        self._after_delete(restaurant_id)
+
+    async def search_restaurants(self, query: str, k: int = 3, offset: int = 0) -> list[Restaurant]:
+        """キーワードによるレストランのベクトル検索を実行する（ページネーション対応）"""
+        query = normalize_query(query)
+        return await self.result_cache.aget_or_compute(
+            ("search", query, k, offset), lambda: self._search_restaurants(query, k, offset)
+        )
+
+    async def _search_restaurants(self, query: str, k: int, offset: int) -> list[Restaurant]:
+        (query_embedding,) = await self._aget_embeddings_many([query])
+        if self.vector_index is not None:
+            await self._load_local_indexes()
+            return self.vector_index.search(query_embedding, k, offset)
+        if _reranks():
+            container = await self.get_container()
+            parameters = _search_top_parameters(query_embedding, self._rerank_candidates(k, offset))
+            candidates = [
+                item async for item in container.query_items(query=_SEARCH_RERANK_QUERY, parameters=parameters)
+            ]
+            items = self._rerank(candidates, query_embedding)[offset : offset + k]
+            return [self._cosmos_item_to_restaurant(item) for item in items]
+        return await self._query(
+            _SEARCH_QUERY, [{"name": "@queryVector", "value": query_embedding}, *_page_parameters(k, offset)]
+        )
+
+    async def search_restaurants_after(
+        self, query: str, cursor: str | None = None, k: int = 3
+    ) -> tuple[list[Restaurant], str | None]:
+        """キーワードによるベクトル検索の結果をカーソルの続きから取得する（継続トークンによるページネーション）"""
+        query = normalize_query(query)
+        position = decode_cursor(cursor, ("search", query))
+        return await self.result_cache.aget_or_compute(
+            ("search_after", query, cursor or "", k), lambda: self._search_restaurants_after(query, position, k)
+        )
+
+    async def _search_restaurants_after(
+        self, query: str, position: dict, k: int
+    ) -> tuple[list[Restaurant], str | None]:
+        (query_embedding,) = await self._aget_embeddings_many([query])
+        if self.vector_index is not None:
+            await self._load_local_indexes()
+            offset = position.get("o", 0)
+            return self._page(("search", query), self.vector_index.search(query_embedding, k + 1, offset), offset, k)
+
+        items, continuation = await self._query_page(
+            _search_top_query(), _search_top_parameters(query_embedding), k, position.get("c")
+        )
+        if _reranks():
+            # 継続トークンの位置はCosmosDBの順位で決まるため、ページの中だけを並べ替える
+            items = self._rerank(items, query_embedding)
+        return self._continued_page(("search", query), items, continuation)
+
+    async def find_nearby_restaurants(
+        self, latitude: float, longitude: float, distance_km: float = 5.0, limit: int = 10, offset: int = 0
+    ) -> list[NearbyRestaurant]:
+        """指定した位置の近くにあるレストランを距離の近い順に検索する（ページネーション対応）"""
+        key = self._nearby_key(latitude, longitude, distance_km, limit, offset)
+        return await self.result_cache.aget_or_compute(key, lambda: self._find_nearby_restaurants(*key[1:]))
+
+    async def _find_nearby_restaurants(
+        self, latitude: float, longitude: float, distance_km: float, limit: int, offset: int
+    ) -> list[NearbyRestaurant]:
+        if self.geo_index is not None:
+            await self._load_local_indexes()
+            return [_nearby(*entry) for entry in self.geo_index.search(latitude, longitude, distance_km, limit, offset)]
+
+        container = await self.get_container()
+        parameters = _nearby_parameters(latitude, longitude, distance_km)
+        items = [item async for item in container.query_items(query=_NEARBY_QUERY, parameters=parameters)]
+        return self._sort_by_distance(items, latitude, longitude, limit, offset)
+
+    async def find_nearby_restaurants_after(
+        self, latitude: float, longitude: float, cursor: str | None = None, distance_km: float = 5.0, limit: int = 10
+    ) -> tuple[list[NearbyRestaurant], str | None]:
+        """近くにあるレストランを距離の近い順に、カーソルの続きから取得する"""
+        query = self._nearby_key(latitude, longitude, distance_km, 0, 0)[:4]
+        offset = decode_cursor(cursor, query).get("o", 0)
+        return self._page(
+            query,
+            await self.find_nearby_restaurants(latitude, longitude, distance_km, limit + 1, offset),
+            offset,
+            limit,
+        )
+
+    async def _load_local_indexes(self) -> None:
+        """初回の検索時に全レストランをローカルのインデックスに読み込む"""
+        if self._unloaded_indexes():
+            container = await self.get_container()
+            self._load_indexes([item async for item in container.query_items(query=_INDEX_QUERY)])
+
+
+def _nearby(restaurant: Restaurant, distance_km: float) -> NearbyRestaurant:
+    return NearbyRestaurant.model_validate({**restaurant.model_dump(), "distance_km": distance_km})
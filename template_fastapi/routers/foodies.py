@@ -1,26 +1,72 @@
 from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
 
-from template_fastapi.models.restaurant import Restaurant
-from template_fastapi.repositories.restaurants import RestaurantRepository
+from template_fastapi.models.restaurant import NearbyRestaurant, NearbyRestaurantPage, Restaurant, RestaurantPage
+from template_fastapi.repositories.restaurants import AsyncRestaurantRepository, InvalidCursorError
 
+# CosmosDBにはazure.cosmos.aioの非同期クライアントでアクセスし、待ち時間の間もイベントループを塞がない。
+# クライアントはアプリのlifespanで開閉する。同時に届いたリクエストの埋め込み要求は1回のAPI呼び出しにまとめられる
 router = APIRouter()
-restaurant_repo = RestaurantRepository()
+restaurant_repo = AsyncRestaurantRepository()
+
+FIELDS_DESCRIPTION = "返すフィールドをカンマ区切りで指定する（例: id,name,price）。省略するとすべてのフィールドを返す"
+
+
+def parse_fields(fields: str | None, model: type[BaseModel]) -> set[str] | None:
+    """`fields`クエリパラメーターを、レスポンスに含めるフィールド名の集合に変換する"""
+    if fields is None:
+        return None
+    selected = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = selected - model.model_fields.keys()
+    if not selected or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"不明なフィールドです: {', '.join(sorted(unknown)) or fields}（指定できるフィールド: "
+            f"{', '.join(model.model_fields)}）",
+        )
+    return selected
+
+
+def sparse_response(content: list[BaseModel] | BaseModel, fields: set[str] | None):
+    """`fields`が指定された場合は、指定されたフィールドだけを含むレスポンスを返す"""
+    if fields is None:
+        return content
+    if isinstance(content, list):
+        return JSONResponse([model.model_dump(mode="json", include=fields) for model in content])
+    # ページの場合はレストランのフィールドだけを絞り、next_cursorは常に返す
+    return JSONResponse(
+        content.model_dump(mode="json", include={"restaurants": {"__all__": fields}, "next_cursor": True})
+    )
 
 
 @router.get(
     "/restaurants/",
-    response_model=list[Restaurant],
+    response_model=list[Restaurant] | RestaurantPage,
     operation_id="list_foodies_restaurants",
 )
 async def list_foodies_restaurants(
     limit: int = Query(10, description="取得する最大件数"),
     offset: int = Query(0, description="スキップする件数（ページネーション用）"),
-) -> list[Restaurant]:
+    cursor: str | None = Query(
+        None, description="前のページのnext_cursor（継続トークンによるページネーション）。空文字列で先頭から取得する"
+    ),
+    fields: str | None = Query(None, description=FIELDS_DESCRIPTION),
+) -> list[Restaurant] | RestaurantPage | JSONResponse:
     """
     レストラン一覧を取得する（ページネーション対応）
+
+    `cursor`を指定すると、`next_cursor`付きのページを返す。深いページでもOFFSETのようにコストが増えない。
+    `fields`を指定すると、指定したフィールドだけを返す
     """
+    selected = parse_fields(fields, Restaurant)
     try:
-        return restaurant_repo.list_restaurants(limit, offset)
+        if cursor is None:
+            return sparse_response(await restaurant_repo.list_restaurants(limit, offset), selected)
+        restaurants, next_cursor = await restaurant_repo.list_restaurants_after(cursor, limit)
+        return sparse_response(RestaurantPage(restaurants=restaurants, next_cursor=next_cursor), selected)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"データの取得に失敗しました: {str(e)}")
 
@@ -35,7 +81,7 @@ async def get_foodies_restaurant(restaurant_id: str) -> Restaurant:
     指定されたIDのレストラン情報を取得する
     """
     try:
-        return restaurant_repo.get_restaurant(restaurant_id)
+        return await restaurant_repo.get_restaurant(restaurant_id)
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"ID {restaurant_id} のレストランが見つかりません: {str(e)}")
 
@@ -50,7 +96,7 @@ async def create_foodies_restaurant(restaurant: Restaurant) -> Restaurant:
     新しいレストランを作成する
     """
     try:
-        return restaurant_repo.create_restaurant(restaurant)
+        return await restaurant_repo.create_restaurant(restaurant)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"レストランの作成に失敗しました: {str(e)}")
 
@@ -66,7 +112,7 @@ async def update_foodies_restaurant(restaurant_id: str, restaurant: Restaurant)
     """
     try:
         try:
-            return restaurant_repo.update_restaurant(restaurant_id, restaurant)
+            return await restaurant_repo.update_restaurant(restaurant_id, restaurant)
         except Exception as e:
             if "Resource with specified id does not exist" in str(e):
                 raise HTTPException(status_code=404, detail=f"ID {restaurant_id} のレストランが見つかりません")
@@ -86,7 +132,7 @@ async def delete_foodies_restaurant(restaurant_id: str) -> dict:
     指定されたIDのレストランを削除する
     """
     try:
-        restaurant_repo.delete_restaurant(restaurant_id)
+        await restaurant_repo.delete_restaurant(restaurant_id)
         return {"message": f"ID {restaurant_id} のレストランを削除しました"}
     except Exception as e:
         raise HTTPException(status_code=404, detail=f"ID {restaurant_id} のレストランの削除に失敗しました: {str(e)}")
@@ -94,26 +140,38 @@ async def delete_foodies_restaurant(restaurant_id: str) -> dict:
 
 @router.get(
     "/restaurants/search/",
-    response_model=list[Restaurant],
+    response_model=list[Restaurant] | RestaurantPage,
     operation_id="search_foodies_restaurants",
 )
 async def search_foodies_restaurants(
     query: str,
     k: int = Query(3, description="取得する上位結果の数"),
     offset: int = Query(0, description="スキップする件数（ページネーション用）"),
-) -> list[Restaurant]:
+    cursor: str | None = Query(
+        None, description="前のページのnext_cursor（継続トークンによるページネーション）。空文字列で先頭から取得する"
+    ),
+    fields: str | None = Query(None, description=FIELDS_DESCRIPTION),
+) -> list[Restaurant] | RestaurantPage | JSONResponse:
     """
     キーワードによるレストランのベクトル検索を実行する（ページネーション対応）
+
+    `cursor`を指定すると、`next_cursor`付きのページを返す。`fields`を指定すると、指定したフィールドだけを返す
     """
+    selected = parse_fields(fields, Restaurant)
     try:
-        return restaurant_repo.search_restaurants(query, k, offset)
+        if cursor is None:
+            return sparse_response(await restaurant_repo.search_restaurants(query, k, offset), selected)
+        restaurants, next_cursor = await restaurant_repo.search_restaurants_after(query, cursor, k)
+        return sparse_response(RestaurantPage(restaurants=restaurants, next_cursor=next_cursor), selected)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"検索に失敗しました: {str(e)}")
 
 
 @router.get(
     "/restaurants/near/",
-    response_model=list[Restaurant],
+    response_model=list[NearbyRestaurant] | NearbyRestaurantPage,
     operation_id="find_nearby_restaurants",
 )
 async def find_nearby_restaurants(
@@ -122,11 +180,27 @@ async def find_nearby_restaurants(
     distance_km: float = Query(5.0, description="検索半径（キロメートル）"),
     limit: int = Query(10, description="取得する最大件数"),
     offset: int = Query(0, description="スキップする件数（ページネーション用）"),
-) -> list[Restaurant]:
+    cursor: str | None = Query(
+        None, description="前のページのnext_cursor（継続トークンによるページネーション）。空文字列で先頭から取得する"
+    ),
+    fields: str | None = Query(None, description=FIELDS_DESCRIPTION),
+) -> list[NearbyRestaurant] | NearbyRestaurantPage | JSONResponse:
     """
-    指定した位置の近くにあるレストランを検索する（ページネーション対応）
+    指定した位置の近くにあるレストランを距離（distance_km）の近い順に検索する（ページネーション対応）
+
+    `cursor`を指定すると、`next_cursor`付きのページを返す。`fields`を指定すると、指定したフィールドだけを返す
     """
+    selected = parse_fields(fields, NearbyRestaurant)
     try:
-        return restaurant_repo.find_nearby_restaurants(latitude, longitude, distance_km, limit, offset)
+        if cursor is None:
+            return sparse_response(
+                await restaurant_repo.find_nearby_restaurants(latitude, longitude, distance_km, limit, offset), selected
+            )
+        restaurants, next_cursor = await restaurant_repo.find_nearby_restaurants_after(
+            latitude, longitude, cursor, distance_km, limit
+        )
+        return sparse_response(NearbyRestaurantPage(restaurants=restaurants, next_cursor=next_cursor), selected)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"位置検索に失敗しました: {str(e)}")
@@ -1,19 +1,300 @@
-from fastapi import APIRouter, HTTPException, Query
+import json
+from collections import defaultdict
+from collections.abc import AsyncIterator
 
-from template_fastapi.models.item import Item
-from template_fastapi.repositories.items import items_db
+from fastapi import APIRouter, Header, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import TypeAdapter, ValidationError
+
+from template_fastapi.models.item import Item, ItemBulkResponse, ItemBulkResult, ItemFacets, ItemPage
+from template_fastapi.repositories.item_changes import ExpiredSequenceError
+from template_fastapi.repositories.items import (
+    PRICE_BUCKET_EDGES,
+    InvalidCursorError,
+    ItemSort,
+    item_changes,
+    item_repo,
+)
 
 router = APIRouter()
 
+# Validators are built once and reused, so each bulk request is validated in a single pass
+items_adapter = TypeAdapter(list[Item])
+item_ids_adapter = TypeAdapter(list[int])
+
+# An idle change feed sends a comment this often, so proxies keep it open and dead clients are noticed
+CHANGE_FEED_KEEPALIVE_SECONDS = 15.0
+
+
+def bulk_body_schema(item_schema: dict) -> dict:
+    """OpenAPI request body accepting a JSON array or NDJSON rows."""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {"schema": {"type": "array", "items": item_schema}},
+                "application/x-ndjson": {"schema": item_schema},
+            },
+        }
+    }
+
+
+class BulkRequestError(Exception):
+    """Raised when a bulk request is rejected without applying any row."""
+
+    def __init__(self, status_code: int, results: list[ItemBulkResult]):
+        self.status_code = status_code
+        self.results = results
+
+
+async def read_bulk_rows(request: Request, adapter: TypeAdapter) -> list:
+    """
+    Validate a bulk request body in one pass.
+
+    NDJSON bodies are joined into a single JSON array first. Raises a 422
+    error with per-row results if any row is invalid.
+    """
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        body = b"[" + b",".join(line for line in body.splitlines() if line.strip()) + b"]"
+
+    try:
+        return adapter.validate_json(body)
+    except ValidationError as e:
+        errors_by_row: dict[int, list[str]] = defaultdict(list)
+        for error in e.errors(include_url=False):
+            location = error["loc"]
+            if not location or not isinstance(location[0], int):
+                raise HTTPException(status_code=400, detail=f"Invalid bulk request body: {error['msg']}")
+            field = ".".join(str(part) for part in location[1:])
+            errors_by_row[location[0]].append(f"{field}: {error['msg']}" if field else error["msg"])
+        raise BulkRequestError(
+            status_code=422,
+            results=[
+                ItemBulkResult(index=index, status="invalid", errors=errors)
+                for index, errors in sorted(errors_by_row.items())
+            ],
+        )
+
+
+def bulk_error_response(error: BulkRequestError) -> JSONResponse:
+    return JSONResponse(
+        status_code=error.status_code,
+        content=ItemBulkResponse(applied=False, results=error.results).model_dump(),
+    )
+
+
+def items_response(content: bytes) -> Response:
+    """
+    Respond with JSON encoded by the repository.
+
+    Stored items were validated on write and their encodings are cached, so
+    read endpoints skip FastAPI's per-request `response_model` serialisation.
+    """
+    return Response(content=content, media_type="application/json")
+
+
+def reject_duplicate_ids(item_ids: list[int]) -> None:
+    """Reject the whole batch with per-row 422 results if any ID is repeated."""
+    seen: set[int] = set()
+    duplicates = []
+    for index, item_id in enumerate(item_ids):
+        if item_id in seen:
+            duplicates.append(ItemBulkResult(index=index, id=item_id, status="invalid", errors=["Duplicate item ID"]))
+        seen.add(item_id)
+    if duplicates:
+        raise BulkRequestError(status_code=422, results=duplicates)
 
-@router.get("/", response_model=list[Item], operation_id="list_items")
-async def list_items(skip: int = 0, limit: int = 10):
+
+def reject_missing_ids(item_ids: list[int]) -> None:
+    """Reject the whole batch with per-row 404 results if any ID does not exist."""
+    missing = [
+        ItemBulkResult(index=index, id=item_id, status="not_found", errors=["Item not found"])
+        for index, item_id in enumerate(item_ids)
+        if item_id not in item_repo
+    ]
+    if missing:
+        raise BulkRequestError(status_code=404, results=missing)
+
+
+@router.get("/", response_model=list[Item] | ItemPage, operation_id="list_items")
+async def list_items(
+    skip: int = Query(0, ge=0, description="Number of items to skip"),
+    limit: int = Query(10, ge=0, description="Maximum number of items to return"),
+    cursor: str | None = Query(None, description="Opaque cursor from a previous page; pass an empty value to start"),
+    sort: ItemSort | None = Query(None, description="Sort by `id`, `name`, `price` or `-price` (descending)"),
+):
     """
     List all items in the database.
 
-    Returns a list of items, with pagination support.
+    Returns a list of items, with pagination support. When `cursor` is given,
+    items are returned in ascending ID order as a page with a `next_cursor`.
+    """
+    if cursor is None:
+        return items_response(item_repo.encode_items(item_repo.list_items(skip, limit, sort)))
+    if sort not in (None, "id"):
+        raise HTTPException(status_code=400, detail="Cursor pagination only supports sort=id")
+
+    try:
+        items, next_cursor = item_repo.list_items_after(cursor, limit)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return items_response(
+        b'{"items":' + item_repo.encode_items(items) + b',"next_cursor":' + json.dumps(next_cursor).encode() + b"}"
+    )
+
+
+@router.post(
+    "/bulk",
+    response_model=ItemBulkResponse,
+    operation_id="create_items_bulk",
+    openapi_extra=bulk_body_schema({"$ref": "#/components/schemas/Item"}),
+)
+async def create_items_bulk(request: Request):
+    """
+    Create or replace many items at once.
+
+    Accepts a JSON array or NDJSON body. The batch is validated in one pass
+    and applied atomically: if any row is invalid, nothing is written.
+    """
+    try:
+        items = await read_bulk_rows(request, items_adapter)
+    except BulkRequestError as e:
+        return bulk_error_response(e)
+
+    created = item_repo.save_items(items)
+    return ItemBulkResponse(
+        applied=True,
+        results=[
+            ItemBulkResult(index=index, id=item.id, status="created" if is_new else "updated")
+            for index, (item, is_new) in enumerate(zip(items, created))
+        ],
+    )
+
+
+@router.put(
+    "/bulk",
+    response_model=ItemBulkResponse,
+    operation_id="update_items_bulk",
+    openapi_extra=bulk_body_schema({"$ref": "#/components/schemas/Item"}),
+)
+async def update_items_bulk(request: Request):
+    """
+    Update many existing items at once.
+
+    Accepts a JSON array or NDJSON body. If any row is invalid or refers to a
+    missing item, nothing is written.
+    """
+    try:
+        items = await read_bulk_rows(request, items_adapter)
+        reject_missing_ids([item.id for item in items])
+    except BulkRequestError as e:
+        return bulk_error_response(e)
+
+    item_repo.save_items(items)
+    return ItemBulkResponse(
+        applied=True,
+        results=[ItemBulkResult(index=index, id=item.id, status="updated") for index, item in enumerate(items)],
+    )
+
+
+@router.delete(
+    "/bulk",
+    response_model=ItemBulkResponse,
+    operation_id="delete_items_bulk",
+    openapi_extra=bulk_body_schema({"type": "integer"}),
+)
+async def delete_items_bulk(request: Request):
+    """
+    Delete many items at once.
+
+    Accepts a JSON array or NDJSON body of item IDs. If any ID is repeated or
+    does not exist, nothing is deleted.
+    """
+    try:
+        item_ids = await read_bulk_rows(request, item_ids_adapter)
+        reject_duplicate_ids(item_ids)
+        reject_missing_ids(item_ids)
+    except BulkRequestError as e:
+        return bulk_error_response(e)
+
+    item_repo.delete_items(item_ids)
+    return ItemBulkResponse(
+        applied=True,
+        results=[ItemBulkResult(index=index, id=item_id, status="deleted") for index, item_id in enumerate(item_ids)],
+    )
+
+
+@router.get("/facets", response_model=ItemFacets, operation_id="get_item_facets")
+async def get_item_facets(
+    q: str | None = Query(None, description="Search query string"),
+    min_price: float | None = Query(None, description="Minimum price"),
+    max_price: float | None = Query(None, description="Maximum price"),
+    tags: list[str] = Query([], description="Filter by tags"),
+    price_buckets: list[float] = Query(
+        list(PRICE_BUCKET_EDGES), description="Ascending lower bounds of the price buckets; the last is open-ended"
+    ),
+):
     """
-    return list(items_db.values())[skip : skip + limit]
+    Get facet counts for a search.
+
+    Returns the number of matching items per tag and per price bucket, for the
+    same filters as the search endpoint.
+    """
+    try:
+        return item_repo.facets(q=q, min_price=min_price, max_price=max_price, tags=tags, price_edges=price_buckets)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def change_events(sequence: int) -> AsyncIterator[str]:
+    """Encode the changes after a sequence number as Server-Sent Events, as they are published."""
+    while True:
+        try:
+            changes = item_changes.since(sequence)
+        except ExpiredSequenceError as e:
+            # The client fell further behind than the feed retains, so it has to re-list the items
+            yield f"event: expired\ndata: {json.dumps({'detail': str(e)})}\n\n"
+            return
+        if not changes:
+            if not await item_changes.wait(sequence, CHANGE_FEED_KEEPALIVE_SECONDS):
+                yield ": keep-alive\n\n"
+            continue
+        yield "".join(
+            f"id: {item_changes.position(change.sequence)}\nevent: {change.operation}\n"
+            f"data: {change.model_dump_json()}\n\n"
+            for change in changes
+        )
+        sequence = changes[-1].sequence
+
+
+@router.get("/changes", operation_id="stream_item_changes", response_class=StreamingResponse)
+async def stream_item_changes(
+    since: str | None = Query(None, description="Resume after this event ID; defaults to the next change"),
+    last_event_id: str | None = Header(None, description="Event ID sent by a reconnecting EventSource"),
+):
+    """
+    Stream item changes as Server-Sent Events.
+
+    Each `saved` or `deleted` event carries its position, `<epoch>:<sequence>`,
+    as the event ID. Raises a 410 error if the changes to resume from are no
+    longer retained or were numbered before the server restarted, in which
+    case the client should re-list the items.
+    """
+    position = since if since is not None else last_event_id
+    try:
+        sequence = item_changes.sequence if position is None else item_changes.sequence_at(position)
+        item_changes.since(sequence)
+    except ExpiredSequenceError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return StreamingResponse(
+        change_events(sequence),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
 
 
 @router.get("/{item_id}", response_model=Item, operation_id="get_item")
@@ -23,9 +304,10 @@ async def read_item(item_id: int):
 
     Raises a 404 error if the item does not exist.
     """
-    if item_id not in items_db:
+    item = item_repo.get_item(item_id)
+    if item is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    return items_db[item_id]
+    return items_response(item_repo.encode_item(item))
 
 
 @router.post("/", response_model=Item, operation_id="create_item")
@@ -35,8 +317,7 @@ async def create_item(item: Item):
 
     Returns the created item with its assigned ID.
     """
-    items_db[item.id] = item
-    return item
+    return item_repo.save_item(item)
 
 
 @router.put("/{item_id}", response_model=Item, operation_id="update_item")
@@ -46,12 +327,11 @@ async def update_item(item_id: int, item: Item):
 
     Raises a 404 error if the item does not exist.
     """
-    if item_id not in items_db:
+    if item_repo.get_item(item_id) is None:
         raise HTTPException(status_code=404, detail="Item not found")
 
     item.id = item_id
-    items_db[item_id] = item
-    return item
+    return item_repo.save_item(item)
 
 
 @router.delete("/{item_id}", operation_id="delete_item")
@@ -61,10 +341,9 @@ async def delete_item(item_id: int):
 
     Raises a 404 error if the item does not exist.
     """
-    if item_id not in items_db:
+    if not item_repo.delete_item(item_id):
         raise HTTPException(status_code=404, detail="Item not found")
 
-    del items_db[item_id]
     return {"message": "Item deleted successfully"}
 
 
@@ -74,28 +353,19 @@ async def search_items(
     min_price: float | None = Query(None, description="Minimum price"),
     max_price: float | None = Query(None, description="Maximum price"),
     tags: list[str] = Query([], description="Filter by tags"),
+    fuzzy: bool = Query(False, description="Match `q` tolerating typos and rank results by similarity"),
+    limit: int | None = Query(None, ge=1, description="Maximum number of results"),
+    sort: ItemSort | None = Query(None, description="Sort by `id`, `name`, `price` or `-price` (descending)"),
 ):
     """
     Search for items with various filters.
 
-    Returns a list of items that match the search criteria.
+    Returns a list of items that match the search criteria. With `fuzzy`, the
+    best `limit` matches are returned from the most similar, unless `sort`
+    orders them by another field.
     """
-    results = list(items_db.values())
-
-    if q:
-        q = q.lower()
-        results = [
-            item
-            for item in results
-            if q in item.name.lower() or (item.description is not None and q in item.description.lower())
-        ]
-
-    if min_price is not None:
-        results = [item for item in results if item.price >= min_price]
-    if max_price is not None:
-        results = [item for item in results if item.price <= max_price]
-
-    if tags:
-        results = [item for item in results if all(tag in item.tags for tag in tags)]
-
-    return results
+    return items_response(
+        item_repo.encode_search(
+            q=q, min_price=min_price, max_price=max_price, tags=tags, fuzzy=fuzzy, limit=limit, sort=sort
+        )
+    )
@@ -9,6 +9,9 @@ class Settings(BaseSettings):
     azure_openai_api_version: str = "2024-10-21"
     azure_openai_model_chat: str = "gpt-4o"
     azure_openai_model_embedding: str = "text-embedding-3-small"
+    azure_openai_embedding_dimensions: int | None = None
+    # 2段階のベクトル検索で、1段目の候補選びに使う埋め込みの先頭の次元数（Noneの場合は全次元で1回だけ検索する）
+    azure_openai_embedding_search_dimensions: int | None = None
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -0,0 +1,45 @@
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    embedding_cache_memory_size: int = Field(
+        default=1024,
+        description="Number of embeddings kept in the in-process LRU cache; 0 disables it",
+    )
+    embedding_cache_path: str = Field(
+        default=str(Path(tempfile.gettempdir()) / "template-fastapi-embeddings.sqlite3"),
+        description="SQLite file of the on-disk embedding cache, shared by all workers",
+    )
+    embedding_cache_disk_size: int = Field(
+        default=100000,
+        description="Number of embeddings kept in the on-disk cache; 0 disables it",
+    )
+
+    embedding_batch_size: int = Field(
+        default=64,
+        description="Maximum number of texts coalesced into one embedding API call",
+    )
+    embedding_batch_wait_ms: float = Field(
+        default=10.0,
+        description="How long a batch waits for more concurrent requests after the first one arrives",
+    )
+    embedding_batch_concurrency: int = Field(
+        default=4,
+        description="Maximum number of embedding API calls in flight at once",
+    )
+
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_ignore_empty=True,
+        extra="ignore",
+    )
+
+
+@lru_cache
+def get_embeddings_settings() -> Settings:
+    return Settings()
@@ -0,0 +1,47 @@
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Literal
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    items_store: Literal["dict", "columnar", "shared"] = Field(
+        default="dict",
+        description=(
+            "Backend of the items store: `dict` of pydantic models, NumPy-backed `columnar`, "
+            "or `shared` memory-mapped file shared by all workers. `columnar` answers price and tag "
+            "filters several times faster once results have been served, but builds an Item for each "
+            "row it returns that was not served since its last write, and is slower on sorted top-N searches"
+        ),
+    )
+    items_shared_path: str = Field(
+        default=str(Path(tempfile.gettempdir()) / "template-fastapi-items.heap"),
+        description="File backing the `shared` items store; every worker of a deployment must use the same path",
+    )
+    items_data_dir: str | None = Field(
+        default=None,
+        description="Directory for the items snapshot and operation log; the store is in-memory only when unset",
+    )
+    items_snapshot_interval: int = Field(
+        default=10000,
+        description="Number of logged operations after which a compacted snapshot is written in the background",
+    )
+    items_log_fsync: bool = Field(default=False, description="fsync the operation log after every write")
+    items_change_feed_size: int = Field(
+        default=10000,
+        description="Number of recent item changes retained for clients resuming the change feed",
+    )
+
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_ignore_empty=True,
+        extra="ignore",
+    )
+
+
+@lru_cache
+def get_items_settings() -> Settings:
+    return Settings()
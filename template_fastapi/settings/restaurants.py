@@ -0,0 +1,100 @@
+from functools import lru_cache
+from typing import Literal
+
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Settings(BaseSettings):
+    restaurant_search_backend: Literal["cosmosdb", "local"] = Field(
+        default="cosmosdb",
+        description=(
+            "Backend of restaurant vector search: `cosmosdb` runs VectorDistance queries, "
+            "`local` loads the vectors once into an in-process NumPy index"
+        ),
+    )
+    restaurant_vector_storage: Literal["float32", "float16", "int8"] = Field(
+        default="float32",
+        description=(
+            "Precision restaurant vectors are stored in Cosmos DB and the local index: `float16` halves and "
+            "`int8` (with a per-vector scale) quarters them; the container's vector policy dataType should match"
+        ),
+    )
+    restaurant_search_rerank_factor: int = Field(
+        default=4,
+        description=(
+            "How many times k candidates are re-ranked by exact cosine similarity. With float16 or int8 storage, "
+            "Cosmos DB documents also keep a base64 float32 copy in `vector_exact` (exclude it from the indexing "
+            "policy) to re-rank against; documents written before keep Cosmos DB's order until rewritten, e.g. by "
+            "`reembed --force`. The local index uses it for its two-stage search over truncated embeddings, "
+            "re-ranking against the vectors it holds at the stored precision; 1 disables re-ranking"
+        ),
+    )
+    restaurant_embedding_mode: Literal["sync", "write_behind"] = Field(
+        default="sync",
+        description=(
+            "How the API embeds created and updated restaurants: `sync` before writing them, `write_behind` "
+            "by writing them with `vector_status: pending` and embedding them in background workers"
+        ),
+    )
+    restaurant_embedding_workers: int = Field(
+        default=2,
+        description="Number of write-behind embedding workers",
+    )
+    restaurant_embedding_max_retries: int = Field(
+        default=5,
+        description="Retries of a failed write-behind embedding before the restaurant is left pending for `reembed`",
+    )
+    restaurant_embedding_retry_backoff_seconds: float = Field(
+        default=0.5,
+        description="Delay before the first write-behind retry, doubled on each further retry",
+    )
+    restaurant_search_max_results: int = Field(
+        default=100,
+        description="Number of the most similar restaurants that cursor-paginated vector search pages through",
+    )
+    restaurant_geo_backend: Literal["cosmosdb", "local"] = Field(
+        default="cosmosdb",
+        description=(
+            "Backend of nearby restaurant search: `cosmosdb` runs bounding-box prefiltered ST_DISTANCE queries, "
+            "`local` loads the coordinates once into an in-process grid index"
+        ),
+    )
+    restaurant_geo_cell_km: float = Field(
+        default=5.0,
+        description="Approximate edge length of a cell of the local geo grid index",
+    )
+    restaurant_cache_ttl_seconds: float = Field(
+        default=30.0,
+        description="How long list, search and nearby results are cached; 0 disables the result cache",
+    )
+    restaurant_cache_size: int = Field(
+        default=1024,
+        description="Maximum number of cached restaurant results",
+    )
+    restaurant_item_cache_fresh_seconds: float = Field(
+        default=5.0,
+        description=(
+            "How long a restaurant read by ID is served from memory before it is revalidated with its ETag; "
+            "0 revalidates every read"
+        ),
+    )
+    restaurant_item_cache_size: int = Field(
+        default=4096,
+        description="Maximum number of restaurants cached by ID; 0 disables the point-read cache",
+    )
+    restaurant_cache_coordinate_precision: int = Field(
+        default=3,
+        description="Decimal places nearby-search coordinates are rounded to (3 is about 100 m)",
+    )
+
+    model_config = SettingsConfigDict(
+        env_file=".env",
+        env_ignore_empty=True,
+        extra="ignore",
+    )
+
+
+@lru_cache
+def get_restaurants_settings() -> Settings:
+    return Settings()
@@ -48,6 +48,11 @@ class TestFoodiesRouter:
         # Should not return 404 - may return 500 due to missing dependencies
         assert response.status_code != 404
 
+    def test_list_restaurants_rejects_invalid_cursor(self):
+        """Test that a malformed pagination cursor is a client error."""
+        response = client.get("/foodies/restaurants/?cursor=not-a-cursor")
+        assert response.status_code == 400
+
     def test_find_nearby_restaurants_endpoint_exists(self):
         """Test that the find nearby restaurants endpoint exists."""
         response = client.get("/foodies/restaurants/near/?latitude=35.6762&longitude=139.6503")
@@ -1,6 +1,12 @@
+import asyncio
+import json
+
 from fastapi.testclient import TestClient
 
 from template_fastapi.app import app
+from template_fastapi.repositories.item_changes import ItemChangeFeed
+from template_fastapi.repositories.items import item_changes
+from template_fastapi.routers.items import change_events
 
 client = TestClient(app)
 
@@ -22,6 +28,19 @@ def test_list_items():
     assert "tags" in item
 
 
+def test_list_items_rejects_negative_pagination():
+    """Test that negative offsets and limits are rejected instead of failing in the repository."""
+    for params in [{"skip": -1}, {"limit": -1}, {"cursor": "", "limit": -1}]:
+        assert client.get("/items/", params=params).status_code == 422
+
+
+def test_list_items_accepts_an_empty_page():
+    """Test that a zero limit returns an empty page, as it always has."""
+    response = client.get("/items/", params={"limit": 0})
+    assert response.status_code == 200
+    assert response.json() == []
+
+
 def test_get_item():
     """Test getting a specific item by ID."""
     response = client.get("/items/1")
@@ -32,6 +51,21 @@ def test_get_item():
     assert item["price"] == 9.99
 
 
+def test_item_responses_follow_updates():
+    """Test that cached item responses reflect updates."""
+    original = client.get("/items/2").json()
+    assert client.get("/items/", params={"limit": 2}).json()[1] == original
+
+    response = client.put("/items/2", json={**original, "price": 1.25})
+    assert response.status_code == 200
+    assert client.get("/items/2").json()["price"] == 1.25
+    assert client.get("/items/", params={"limit": 2}).json()[1]["price"] == 1.25
+    assert client.get("/items/search/", params={"q": original["name"]}).json()[0]["price"] == 1.25
+
+    client.put("/items/2", json=original)
+    assert client.get("/items/2").json() == original
+
+
 def test_get_nonexistent_item():
     """Test getting a non-existent item returns 404."""
     response = client.get("/items/999")
@@ -69,3 +103,118 @@ def test_search_items():
     items = response.json()
     assert len(items) == 1
     assert items[0]["name"] == "Hammer"
+
+
+def test_list_items_with_cursor():
+    """Test keyset pagination of the items endpoint."""
+    response = client.get("/items/", params={"cursor": "", "limit": 3})
+    assert response.status_code == 200
+    page = response.json()
+    assert [item["id"] for item in page["items"]] == [1, 2, 3]
+
+    response = client.get("/items/", params={"cursor": page["next_cursor"], "limit": 3})
+    page = response.json()
+    assert [item["id"] for item in page["items"]] == [4, 5]
+    assert page["next_cursor"] is None
+
+    response = client.get("/items/", params={"cursor": "%%%"})
+    assert response.status_code == 400
+
+
+def test_sorted_items():
+    """Test server-side sorting of the items endpoints."""
+    response = client.get("/items/", params={"sort": "-price", "limit": 2})
+    assert response.status_code == 200
+    assert [item["name"] for item in response.json()] == ["Drill", "Saw"]
+
+    response = client.get("/items/search/", params={"q": "tool", "sort": "name", "limit": 3})
+    assert [item["name"] for item in response.json()] == ["Drill", "Hammer", "Saw"]
+
+    assert client.get("/items/", params={"sort": "color"}).status_code == 422
+    assert client.get("/items/", params={"cursor": "", "sort": "price"}).status_code == 400
+
+
+def test_item_facets():
+    """Test facet counts of the items endpoint."""
+    response = client.get("/items/facets", params={"q": "tool", "price_buckets": [0, 10, 20]})
+    assert response.status_code == 200
+    facets = response.json()
+    assert facets["total"] == 5
+    assert facets["tags"] == {"hardware": 5, "tool": 5, "cutting": 1, "power": 1}
+    assert [bucket["count"] for bucket in facets["price_buckets"]] == [2, 2, 1]
+
+    response = client.get("/items/facets", params={"price_buckets": [20, 10]})
+    assert response.status_code == 400
+
+
+def test_item_change_feed():
+    """Test that item writes are streamed as numbered change events."""
+    sequence = item_changes.sequence
+    item = client.get("/items/3").json()
+    client.put("/items/3", json=item)
+
+    async def first_event() -> str:
+        events = change_events(sequence)
+        try:
+            return await anext(events)
+        finally:
+            await events.aclose()
+
+    event = asyncio.run(first_event())
+    assert event.startswith(f"id: {item_changes.epoch}:{sequence + 1}\nevent: saved\ndata: ")
+    assert json.loads(event.split("data: ", 1)[1])["item"] == item
+
+    response = client.get("/items/changes", params={"since": item_changes.position(sequence + 100)})
+    assert response.status_code == 410
+    response = client.get("/items/changes", params={"since": "latest"})
+    assert response.status_code == 400
+
+
+def test_item_change_feed_rejects_event_ids_from_before_a_restart():
+    """Test that an event ID numbered by a previous process is not resumed from."""
+    previous = ItemChangeFeed()
+    previous.items_deleted([1, 2])
+    client.put("/items/3", json=client.get("/items/3").json())
+    assert item_changes.sequence >= 2
+
+    response = client.get("/items/changes", headers={"Last-Event-ID": previous.position(previous.sequence)})
+    assert response.status_code == 410
+    response = client.get("/items/changes", params={"since": "2"})
+    assert response.status_code == 410
+
+
+def test_bulk_items():
+    """Test bulk create, update and delete of items."""
+    rows = [{"id": 101, "name": "Clamp", "price": 5.0}, {"id": 102, "name": "Vise", "price": 25.0, "tags": ["tool"]}]
+    response = client.post("/items/bulk", json=rows)
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == ["created", "created"]
+
+    ndjson = '{"id": 101, "name": "Clamp", "price": 6.0}\n{"id": 102, "name": "Vise", "price": 26.0}\n'
+    response = client.put("/items/bulk", content=ndjson, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert client.get("/items/101").json()["price"] == 6.0
+
+    response = client.request("DELETE", "/items/bulk", json=[101, 102])
+    assert response.status_code == 200
+    assert client.get("/items/102").status_code == 404
+
+
+def test_bulk_items_are_atomic():
+    """Test that a bulk request with an invalid row writes nothing."""
+    rows = [{"id": 103, "name": "Clamp", "price": 5.0}, {"id": 104, "name": "Vise", "price": "cheap"}]
+    response = client.post("/items/bulk", json=rows)
+    assert response.status_code == 422
+    body = response.json()
+    assert body["applied"] is False
+    assert [result["index"] for result in body["results"]] == [1]
+    assert client.get("/items/103").status_code == 404
+
+    response = client.request("DELETE", "/items/bulk", json=[1, 999])
+    assert response.status_code == 404
+    assert client.get("/items/1").status_code == 200
+
+    response = client.request("DELETE", "/items/bulk", json=[1, 2, 1])
+    assert response.status_code == 422
+    assert response.json()["results"] == [{"index": 2, "id": 1, "status": "invalid", "errors": ["Duplicate item ID"]}]
+    assert client.get("/items/1").status_code == 200
@@ -0,0 +1,133 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from template_fastapi.repositories.embeddings import (
+    EmbeddingBatcher,
+    EmbeddingCache,
+    FakeEmbedder,
+    embedding_cache_key,
+)
+
+
+@pytest.fixture
+def embedder():
+    return FakeEmbedder()
+
+
+def test_repeated_texts_skip_the_embedder(tmp_path, embedder):
+    cache = EmbeddingCache(tmp_path / "embeddings.sqlite3")
+    first = cache.embed(["ramen", "sushi", "ramen"], "small", None, embedder)
+    second = cache.embed(["sushi", "udon"], "small", None, embedder)
+
+    assert first == [embedder.embed("ramen"), embedder.embed("sushi"), embedder.embed("ramen")]
+    assert second == [embedder.embed("sushi"), embedder.embed("udon")]
+    assert embedder.calls == [["ramen", "sushi"], ["udon"]]
+    assert cache.stats() == {"memory_hits": 1, "disk_hits": 0, "misses": 3, "memory_entries": 3, "disk_entries": 3}
+
+
+def test_disk_tier_is_shared_across_instances(tmp_path, embedder):
+    path = tmp_path / "embeddings.sqlite3"
+    EmbeddingCache(path).embed(["ramen"], "small", 256, embedder)
+
+    cache = EmbeddingCache(path)
+    # Vectors round-trip through float32 on disk
+    assert cache.embed(["ramen"], "small", 256, embedder)[0] == pytest.approx(embedder.embed("ramen"), rel=1e-6)
+    assert cache.embed(["ramen"], "small", 256, embedder)[0] == pytest.approx(embedder.embed("ramen"), rel=1e-6)
+    assert len(embedder.calls) == 1
+    assert cache.hits == {"memory": 1, "disk": 1}
+
+
+def test_key_covers_deployment_and_dimensions(embedder):
+    keys = {
+        embedding_cache_key("ramen", "small", None),
+        embedding_cache_key("ramen", "small", 256),
+        embedding_cache_key("ramen", "large", None),
+        embedding_cache_key("ramen ", "small", None),
+    }
+    assert len(keys) == 4
+
+    cache = EmbeddingCache()
+    cache.embed(["ramen"], "small", None, embedder)
+    cache.embed(["ramen"], "small", 256, embedder)
+    assert len(embedder.calls) == 2
+
+
+def test_both_tiers_evict_least_recently_used(tmp_path, embedder):
+    cache = EmbeddingCache(tmp_path / "embeddings.sqlite3", memory_size=2, disk_size=10)
+    cache.embed([f"dish {i}" for i in range(10)], "small", None, embedder)
+    # Touch the oldest entry so eviction skips it
+    cache.embed(["dish 0"], "small", None, embedder)
+    cache.embed(["dish 10"], "small", None, embedder)
+
+    stats = cache.stats()
+    assert stats["memory_entries"] == 2
+    assert stats["disk_entries"] == 9
+    assert cache.get(embedding_cache_key("dish 0", "small", None)) is not None
+    assert cache.get(embedding_cache_key("dish 1", "small", None)) is None
+
+
+def test_locked_disk_tier_does_not_block_the_event_loop(tmp_path, embedder):
+    path = tmp_path / "embeddings.sqlite3"
+    EmbeddingCache(path).embed(["ramen"], "small", None, embedder)
+    cache = EmbeddingCache(path)
+
+    async def aembed(texts):
+        return embedder(texts)
+
+    async def scenario():
+        # Another worker holds the write lock on the shared file
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        missed = asyncio.create_task(cache.aembed(["sushi"], "small", None, aembed))
+        await asyncio.sleep(0.1)
+
+        # A disk hit does not write, and is served while the miss waits for the lock off the loop
+        vectors = await cache.aembed(["ramen"], "small", None, aembed)
+        assert vectors[0] == pytest.approx(embedder.embed("ramen"), rel=1e-6)
+        assert not missed.done()
+
+        other.execute("COMMIT")
+        other.close()
+        assert await missed == [embedder.embed("sushi")]
+
+    asyncio.run(scenario())
+    assert cache.stats()["disk_entries"] == 2
+    cache.close()
+
+
+def test_batcher_coalesces_concurrent_requests():
+    embedder = FakeEmbedder(latency=0.02)
+    batcher = EmbeddingBatcher(embedder, max_batch_size=16, max_wait=0.05, max_concurrency=2)
+    texts = [f"dish {i % 20}" for i in range(40)]
+    with ThreadPoolExecutor(max_workers=40) as pool:
+        vectors = list(pool.map(lambda text: batcher.embed([text])[0], texts))
+    batcher.close()
+
+    assert vectors == [embedder.embed(text) for text in texts]
+    # Duplicates within a batch are embedded once, and no call exceeds the batch size
+    assert {text for call in embedder.calls for text in call} == set(texts)
+    assert all(len(set(call)) == len(call) <= 16 for call in embedder.calls)
+    assert len(embedder.calls) < 10
+
+
+def test_batcher_splits_large_requests_and_serves_event_loops():
+    embedder = FakeEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_batch_size=4, max_wait=0.001, max_concurrency=1)
+    texts = [f"dish {i}" for i in range(10)]
+
+    assert asyncio.run(batcher.aembed(texts)) == [embedder.embed(text) for text in texts]
+    assert [len(call) for call in embedder.calls] == [4, 4, 2]
+    batcher.close()
+
+
+def test_batcher_fails_every_waiter_of_a_failed_call():
+    def fail(texts):
+        raise RuntimeError("rate limited")
+
+    batcher = EmbeddingBatcher(fail, max_wait=0.01)
+    with pytest.raises(RuntimeError, match="rate limited"):
+        batcher.embed(["ramen", "sushi"])
+    batcher.close()
@@ -0,0 +1,501 @@
+"""Tests for the items repository and its indexes."""
+
+import asyncio
+import gc
+import json
+import random
+import re
+import threading
+from collections import Counter
+
+import pytest
+
+from template_fastapi.models.item import Item
+from template_fastapi.repositories.item_changes import ExpiredSequenceError, ItemChangeFeed
+from template_fastapi.repositories.item_shared_memory import SharedItemRepository
+from template_fastapi.repositories.item_storage import ItemStorage
+from template_fastapi.repositories.items import (
+    ColumnarItemRepository,
+    InvalidCursorError,
+    ItemRepository,
+    sample_items,
+)
+
+
+def linear_search(items, q=None, min_price=None, max_price=None, tags=None):
+    """Reference implementation of the original linear-scan search."""
+    results = list(items)
+    if q:
+        q = q.lower()
+        results = [
+            item
+            for item in results
+            if q in item.name.lower() or (item.description is not None and q in item.description.lower())
+        ]
+    if min_price is not None:
+        results = [item for item in results if item.price >= min_price]
+    if max_price is not None:
+        results = [item for item in results if item.price <= max_price]
+    if tags:
+        results = [item for item in results if all(tag in item.tags for tag in tags)]
+    return results
+
+
+@pytest.fixture(params=[ItemRepository, ColumnarItemRepository])
+def repo_class(request):
+    return request.param
+
+
+@pytest.fixture
+def repo(repo_class):
+    return repo_class([item.model_copy() for item in sample_items])
+
+
+def random_items(count: int, seed: int = 0) -> list[Item]:
+    rng = random.Random(seed)
+    words = ["red", "blue", "steel", "wood", "hammer", "saw", "drill", "a tool", "Nail-Gun", "bolt"]
+    tag_pool = ["tool", "hardware", "power", "cutting", "garden"]
+    return [
+        Item(
+            id=i,
+            name=" ".join(rng.sample(words, 2)),
+            description=rng.choice([None, " ".join(rng.sample(words, 3))]),
+            price=round(rng.uniform(0, 100), 2),
+            tags=rng.sample(tag_pool, rng.randint(0, 3)),
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {},
+        {"q": "ham"},
+        {"q": "A TOOL"},
+        {"q": "nail-g"},
+        {"q": "ll st"},
+        {"q": "saw red drill"},
+        {"q": " bolt "},
+        {"q": "l-gun a"},
+        {"q": " "},
+        {"q": "missing"},
+        {"min_price": 20},
+        {"max_price": 30.5},
+        {"min_price": 10, "max_price": 60, "tags": ["tool"]},
+        {"q": "o", "tags": ["power", "tool"]},
+        {"tags": ["unknown"]},
+    ],
+)
+def test_search_matches_linear_scan(repo_class, filters):
+    """The indexed search returns exactly what the linear scan returned, in the same order."""
+    items = random_items(500)
+    repo = repo_class(items)
+    for item_id in range(0, 500, 7):
+        repo.delete_item(item_id)
+    repo.save_item(items[3].model_copy(update={"price": 55.5, "tags": ["power"]}))
+    remaining = repo.list_items(limit=len(repo))
+    assert repo.search_items(**filters) == linear_search(remaining, **filters)
+
+
+@pytest.mark.parametrize(
+    "skip, limit, expected",
+    [(0, 2, slice(0, 2)), (3, 10, slice(3, 5)), (-1, 3, slice(0, 3)), (-10, 1, slice(0, 1)), (1, -1, slice(0, 0))],
+)
+@pytest.mark.parametrize("sort", [None, "id"])
+def test_list_items_clamps_negative_pagination(repo, skip, limit, expected, sort):
+    """Negative offsets and limits are clamped to zero instead of raising or reading unused column slots."""
+    assert repo.list_items(skip=skip, limit=limit, sort=sort) == sample_items[expected]
+
+
+def test_index_follows_writes(repo):
+    """Updates and deletes are reflected in subsequent searches."""
+    repo.save_item(Item(id=1, name="Mallet", description="A rubber mallet", price=99.0, tags=["rubber"]))
+    assert repo.search_items(q="hammer") == []
+    assert [item.id for item in repo.search_items(q="mallet", tags=["rubber"])] == [1]
+    assert [item.id for item in repo.search_items(min_price=50)] == [1]
+
+    repo.delete_item(1)
+    assert repo.search_items(q="mallet") == []
+    assert repo.search_items(tags=["rubber"]) == []
+    assert [item.id for item in repo.search_items(min_price=40)] == [5]
+
+
+def test_fuzzy_search_tolerates_typos(repo):
+    """Misspelt queries find the intended items, most similar first, and respect the other filters."""
+    assert [item.id for item in repo.search_items(q="hamer", fuzzy=True)] == [1]
+    assert [item.id for item in repo.search_items(q="screw drivr", fuzzy=True)][0] == 2
+    assert [item.id for item in repo.search_items(q="drilling", fuzzy=True, limit=2)] == [5, 2]
+    assert repo.search_items(q="hamer", fuzzy=True, tags=["power"]) == []
+    assert repo.search_items(q="xyzzy", fuzzy=True) == []
+
+    repo.save_item(Item(id=6, name="Hammer drill", price=89.0, tags=["power"]))
+    assert [item.id for item in repo.search_items(q="hamer dril", fuzzy=True, limit=3)] == [6, 1, 5]
+    assert [item.id for item in repo.search_items(q="hamer dril", fuzzy=True, limit=1)] == [6]
+    repo.delete_item(1)
+    repo.delete_item(6)
+    assert repo.search_items(q="hamer", fuzzy=True) == []
+
+
+def fuzzy_ranking(items, q, threshold=0.3):
+    """Reference ranking scoring every item against every query token."""
+
+    def trigrams(token):
+        padded = f"  {token} "
+        return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+    def similarity(a, b):
+        return len(trigrams(a) & trigrams(b)) / len(trigrams(a) | trigrams(b))
+
+    scored = []
+    for position, item in enumerate(items):
+        tokens = re.findall(r"\w+", f"{item.name} {item.description or ''}".lower())
+        score = 0.0
+        for query_token in set(re.findall(r"\w+", q.lower())):
+            similarities = [similarity(query_token, token) for token in tokens]
+            score += max([value for value in similarities if value >= threshold], default=0.0)
+        if score:
+            scored.append((-round(score, 9), position, item))
+    return [item for _, _, item in sorted(scored, key=lambda entry: entry[:2])]
+
+
+def test_fuzzy_top_k_matches_full_ranking(repo_class):
+    """The top-k heap returns the head of the fully ranked result list."""
+    items = random_items(500)
+    repo = repo_class(items)
+    ranked = repo.search_items(q="stel bolts", fuzzy=True)
+    assert len(ranked) > 10
+    assert ranked == fuzzy_ranking(items, "stel bolts")
+    assert repo.search_items(q="stel bolts", fuzzy=True, limit=10) == ranked[:10]
+    assert repo.search_items(q="stel bolts", fuzzy=True, max_price=50) == [item for item in ranked if item.price <= 50]
+
+
+def sort_items(items, sort):
+    """Reference ordering for the `sort` parameter."""
+    keys = {
+        "id": lambda item: item.id,
+        "name": lambda item: (item.name.lower(), item.id),
+        "price": lambda item: (item.price, item.id),
+        "-price": lambda item: (item.price, item.id),
+    }
+    return sorted(items, key=keys[sort], reverse=sort.startswith("-"))
+
+
+@pytest.mark.parametrize("sort", ["id", "name", "price", "-price"])
+def test_sorted_list_and_search(repo_class, sort):
+    """Sorted pages and searches match a full sort of the results, with or without a limit."""
+    items = random_items(500)
+    repo = repo_class(items[::-1])
+    for item_id in range(0, 500, 9):
+        repo.delete_item(item_id)
+    repo.save_item(items[4].model_copy(update={"name": "Anvil", "price": 0.5}))
+    remaining = repo.list_items(limit=len(repo))
+
+    assert repo.list_items(skip=30, limit=20, sort=sort) == sort_items(remaining, sort)[30:50]
+    for filters in [{}, {"q": "steel"}, {"min_price": 10, "max_price": 20}, {"max_price": 60, "tags": ["tool"]}]:
+        expected = sort_items(linear_search(remaining, **filters), sort)
+        assert repo.search_items(**filters, sort=sort) == expected
+        assert repo.search_items(**filters, sort=sort, limit=5) == expected[:5]
+
+    fuzzy_matches = repo.search_items(q="stel", fuzzy=True)
+    assert repo.search_items(q="stel", fuzzy=True, sort=sort) == sort_items(fuzzy_matches, sort)
+
+
+def expected_facets(items, edges):
+    """Reference facets counted from a list of items."""
+    tag_counts = Counter(tag for item in items for tag in set(item.tags))
+    bounds = [*edges[1:], float("inf")]
+    return {
+        "total": len(items),
+        "tags": dict(sorted(tag_counts.items(), key=lambda entry: (-entry[1], entry[0]))),
+        "price_buckets": [
+            {
+                "min_price": lo,
+                "max_price": None if hi == float("inf") else hi,
+                "count": sum(lo <= item.price < hi for item in items),
+            }
+            for lo, hi in zip(edges, bounds)
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [{}, {"q": "steel"}, {"min_price": 10, "max_price": 60}, {"tags": ["tool"]}, {"q": "o", "tags": ["power"]}],
+)
+def test_facets_match_search_results(repo_class, filters):
+    """Facets count exactly the items the same search returns, and follow writes."""
+    items = random_items(500)
+    repo = repo_class(items)
+    edges = [0.0, 25.0, 50.0, 90.0]
+    for item_id in range(0, 500, 11):
+        repo.delete_item(item_id)
+    repo.save_item(items[5].model_copy(update={"price": 95.0, "tags": ["garden", "sale"]}))
+
+    facets = repo.facets(**filters, price_edges=edges)
+    assert facets.model_dump() == expected_facets(repo.search_items(**filters), edges)
+
+
+def test_facets_reject_unsorted_edges(repo):
+    with pytest.raises(ValueError):
+        repo.facets(price_edges=[10.0, 5.0])
+
+
+def test_encoded_items_follow_writes(repo):
+    """Cached JSON encodings match the stored items and are dropped on every kind of write."""
+    assert json.loads(repo.encode_items(repo.list_items())) == [item.model_dump() for item in sample_items]
+
+    repo.save_item(sample_items[0].model_copy(update={"price": 1.5}))
+    repo.save_items([sample_items[1].model_copy(update={"tags": ["sale"]})])
+    repo.delete_item(3)
+    repo.save_item(sample_items[2].model_copy(update={"name": "Pliers"}))
+    repo.delete_items([4])
+    assert (
+        repo.encode_items(repo.list_items())
+        == b"[" + b",".join(item.model_dump_json().encode() for item in repo.list_items()) + b"]"
+    )
+    assert json.loads(repo.encode_item(repo.get_item(3)))["name"] == "Pliers"
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [{}, {"q": "drill"}, {"min_price": 10, "tags": ["power"]}, {"q": "hamer", "fuzzy": True}, {"sort": "-price"}],
+)
+def test_encoded_search_matches_search_items(repo, filters):
+    """Encoded search results match `search_items`, and warm encodings skip building Items in the columnar store."""
+    expected = repo.encode_items(repo.search_items(**filters))
+    assert repo.encode_search(**filters) == expected
+    assert repo.encode_search(limit=2, **filters) == repo.encode_items(repo.search_items(limit=2, **filters))
+
+    if isinstance(repo, ColumnarItemRepository):
+        repo._item = None  # every row was encoded above, so none is built again
+        assert repo.encode_search(**filters) == expected
+
+
+def test_change_feed_numbers_writes(repo):
+    """Every write path publishes numbered changes, and only the most recent are retained."""
+    feed = ItemChangeFeed(capacity=4)
+    repo.subscribe(feed)
+    repo.save_item(sample_items[0].model_copy(update={"price": 1.5}))
+    repo.delete_item(2)
+    repo.save_items([sample_items[2], sample_items[3]])
+    repo.delete_items([4, 99])
+
+    assert feed.sequence == 5
+    changes = feed.since(2)
+    assert [(change.sequence, change.operation, change.id) for change in changes] == [
+        (3, "saved", 3),
+        (4, "saved", 4),
+        (5, "deleted", 4),
+    ]
+    assert changes[0].item == sample_items[2]
+    assert feed.since(5) == []
+    for sequence in [0, 6]:
+        with pytest.raises(ExpiredSequenceError):
+            feed.since(sequence)
+
+
+def test_change_feed_positions_do_not_resume_across_restarts():
+    """A position from a feed that restarted is expired even if its sequence number was reissued."""
+    feed = ItemChangeFeed()
+    feed.items_deleted([1, 2])
+    assert feed.sequence_at(feed.position(1)) == 1
+
+    restarted = ItemChangeFeed()
+    restarted.items_deleted([3, 4, 5])
+    with pytest.raises(ExpiredSequenceError):
+        restarted.sequence_at(feed.position(1))
+    with pytest.raises(ExpiredSequenceError):
+        restarted.sequence_at("1")
+    with pytest.raises(ValueError):
+        restarted.sequence_at(f"{restarted.epoch}:")
+
+
+def test_change_feed_wakes_waiting_readers():
+    async def follow() -> None:
+        feed = ItemChangeFeed()
+        assert not await feed.wait(0, timeout=0.01)
+
+        waiter = asyncio.create_task(feed.wait(0, timeout=5))
+        await asyncio.sleep(0)
+        # Writes may be published from threads other than the event loop's
+        threading.Thread(target=feed.items_deleted, args=([1],)).start()
+        assert await waiter
+        assert await feed.wait(0, timeout=0)
+        assert [change.id for change in feed.since(0)] == [1]
+
+    asyncio.run(follow())
+
+
+def test_cursor_pagination_walks_all_items(repo_class):
+    """Cursor pages cover every item exactly once in ascending ID order."""
+    repo = repo_class(random_items(25)[::-1])
+    repo.delete_item(7)
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = repo.list_items_after(cursor, limit=4)
+        seen.extend(item.id for item in page)
+        if cursor is None:
+            break
+    assert seen == sorted(set(range(25)) - {7})
+
+
+def test_invalid_cursor(repo):
+    with pytest.raises(InvalidCursorError):
+        repo.list_items_after("not-a-cursor")
+
+
+def test_columnar_compaction_keeps_order():
+    """Compacting tombstoned rows keeps the remaining items in insertion order."""
+    items = random_items(5000)
+    repo = ColumnarItemRepository(items)
+    for item in items:
+        if item.id % 3:
+            repo.delete_item(item.id)
+    assert repo._size < len(items)
+    assert repo.list_items(limit=len(repo)) == items[::3]
+    assert repo.search_items(tags=["tool"]) == linear_search(items[::3], tags=["tool"])
+
+
+def test_save_items_bulk_load_path(repo):
+    """Large batches take the bulk-load path and leave the indexes consistent."""
+    items = [item.model_copy(update={"id": item.id + 1000}) for item in random_items(400)]
+    updated = sample_items[0].model_copy(update={"price": 1.5})
+    created = repo.save_items([updated, *items])
+
+    assert created[0] is False and all(created[1:])
+    assert repo.list_items(limit=3) == [updated, *sample_items[1:3]]
+    remaining = repo.list_items(limit=len(repo))
+    for filters in [{"max_price": 8}, {"q": "blue", "tags": ["tool"]}]:
+        assert repo.search_items(**filters) == linear_search(remaining, **filters)
+
+
+def test_storage_round_trip(tmp_path, repo_class):
+    """Writes survive a restart through the snapshot and the replayed log."""
+    storage = ItemStorage(tmp_path, snapshot_interval=3)
+    storage.snapshot(sample_items)
+    repo = repo_class(storage.load())
+    storage.attach(repo)
+
+    repo.save_item(Item(id=6, name="Level", description=None, price=15.0, tags=[]))
+    repo.delete_item(2)
+    repo.save_item(sample_items[0].model_copy(update={"price": 10.5}))  # triggers a snapshot
+    repo.save_items([Item(id=7, name="Chisel", price=8.0, tags=["tool", "cutting"])])
+    storage.close()
+
+    restored = ItemStorage(tmp_path).load()
+    assert restored == list(repo.iter_items())
+    assert [item.id for item in restored] == [1, 3, 4, 5, 6, 7]
+
+
+@pytest.mark.parametrize("sort", [None, "id", "name", "price", "-price"])
+def test_storage_restores_index_state(tmp_path, repo_class, sort):
+    """A store restored from a snapshot with index state answers like one rebuilt from its items."""
+    items = random_items(300)
+    storage = ItemStorage(tmp_path, snapshot_interval=50)
+    repo = repo_class(items)
+    storage.attach(repo)
+    storage.checkpoint(wait=True)
+    for item in items[:80]:  # the 50th write snapshots in the background
+        repo.save_item(item.model_copy(update={"name": f"renamed {item.name}", "price": item.price / 2}))
+    repo.delete_items([item.id for item in items[100:120]])
+    storage.close()
+
+    restored = ItemStorage(tmp_path).restore(repo_class)
+    rebuilt = repo_class(list(repo.iter_items()))
+    assert list(restored.iter_items()) == list(rebuilt.iter_items())
+    for filters in [{"q": "renamed"}, {"q": "l st"}, {"q": "hammer", "tags": ["tool"]}, {"max_price": 200}]:
+        assert restored.search_items(**filters, sort=sort) == rebuilt.search_items(**filters, sort=sort)
+
+    # Rewriting a restored item drops the tokens saved for it
+    restored.save_item(items[200].model_copy(update={"name": "Plane", "description": None}))
+    rebuilt.save_item(items[200].model_copy(update={"name": "Plane", "description": None}))
+    for q in [items[200].name.lower(), "plane"]:
+        assert restored.search_items(q=q, sort=sort) == rebuilt.search_items(q=q, sort=sort)
+
+
+def test_storage_keeps_rotated_log_after_failed_snapshot(tmp_path, monkeypatch):
+    """Writes logged before a failed background snapshot survive until a later snapshot succeeds."""
+    storage = ItemStorage(tmp_path, snapshot_interval=2)
+    repo = ItemRepository(sample_items)
+    storage.attach(repo)
+    storage.checkpoint(wait=True)
+
+    def failing_build():
+        raise OSError("disk full")
+
+    monkeypatch.setattr(repo, "snapshot_state", lambda: failing_build)
+    repo.save_item(Item(id=6, name="Level", price=15.0))
+    repo.delete_item(2)  # the background snapshot fails and the log stays rotated
+    storage.wait()
+    assert storage.rotated_log_path.exists()
+    assert gc.isenabled()
+
+    repo.save_item(Item(id=7, name="Chisel", price=8.0))
+    assert ItemStorage(tmp_path).load() == list(repo.iter_items())
+
+    # A snapshot that fails while freezing the store leaves the cyclic collector enabled too
+    monkeypatch.setattr(repo, "snapshot_state", lambda: failing_build())
+    with pytest.raises(OSError):
+        storage.checkpoint(wait=True)
+    assert gc.isenabled()
+
+    monkeypatch.undo()
+    repo.delete_item(3)  # the next snapshot folds the current log into the rotated one and succeeds
+    storage.close()
+    assert not storage.rotated_log_path.exists()
+    assert [item.id for item in ItemStorage(tmp_path).restore(ItemRepository).iter_items()] == [1, 4, 5, 6, 7]
+
+
+def test_storage_drops_torn_log_record(tmp_path):
+    """A partially written record at the end of the log is discarded on load."""
+    storage = ItemStorage(tmp_path)
+    storage.items_saved([sample_items[0]])
+    storage.items_deleted([1])
+    storage.close()
+    with open(storage.log_path, "ab") as f:
+        f.write(b"\x01\xff\x00")
+
+    assert ItemStorage(tmp_path).load() == []
+    assert ItemStorage(tmp_path).load() == []
+
+
+def test_shared_store_is_visible_across_instances(tmp_path):
+    """Two workers opening the same heap see each other's writes and searches."""
+    path = tmp_path / "items.heap"
+    first = SharedItemRepository(path, sample_items)
+    second = SharedItemRepository(path, [Item(id=99, name="Ignored", price=1.0)])
+    assert list(second.iter_items()) == sample_items
+
+    first.save_item(Item(id=6, name="Level", description=None, price=15.0, tags=["tool"]))
+    second.delete_item(2)
+    second.save_item(sample_items[0].model_copy(update={"price": 10.5}))
+
+    for repo in [first, second]:
+        assert [item.id for item in repo.iter_items()] == [1, 3, 4, 5, 6]
+        assert repo.get_item(1).price == 10.5
+        assert 2 not in repo
+        assert repo.search_items(q="level") == [repo.get_item(6)]
+        assert repo.list_items_after(limit=2)[0] == repo.list_items(limit=2)
+
+    # An encoding cached by one worker is dropped when another worker writes the item
+    assert json.loads(first.encode_item(first.get_item(3)))["price"] == sample_items[2].price
+    second.save_item(sample_items[2].model_copy(update={"price": 2.5}))
+    assert json.loads(first.encode_item(first.get_item(3)))["price"] == 2.5
+
+
+def test_shared_store_compaction_reopens_readers(tmp_path):
+    """Readers rebuild from the new heap after another worker compacts it."""
+    path = tmp_path / "items.heap"
+    writer = SharedItemRepository(path, sample_items)
+    reader = SharedItemRepository(path)
+    writer._COMPACTION_MIN_RECORDS = 20
+    for price in range(30):
+        writer.save_item(sample_items[2].model_copy(update={"price": float(price)}))
+
+    assert writer.heap.epoch == 1
+    assert reader.get_item(3).price == 29.0
+    assert reader._records == writer._records < 30
+    assert list(reader.iter_items()) == list(writer.iter_items())
+    assert reader.search_items(max_price=10) == linear_search(writer.iter_items(), max_price=10)
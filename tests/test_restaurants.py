@@ -0,0 +1,1012 @@
+import asyncio
+import csv
+import json
+import re
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pytest
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceNotFoundError
+from fastapi.testclient import TestClient
+
+from template_fastapi.app import app
+from template_fastapi.models.restaurant import Restaurant
+from template_fastapi.repositories import restaurant_cache, restaurants
+from template_fastapi.repositories.embeddings import EmbeddingCache, FakeEmbedder
+from template_fastapi.repositories.restaurant_cache import RestaurantItemCache, RestaurantResultCache
+from template_fastapi.repositories.restaurant_embedding_worker import EmbeddingJob, EmbeddingWriteBehind
+from template_fastapi.repositories.restaurant_geo import RestaurantGeoIndex, bounding_box, haversine_km
+from template_fastapi.repositories.restaurant_import import import_restaurants, read_csv_rows
+from template_fastapi.repositories.restaurant_reembed import reembed_restaurants
+from template_fastapi.repositories.restaurant_vectors import (
+    RestaurantVectorIndex,
+    dequantize_vector,
+    exact_vector,
+    quantize_vector,
+    rerank,
+)
+from template_fastapi.repositories.restaurants import (
+    AsyncRestaurantRepository,
+    InvalidCursorError,
+    RestaurantRepository,
+    content_hash,
+)
+from template_fastapi.routers import foodies
+
+
+class InMemoryContainer:
+    """Stand-in for the Cosmos DB container client, keeping items in a dict."""
+
+    def __init__(self, fail_on_upsert: int | None = None, fail_on_replace: int | None = None):
+        self.items: dict[str, dict] = {}
+        self.upserts = 0
+        self.replaces = 0
+        self.fail_on_upsert = fail_on_upsert
+        self.fail_on_replace = fail_on_replace
+        self._lock = threading.Lock()
+
+    def upsert_item(self, body: dict) -> dict:
+        with self._lock:
+            self.upserts += 1
+            if self.upserts == self.fail_on_upsert:
+                raise ConnectionError("Service unavailable")
+            return self._write(body)
+
+    def create_item(self, body: dict) -> dict:
+        with self._lock:
+            if body["id"] in self.items:
+                raise ValueError("Conflict")
+            return self._write(body)
+
+    def replace_item(self, item: str, body: dict, etag: str | None = None, match_condition=None) -> dict:
+        with self._lock:
+            self.replaces += 1
+            if self.replaces == self.fail_on_replace:
+                raise ConnectionError("Service unavailable")
+            if etag is not None and self.items[item]["_etag"] != etag:
+                raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+            return self._write(body)
+
+    def query_items(self, query: str, enable_cross_partition_query: bool = False, max_item_count: int | None = None):
+        return QueryResult([project(query, item) for item in self.items.values()], max_item_count)
+
+    def _write(self, body: dict) -> dict:
+        self.items[body["id"]] = {**body, "_etag": uuid.uuid4().hex}
+        return dict(self.items[body["id"]])
+
+    def read_item(self, item: str, partition_key: str, etag: str | None = None, match_condition=None) -> dict:
+        if etag is not None and self.items[item]["_etag"] == etag:
+            return {}
+        return dict(self.items[item])
+
+
+class AsyncInMemoryContainer:
+    """Stand-in for the azure.cosmos.aio container client."""
+
+    def __init__(self):
+        self.items: dict[str, dict] = {}
+        self.queries: list[tuple[str, list[dict] | None]] = []
+        self.reads: list[str | None] = []
+
+    async def create_item(self, body: dict) -> dict:
+        return self._write(body)
+
+    async def read_item(self, item: str, partition_key: str, etag: str | None = None, match_condition=None) -> dict:
+        self.reads.append(etag)
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message="Not found")
+        # A matching If-None-Match is answered with 304 Not Modified and no body
+        if etag is not None and self.items[item]["_etag"] == etag:
+            return {}
+        return dict(self.items[item])
+
+    async def replace_item(self, item: str, body: dict) -> dict:
+        return self._write(body)
+
+    async def delete_item(self, item: str, partition_key: str) -> None:
+        del self.items[item]
+
+    async def patch_item(
+        self, item: str, partition_key: str, patch_operations: list[dict], filter_predicate: str | None = None
+    ) -> dict:
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message="Not found")
+        condition = re.fullmatch(r'FROM c WHERE c\.(\w+) = "(.*)"', filter_predicate or "")
+        if condition and self.items[item].get(condition[1]) != condition[2]:
+            raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+        for operation in patch_operations:
+            field = operation["path"].lstrip("/")
+            if operation["op"] == "remove":
+                del self.items[item][field]
+            else:
+                self.items[item][field] = operation["value"]
+        return self._write(self.items[item])
+
+    def query_items(self, query: str, parameters: list[dict] | None = None, max_item_count: int | None = None):
+        self.queries.append((query, parameters))
+        return AsyncQueryResult([project(query, item) for item in self.items.values()], max_item_count)
+
+    def _write(self, body: dict) -> dict:
+        self.items[body["id"]] = {**body, "_etag": uuid.uuid4().hex}
+        return dict(self.items[body["id"]])
+
+
+def project(query: str, item: dict) -> dict:
+    """Apply the `c.<field>` projection of a SELECT clause, omitting missing fields like Cosmos DB."""
+    fields = re.findall(r"\bc\.(\w+)", query.split("FROM")[0])
+    return {field: item[field] for field in fields if field in item} if fields else dict(item)
+
+
+class QueryResult:
+    """Stand-in for ItemPaged, paging with the offset as the continuation token."""
+
+    def __init__(self, items: list[dict], max_item_count: int | None):
+        self.items = items
+        self.page_size = max_item_count or len(items) or 1
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def by_page(self, continuation_token: str | None = None):
+        return QueryPages(self.items, self.page_size, continuation_token)
+
+
+class QueryPages:
+    def __init__(self, items: list[dict], page_size: int, continuation_token: str | None):
+        self.items = items
+        self.page_size = page_size
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        while True:
+            start = int(self.continuation_token or 0)
+            end = start + self.page_size
+            self.continuation_token = str(end) if end < len(self.items) else None
+            yield iter(self.items[start:end])
+            if self.continuation_token is None:
+                return
+
+
+class AsyncQueryResult:
+    """Stand-in for AsyncItemPaged, paging with the offset as the continuation token."""
+
+    def __init__(self, items: list[dict], max_item_count: int | None):
+        self.items = items
+        self.page_size = max_item_count or len(items) or 1
+
+    async def __aiter__(self):
+        for item in self.items:
+            yield item
+
+    def by_page(self, continuation_token: str | None = None):
+        return AsyncQueryPages(self.items, self.page_size, continuation_token)
+
+
+class AsyncQueryPages:
+    def __init__(self, items: list[dict], page_size: int, continuation_token: str | None):
+        self.items = items
+        self.page_size = page_size
+        self.continuation_token = continuation_token
+
+    async def __aiter__(self):
+        while True:
+            start = int(self.continuation_token or 0)
+            end = start + self.page_size
+            self.continuation_token = str(end) if end < len(self.items) else None
+            yield AsyncQueryResult(self.items[start:end], None)
+            if self.continuation_token is None:
+                return
+
+
+SAMPLE_CSV = Path(__file__).parent.parent / "datasets" / "foodies_restaurants.csv"
+
+
+@pytest.fixture
+def embedder():
+    return FakeEmbedder()
+
+
+def make_repository(container: InMemoryContainer, embedder: FakeEmbedder) -> RestaurantRepository:
+    return RestaurantRepository(container=container, embed_documents=embedder, embedding_cache=EmbeddingCache())
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    path = tmp_path / "restaurants.csv"
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "name", "description", "price", "latitude", "longitude", "tags"])
+        for i in range(25):
+            location = ["", ""] if i % 5 == 0 else [35.6 + i / 100, 139.7]
+            writer.writerow([f"r{i}", f"Restaurant {i}", f"Dish number {i}", 1000 + i, *location, "寿司,日本料理"])
+    return path
+
+
+def test_read_csv_rows_streams_the_sample_dataset():
+    restaurants = list(read_csv_rows(SAMPLE_CSV))
+    assert restaurants
+    assert restaurants[0].tags == ["寿司", "日本料理", "高級"]
+    assert [restaurant.id for restaurant in read_csv_rows(SAMPLE_CSV, skip=2)] == [
+        restaurant.id for restaurant in restaurants[2:]
+    ]
+
+
+def test_import_embeds_in_batches_and_upserts_every_row(csv_file, embedder):
+    container = InMemoryContainer()
+    progress = []
+    result = import_restaurants(
+        make_repository(container, embedder),
+        csv_file,
+        batch_size=10,
+        concurrency=4,
+        checkpoint_file=csv_file.with_suffix(".checkpoint"),
+        on_progress=progress.append,
+    )
+
+    assert result.rows == 25 and result.resumed_rows == 0
+    assert [p.rows for p in progress] == [10, 20, 25]
+    assert [len(call) for call in embedder.calls] == [10, 10, 5]
+    assert sorted(container.items) == sorted(f"r{i}" for i in range(25))
+    assert container.items["r3"]["vector"] == embedder.embed("Dish number 3")
+    assert container.items["r3"]["location"] == {"type": "Point", "coordinates": [139.7, 35.63]}
+    assert "location" not in container.items["r5"]
+    assert not csv_file.with_suffix(".checkpoint").exists()
+
+
+def test_interrupted_import_resumes_from_checkpoint(csv_file, embedder):
+    checkpoint_file = csv_file.with_suffix(".checkpoint")
+    failing = InMemoryContainer(fail_on_upsert=15)
+    with pytest.raises(ConnectionError):
+        import_restaurants(make_repository(failing, embedder), csv_file, batch_size=10, checkpoint_file=checkpoint_file)
+    # Only the batch whose writes all completed is recorded
+    assert json.loads(checkpoint_file.read_text())["rows"] == 10
+
+    container = InMemoryContainer()
+    resumed_embedder = FakeEmbedder()
+    result = import_restaurants(
+        make_repository(container, resumed_embedder), csv_file, batch_size=10, checkpoint_file=checkpoint_file
+    )
+    assert result.resumed_rows == 10 and result.rows == 25
+    assert sorted(container.items) == sorted(f"r{i}" for i in range(10, 25))
+    assert [len(call) for call in resumed_embedder.calls] == [10, 5]
+    assert not checkpoint_file.exists()
+
+
+def test_reembed_refreshes_only_stale_vectors(csv_file, embedder, monkeypatch):
+    container = InMemoryContainer()
+    import_restaurants(make_repository(container, embedder), csv_file, batch_size=10)
+    assert container.items["r3"]["content_hash"] == content_hash("Dish number 3")
+    # Edited outside update_restaurant, written before content hashes, and embedded by another model
+    container.items["r3"]["description"] = "Seasonal tempura"
+    del container.items["r4"]["content_hash"]
+    container.items["r5"]["embedding_model"] = "text-embedding-ada-002@native"
+
+    reembedder = FakeEmbedder()
+    progress = []
+    result = reembed_restaurants(
+        make_repository(container, reembedder), batch_size=10, concurrency=4, on_progress=progress.append
+    )
+    assert (result.scanned, result.reembedded, result.conflicts) == (25, 3, 0)
+    assert [p.scanned for p in progress] == [10, 20, 25]
+    assert reembedder.calls == [["Seasonal tempura", "Dish number 4", "Dish number 5"]]
+    assert container.items["r3"]["vector"] == embedder.embed("Seasonal tempura")
+    assert container.items["r3"]["content_hash"] == content_hash("Seasonal tempura")
+    assert container.items["r3"]["location"] == {"type": "Point", "coordinates": [139.7, 35.63]}
+    assert reembed_restaurants(make_repository(container, FakeEmbedder())).reembedded == 0
+
+    # Changing the embedding dimensions makes every vector stale
+    monkeypatch.setattr(restaurants.azure_openai_settings, "azure_openai_embedding_dimensions", 8)
+    assert reembed_restaurants(make_repository(container, FakeEmbedder())).reembedded == 25
+
+
+def test_reembed_resumes_from_checkpoint_and_skips_concurrent_writes(csv_file, embedder):
+    container = InMemoryContainer()
+    import_restaurants(make_repository(container, embedder), csv_file, batch_size=10)
+    checkpoint_file = csv_file.with_suffix(".reembed")
+    container.fail_on_replace = 15
+    with pytest.raises(ConnectionError):
+        reembed_restaurants(
+            make_repository(container, FakeEmbedder()), batch_size=10, checkpoint_file=checkpoint_file, force=True
+        )
+    # Only the page whose writes all completed is recorded
+    assert json.loads(checkpoint_file.read_text())["scanned"] == 10
+
+    class ConcurrentlyUpdatedContainer(InMemoryContainer):
+        def replace_item(self, item: str, body: dict, etag: str | None = None, match_condition=None) -> dict:
+            if item == "r20" and self.items[item]["_etag"] == etag:
+                self._write(self.items[item])
+            return super().replace_item(item, body, etag, match_condition)
+
+    resumed = ConcurrentlyUpdatedContainer()
+    resumed.items = container.items
+    resumed_embedder = FakeEmbedder()
+    result = reembed_restaurants(
+        make_repository(resumed, resumed_embedder), batch_size=10, checkpoint_file=checkpoint_file, force=True
+    )
+    assert (result.scanned, result.reembedded, result.conflicts) == (25, 24, 1)
+    assert [len(call) for call in resumed_embedder.calls] == [10, 5]
+    assert not checkpoint_file.exists()
+
+
+def test_async_repository_reuses_embeddings_and_awaits_the_container(embedder):
+    container = AsyncInMemoryContainer()
+    repository = AsyncRestaurantRepository(
+        container=container, embed_documents=embedder, embedding_cache=EmbeddingCache()
+    )
+
+    async def scenario():
+        created = await repository.create_restaurant(
+            Restaurant(id="sushi", name="Sushi", description="Fresh nigiri", price=3000, latitude=35.6, longitude=139.7)
+        )
+        assert container.items[created.id]["vector"] == embedder.embed("Fresh nigiri")
+        assert container.items[created.id]["location"] == {"type": "Point", "coordinates": [139.7, 35.6]}
+        assert await repository.get_restaurant(created.id) == created
+
+        # Unchanged descriptions keep the stored vector
+        updated = await repository.update_restaurant(created.id, created.model_copy(update={"price": 3500}))
+        assert updated.price == 3500
+        assert len(embedder.calls) == 1
+
+        # Search queries hit the embedding cache
+        assert await repository.search_restaurants("Fresh nigiri") == [updated]
+        assert container.queries[-1][1] == [
+            {"name": "@queryVector", "value": embedder.embed("Fresh nigiri")},
+            {"name": "@offset", "value": 0},
+            {"name": "@limit", "value": 3},
+        ]
+        assert len(embedder.calls) == 1
+
+        await repository.delete_restaurant(created.id)
+        assert await repository.list_restaurants() == []
+
+    asyncio.run(scenario())
+
+
+def test_write_behind_patches_vectors_after_the_write(embedder, monkeypatch):
+    monkeypatch.setattr(restaurants.restaurants_settings, "restaurant_embedding_mode", "write_behind")
+    container = AsyncInMemoryContainer()
+    repository = AsyncRestaurantRepository(
+        container=container, embed_documents=embedder, embedding_cache=EmbeddingCache()
+    )
+
+    async def scenario():
+        created = await repository.create_restaurant(
+            Restaurant(id="eel", name="Eel", description="Grilled eel", price=2800)
+        )
+        assert container.items["eel"]["vector_status"] == "pending"
+        assert "vector" not in container.items["eel"]
+        assert repository.embedding_worker.depth == 1
+
+        await repository.embedding_worker.join()
+        assert container.items["eel"]["vector"] == embedder.embed("Grilled eel")
+        assert "vector_status" not in container.items["eel"]
+        assert await repository.search_restaurants("Grilled eel") == [created]
+
+        # The job for an overwritten description is superseded instead of patching a stale vector
+        await repository.update_restaurant("eel", created.model_copy(update={"description": "Eel on rice"}))
+        await repository.update_restaurant("eel", created.model_copy(update={"description": "Eel with sansho"}))
+        await repository.close()
+        assert embedder.calls[-1] == ["Eel on rice", "Eel with sansho"]
+        assert container.items["eel"]["vector"] == embedder.embed("Eel with sansho")
+        assert "vector_status" not in container.items["eel"]
+
+        # A hash that could escape the patch condition is rejected before anything is written
+        with pytest.raises(ValueError, match="Invalid content hash"):
+            await repository.apply_embedding(EmbeddingJob("eel", "Eel", '" OR c.id = "eel'), embedder.embed("Eel"))
+        assert container.items["eel"]["vector"] == embedder.embed("Eel with sansho")
+
+    asyncio.run(scenario())
+
+
+def test_write_behind_retries_and_leaves_failures_pending_for_reembed(embedder, monkeypatch):
+    monkeypatch.setattr(restaurants.restaurants_settings, "restaurant_embedding_mode", "write_behind")
+    monkeypatch.setattr(restaurants.restaurants_settings, "restaurant_embedding_max_retries", 2)
+    monkeypatch.setattr(restaurants.restaurants_settings, "restaurant_embedding_retry_backoff_seconds", 0)
+    failures = iter([True, False, True, True, True])
+
+    def flaky_embedder(texts: list[str]) -> list[list[float]]:
+        if next(failures):
+            raise ConnectionError("Rate limited")
+        return embedder(texts)
+
+    container = AsyncInMemoryContainer()
+    repository = AsyncRestaurantRepository(
+        container=container, embed_documents=flaky_embedder, embedding_cache=EmbeddingCache()
+    )
+
+    async def scenario():
+        # Succeeds on the first retry
+        await repository.create_restaurant(Restaurant(id="soba", name="Soba", description="Cold soba", price=900))
+        await repository.embedding_worker.join()
+        assert "vector_status" not in container.items["soba"]
+        # Fails the first attempt and both retries
+        await repository.create_restaurant(Restaurant(id="udon", name="Udon", description="Curry udon", price=1100))
+        await repository.close()
+
+    asyncio.run(scenario())
+    assert container.items["udon"]["vector_status"] == "pending"
+
+    synced = InMemoryContainer()
+    synced.items = container.items
+    result = reembed_restaurants(make_repository(synced, FakeEmbedder()))
+    assert result.reembedded == 1
+    assert synced.items["udon"]["vector"] == embedder.embed("Curry udon")
+    assert "vector_status" not in synced.items["udon"]
+
+
+def test_write_behind_drops_rejected_jobs_without_retrying():
+    applied: list[str] = []
+
+    async def embed(texts: list[str]) -> list[list[float]]:
+        return [[0.0] for _ in texts]
+
+    async def apply(job: EmbeddingJob, vector: list[float]) -> bool:
+        applied.append(job.restaurant_id)
+        if job.restaurant_id == "bad":
+            raise ValueError("Invalid content hash")
+        if applied.count(job.restaurant_id) == 1:
+            raise ConnectionError("Service unavailable")
+        return True
+
+    worker = EmbeddingWriteBehind(embed, apply, workers=1, max_retries=3, retry_backoff=0)
+
+    async def scenario():
+        worker.enqueue(EmbeddingJob("bad", "Bad", "not a hash"))
+        worker.enqueue(EmbeddingJob("ok", "Ok", content_hash("Ok")))
+        await worker.stop()
+
+    asyncio.run(scenario())
+    # The validation failure is attempted once, while the transport error is retried
+    assert applied.count("bad") == 1
+    assert applied.count("ok") == 2
+
+
+def test_vector_index_matches_brute_force():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((500, 16)).astype(np.float32)
+    restaurants = [Restaurant(id=f"r{i}", name=f"Restaurant {i}", price=1000) for i in range(len(vectors))]
+    index = RestaurantVectorIndex()
+    index.load(list(zip(restaurants, vectors.tolist())))
+
+    # Drop and replace a few rows to exercise the compaction of the matrix
+    index.remove("r0")
+    index.remove("missing")
+    vectors[7] = rng.standard_normal(16)
+    index.add_many([(restaurants[7], vectors[7].tolist())])
+    index.add_many([(restaurants[8], None)])
+    live = [i for i in range(len(vectors)) if i not in (0, 8)]
+    assert len(index) == len(live) and "r8" not in index
+
+    queries = rng.standard_normal((4, 16)).astype(np.float32)
+    normalized = vectors[live] / np.linalg.norm(vectors[live], axis=1, keepdims=True)
+    for query, results in zip(queries, index.search_many(queries.tolist(), k=10, offset=5)):
+        expected = [live[row] for row in np.argsort(-(normalized @ query))[5:15]]
+        assert [restaurant.id for restaurant in results] == [f"r{i}" for i in expected]
+    assert len(index.search(queries[0].tolist(), k=10, offset=len(live) - 3)) == 3
+    assert index.search(queries[0].tolist(), k=10, offset=len(live)) == []
+
+
+@pytest.mark.parametrize("storage, ratio, min_recall", [("float16", 2, 0.99), ("int8", 4, 0.95)])
+def test_quantized_vector_index_keeps_recall(storage, ratio, min_recall):
+    rng = np.random.default_rng(0)
+    # Clustered vectors, so that the nearest neighbours are close and precision matters
+    centers = rng.standard_normal((20, 64))
+    vectors = (centers[rng.integers(0, 20, 2000)] + 0.3 * rng.standard_normal((2000, 64))).astype(np.float32)
+    restaurants = [Restaurant(id=f"r{i}", name=f"Restaurant {i}", price=1000) for i in range(len(vectors))]
+    exact, quantized = RestaurantVectorIndex(), RestaurantVectorIndex(storage)
+    exact.load(list(zip(restaurants, vectors.tolist())))
+    quantized.load(list(zip(restaurants, vectors.tolist())))
+    quantized.remove("r0")
+    exact.remove("r0")
+    # int8 rows also keep a float32 scale
+    assert quantized.nbytes <= exact.nbytes / ratio + 4 * len(quantized)
+
+    queries = (centers[:10] + 0.3 * rng.standard_normal((10, 64))).tolist()
+    hits = sum(
+        len({r.id for r in a} & {r.id for r in b})
+        for a, b in zip(exact.search_many(queries, k=10), quantized.search_many(queries, k=10))
+    )
+    assert hits / 100 >= min_recall
+
+
+@pytest.mark.parametrize("storage", ["float32", "int8"])
+def test_two_stage_search_shortlists_with_leading_dimensions(storage):
+    rng = np.random.default_rng(0)
+    # Like Matryoshka embeddings, the leading dimensions carry most of the signal
+    weights = (1 + np.arange(128)) ** -0.75
+    centers = rng.standard_normal((50, 128)) * weights
+    vectors = (centers[rng.integers(0, 50, 3000)] + 0.3 * rng.standard_normal((3000, 128)) * weights).astype(np.float32)
+    restaurants = [Restaurant(id=f"r{i}", name=f"Restaurant {i}", price=1000) for i in range(len(vectors))]
+    single, two_stage = RestaurantVectorIndex(storage), RestaurantVectorIndex(storage, search_dimensions=32)
+    for index in (single, two_stage):
+        index.load(list(zip(restaurants, vectors.tolist())))
+        index.remove("r1")
+        index.add_many([(restaurants[2], (-vectors[2]).tolist())])
+    assert single.nbytes < two_stage.nbytes <= single.nbytes * 1.3
+
+    queries = (centers[:20] + 0.3 * rng.standard_normal((20, 128)) * weights).tolist()
+    expected, results = single.search_many(queries, k=10, offset=2), two_stage.search_many(queries, k=10, offset=2)
+    hits = sum(len({r.id for r in a} & {r.id for r in b}) for a, b in zip(expected, results))
+    assert hits / 200 >= 0.9
+    assert all(len(result) == 10 for result in results)
+    # Search dimensions that are not shorter than the vectors fall back to single-stage search
+    full = RestaurantVectorIndex(storage, search_dimensions=128)
+    full.load(list(zip(restaurants[:10], vectors[:10].tolist())))
+    assert full._prefixes is None
+
+
+def test_quantize_vector_round_trips_compactly():
+    vector = (np.random.default_rng(0).standard_normal(256) / 16).tolist()
+    assert quantize_vector(vector, "float32") == {"vector": vector}
+    for storage, tolerance in [("float16", 1e-3), ("int8", 2e-3)]:
+        item = quantize_vector(vector, storage)
+        assert len(json.dumps(item)) < len(json.dumps(vector)) / 2
+        assert np.allclose(dequantize_vector(item), vector, atol=tolerance)
+    assert all(isinstance(value, int) and -127 <= value <= 127 for value in quantize_vector(vector, "int8")["vector"])
+
+
+def test_quantized_storage_reranks_cosmos_candidates(embedder, monkeypatch):
+    monkeypatch.setattr(restaurants.restaurants_settings, "restaurant_vector_storage", "int8")
+    container = AsyncInMemoryContainer()
+    repository = AsyncRestaurantRepository(
+        container=container,
+        embed_documents=embedder,
+        embedding_cache=EmbeddingCache(),
+        result_cache=RestaurantResultCache(ttl=0),
+    )
+
+    async def scenario():
+        for i, description in enumerate(["Ramen", "Udon", "Tempura", "Fresh nigiri"]):
+            await repository.create_restaurant(
+                Restaurant(id=f"r{i}", name=description, description=description, price=1)
+            )
+        assert isinstance(container.items["r3"]["vector_scale"], float)
+        assert all(isinstance(value, int) for value in container.items["r3"]["vector"])
+
+        # The in-memory container ignores ORDER BY, so the order comes from the client-side re-ranking
+        assert [r.id for r in await repository.search_restaurants("Fresh nigiri", k=1)] == ["r3"]
+        query, parameters = container.queries[-1]
+        # Candidates come back with the float32 copy instead of the quantized vector
+        projection = query.split("FROM")[0]
+        assert "SELECT TOP @top" in projection and "c.vector_exact" in projection and "c.vector," not in projection
+        assert np.allclose(exact_vector(container.items["r3"]) or [], embedder.embed("Fresh nigiri"))
+        assert parameters is not None
+        assert parameters[1] == {"name": "@top", "value": 4}
+
+        # Unchanged descriptions keep their stored vector through the dequantised round trip
+        await repository.update_restaurant("r3", Restaurant(id="r3", name="Sushi", description="Fresh nigiri", price=2))
+        assert container.items["r3"]["vector"] == quantize_vector(embedder.embed("Fresh nigiri"), "int8")["vector"]
+
+    asyncio.run(scenario())
+
+
+def test_quantized_rerank_restores_the_exact_order(monkeypatch):
+    monkeypatch.setattr(restaurants.restaurants_settings, "restaurant_vector_storage", "int8")
+    # Rounded to int8, B's vector scores closer to the query than A's, although A is closer
+    vectors = {"query": [1.0, 0.0, 0.0], "A": [1.0, 0.0157, 0.005], "B": [1.0, 0.0015, 0.0193]}
+    quantized = {name: dequantize_vector(quantize_vector(vectors[name], "int8")) for name in ("A", "B")}
+    assert rerank(vectors["query"], [vectors["A"], vectors["B"]]) == [0, 1]
+    assert rerank(vectors["query"], [quantized["A"], quantized["B"]]) == [1, 0]
+
+    container = AsyncInMemoryContainer()
+    repository = AsyncRestaurantRepository(
+        container=container,
+        embed_documents=lambda texts: [vectors[text] for text in texts],
+        embedding_cache=EmbeddingCache(),
+        result_cache=RestaurantResultCache(ttl=0),
+    )
+
+    async def scenario():
+        # The in-memory container ignores ORDER BY, so B comes back first as Cosmos DB would rank it
+        for name in ("B", "A"):
+            await repository.create_restaurant(Restaurant(id=name, name=name, description=name, price=1))
+        assert [r.id for r in await repository.search_restaurants("query", k=2)] == ["A", "B"]
+
+        # Documents written without the float32 copy keep Cosmos DB's order
+        del container.items["A"]["vector_exact"]
+        assert [r.id for r in await repository.search_restaurants("query", k=2)] == ["B", "A"]
+
+    asyncio.run(scenario())
+
+
+def test_local_search_backend_loads_once_and_follows_writes(embedder):
+    container = AsyncInMemoryContainer()
+    repository = AsyncRestaurantRepository(
+        container=container,
+        embed_documents=embedder,
+        embedding_cache=EmbeddingCache(),
+        vector_index=RestaurantVectorIndex(),
+    )
+    container.items["old"] = {"id": "old", "name": "Old", "price": 500, "vector": embedder.embed("Ramen")}
+
+    async def scenario():
+        created = await repository.create_restaurant(Restaurant(id="new", name="New", description="Sushi", price=900))
+        assert [r.id for r in await repository.search_restaurants("Ramen", k=1)] == ["old"]
+        assert [r.id for r in await repository.search_restaurants("Sushi", k=1)] == ["new"]
+        # The vectors were loaded with a single query; searches do not hit the container
+        assert len(container.queries) == 1
+
+        await repository.update_restaurant("new", created.model_copy(update={"description": "Udon"}))
+        assert [r.description for r in await repository.search_restaurants("Udon", k=1)] == ["Udon"]
+        await repository.delete_restaurant("old")
+        assert [r.id for r in await repository.search_restaurants("Ramen", k=5)] == ["new"]
+        assert len(container.queries) == 1
+
+    asyncio.run(scenario())
+
+
+def test_haversine_and_bounding_box():
+    assert haversine_km(0, 0, np.array([0.0, 1.0]), np.array([1.0, 0.0])) == pytest.approx([111.195, 111.195], abs=1e-3)
+    min_latitude, max_latitude, min_longitude, max_longitude = bounding_box(35.68, 139.77, 5)
+    corners = haversine_km(35.68, 139.77, np.array([min_latitude, 35.68]), np.array([139.77, max_longitude]))
+    assert corners[0] == pytest.approx(5) and corners[1] >= 5
+    # Ranges crossing the antimeridian or a pole cover every longitude
+    assert bounding_box(10, 179.99, 50)[2:] == (-180.0, 180.0)
+    assert bounding_box(89.9, 0, 50)[1:] == (90.0, -180.0, 180.0)
+
+
+def test_geo_index_matches_brute_force():
+    rng = np.random.default_rng(0)
+    latitudes = 35.68 + rng.uniform(-0.3, 0.3, 2000)
+    longitudes = 139.77 + rng.uniform(-0.3, 0.3, 2000)
+    restaurants = [
+        Restaurant(id=f"r{i}", name=f"Restaurant {i}", price=1000, latitude=latitude, longitude=longitude)
+        for i, (latitude, longitude) in enumerate(zip(latitudes, longitudes))
+    ]
+    index = RestaurantGeoIndex(cell_km=2)
+    index.load([*restaurants, Restaurant(id="nowhere", name="Nowhere", price=1000)])
+    assert "nowhere" not in index
+
+    # Move, drop and un-locate a few restaurants
+    latitudes[3], longitudes[3] = 35.68, 139.77
+    index.add_many([restaurants[3].model_copy(update={"latitude": 35.68, "longitude": 139.77})])
+    index.remove("r0")
+    index.add_many([restaurants[1].model_copy(update={"latitude": None})])
+    live = np.arange(2, len(restaurants))
+
+    for distance_km in [0.5, 3, 10, 100]:
+        distances = haversine_km(35.68, 139.77, latitudes[live], longitudes[live])
+        expected = [f"r{live[i]}" for i in np.argsort(distances, kind="stable") if distances[i] <= distance_km]
+        results = index.search(35.68, 139.77, distance_km, limit=20, offset=2)
+        assert [restaurant.id for restaurant, _ in results] == expected[2:22]
+        assert [distance for _, distance in results] == sorted(distance for _, distance in results)
+    assert index.search(35.68, 139.77, 0.001)[0][0].id == "r3"
+
+
+def test_nearby_search_sorts_by_distance_on_both_backends(embedder):
+    container = AsyncInMemoryContainer()
+    for i, latitude in enumerate([35.70, 35.68, 35.69]):
+        container.items[f"r{i}"] = {
+            "id": f"r{i}",
+            "name": f"Restaurant {i}",
+            "price": 1000,
+            "location": {"type": "Point", "coordinates": [139.77, latitude]},
+        }
+    cosmos = AsyncRestaurantRepository(container=container, embed_documents=embedder, embedding_cache=EmbeddingCache())
+    local = AsyncRestaurantRepository(
+        container=container,
+        embed_documents=embedder,
+        embedding_cache=EmbeddingCache(),
+        geo_index=RestaurantGeoIndex(),
+    )
+
+    async def scenario():
+        for repository in [cosmos, local]:
+            results = await repository.find_nearby_restaurants(35.68, 139.77, distance_km=5, limit=2)
+            assert [restaurant.id for restaurant in results] == ["r1", "r2"]
+            assert results[1].distance_km == pytest.approx(1.112, abs=1e-3)
+        query, parameters = container.queries[0]
+        assert "BETWEEN @minLatitude AND @maxLatitude" in query
+        assert {parameter["name"]: parameter["value"] for parameter in parameters}["@distance"] == 5000
+
+        await local.delete_restaurant("r1")
+        assert [restaurant.id for restaurant in await local.find_nearby_restaurants(35.68, 139.77)] == ["r2", "r0"]
+        # The local index was loaded with a single query
+        assert len(container.queries) == 2
+
+    asyncio.run(scenario())
+
+
+def test_result_cache_expires_evicts_and_invalidates(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(restaurant_cache.time, "monotonic", lambda: now[0])
+    cache = RestaurantResultCache(ttl=10, max_size=2)
+    calls = []
+
+    def compute(key):
+        calls.append(key)
+        return [key, len(calls)]
+
+    assert cache.get_or_compute("a", lambda: compute("a")) == ["a", 1]
+    assert cache.get_or_compute("a", lambda: compute("a")) == ["a", 1]
+    cache.get_or_compute("b", lambda: compute("b"))
+    cache.get_or_compute("a", lambda: compute("a"))
+    cache.get_or_compute("c", lambda: compute("c"))
+    # "b" was the least recently used entry
+    assert cache.get_or_compute("b", lambda: compute("b")) == ["b", 4]
+    now[0] = 11
+    assert cache.get_or_compute("b", lambda: compute("b")) == ["b", 5]
+    cache.invalidate()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (2, 5)
+
+    # Failures are not cached
+    with pytest.raises(ZeroDivisionError):
+        cache.get_or_compute("d", lambda: 1 / 0)
+    assert cache.get_or_compute("d", lambda: "d") == "d"
+    assert RestaurantResultCache(ttl=0).get_or_compute("a", lambda: compute("a")) == ["a", 6]
+
+
+def test_result_cache_coalesces_concurrent_misses():
+    cache = RestaurantResultCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return ["result"]
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute)))
+    leader.start()
+    started.wait(5)
+    followers = [
+        threading.Thread(target=lambda: results.append(cache.get_or_compute("key", compute))) for _ in range(4)
+    ]
+    for follower in followers:
+        follower.start()
+
+    async def await_inflight():
+        return await cache.aget_or_compute("key", compute)
+
+    waiter = threading.Thread(target=lambda: results.append(asyncio.run(await_inflight())))
+    waiter.start()
+    while cache.coalesced < 5:
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in [leader, *followers, waiter]:
+        thread.join(5)
+    assert results == [["result"]] * 6
+    assert len(calls) == 1
+
+
+def test_result_cache_drops_results_computed_before_an_invalidation():
+    cache = RestaurantResultCache()
+
+    async def scenario():
+        computing = asyncio.Event()
+        release = asyncio.Event()
+
+        async def compute():
+            computing.set()
+            await release.wait()
+            return "stale"
+
+        leader = asyncio.create_task(cache.aget_or_compute("key", compute))
+        await computing.wait()
+        cache.invalidate()
+
+        async def fresh():
+            return "fresh"
+
+        # Requests after the write do not join the computation started before it
+        assert await cache.aget_or_compute("key", fresh) == "fresh"
+        release.set()
+        assert await leader == "stale"
+        assert await cache.aget_or_compute("key", compute) == "fresh"
+
+    asyncio.run(scenario())
+
+
+def test_repository_caches_results_until_a_write(embedder):
+    container = AsyncInMemoryContainer()
+    container.items["r0"] = {
+        "id": "r0",
+        "name": "Restaurant 0",
+        "price": 1000,
+        "vector": embedder.embed("Ramen"),
+        "location": {"type": "Point", "coordinates": [139.77, 35.68]},
+    }
+    repository = AsyncRestaurantRepository(
+        container=container,
+        embed_documents=embedder,
+        embedding_cache=EmbeddingCache(),
+        result_cache=RestaurantResultCache(),
+    )
+
+    async def scenario():
+        assert [r.id for r in await repository.search_restaurants("Ramen")] == ["r0"]
+        assert [r.id for r in await repository.search_restaurants("  Ramen ")] == ["r0"]
+        # Coordinates within the rounding precision share one query
+        await repository.find_nearby_restaurants(35.68001, 139.77001)
+        nearby = await repository.find_nearby_restaurants(35.67999, 139.76999)
+        assert nearby[0].distance_km == 0
+        await repository.list_restaurants()
+        await repository.list_restaurants()
+        assert len(container.queries) == 3
+
+        await repository.delete_restaurant("r0")
+        assert await repository.search_restaurants("Ramen") == []
+        assert await repository.list_restaurants() == []
+        assert len(container.queries) == 5
+
+    asyncio.run(scenario())
+
+
+def test_point_reads_are_cached_and_revalidated_with_etags(embedder, monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(restaurant_cache.time, "monotonic", lambda: now[0])
+    container = AsyncInMemoryContainer()
+    item_cache = RestaurantItemCache(fresh_for=5)
+    repository = AsyncRestaurantRepository(
+        container=container, embed_documents=embedder, embedding_cache=EmbeddingCache(), item_cache=item_cache
+    )
+
+    async def scenario():
+        created = await repository.create_restaurant(
+            Restaurant(id="r0", name="Ramen", description="Tonkotsu", price=900)
+        )
+        etag = container.items["r0"]["_etag"]
+        assert await repository.get_restaurant("r0") == created
+        assert await repository.get_restaurant("r0") == created
+        assert container.reads == [None]
+
+        # After the freshness window an unchanged item is revalidated without its body
+        now[0] = 6
+        assert await repository.get_restaurant("r0") == created
+        assert await repository.get_restaurant("r0") == created
+        assert container.reads == [None, etag]
+
+        # Writes from elsewhere are picked up at the next revalidation
+        await container.replace_item("r0", {**container.items["r0"], "price": 950})
+        now[0] = 12
+        assert (await repository.get_restaurant("r0")).price == 950
+        assert container.reads == [None, etag, etag]
+
+        # Writes through the repository invalidate the entry
+        await repository.update_restaurant("r0", created.model_copy(update={"price": 1000}))
+        assert (await repository.get_restaurant("r0")).price == 1000
+        await repository.delete_restaurant("r0")
+        with pytest.raises(CosmosResourceNotFoundError):
+            await repository.get_restaurant("r0")
+        assert (item_cache.fresh, item_cache.revalidated, item_cache.fetched) == (2, 1, 3)
+
+    asyncio.run(scenario())
+
+    # A read that raced a write is not cached
+    def read_during_write(etag: str | None) -> tuple[str, str]:
+        item_cache.invalidate("r1")
+        return "etag", "before the write"
+
+    assert item_cache.get("r1", read_during_write) == "before the write"
+    assert len(item_cache) == 0
+
+    # A 304 for an entry evicted during the conditional read is followed by a read without the ETag
+    small_cache = RestaurantItemCache(fresh_for=5, max_size=1)
+    small_cache.get("r2", lambda etag: ("etag-2", "cached"))
+    now[0] = 30
+    reads = []
+
+    def read_after_eviction(etag: str | None) -> tuple[str, str] | None:
+        reads.append(etag)
+        if etag is None:
+            return "etag-3", "read again"
+        small_cache.get("r3", lambda etag: ("etag-r3", "evicts r2"))
+        return None
+
+    assert small_cache.get("r2", read_after_eviction) == "read again"
+    assert reads == ["etag-2", None]
+    assert small_cache.get("r2", read_after_eviction) == "read again"
+    assert (small_cache.fresh, small_cache.revalidated, small_cache.fetched) == (1, 0, 3)
+    assert RestaurantItemCache(max_size=0).get("r1", lambda etag: ("etag", etag)) is None
+
+
+def test_cursor_pagination_follows_continuation_tokens(embedder):
+    container = AsyncInMemoryContainer()
+    for i in range(7):
+        container.items[f"r{i}"] = {
+            "id": f"r{i}",
+            "name": f"Restaurant {i}",
+            "price": 1000,
+            "vector": embedder.embed(f"Dish {i}"),
+            "location": {"type": "Point", "coordinates": [139.77, 35.68 + i / 1000]},
+        }
+    repository = AsyncRestaurantRepository(
+        container=container,
+        embed_documents=embedder,
+        embedding_cache=EmbeddingCache(),
+        result_cache=RestaurantResultCache(ttl=0),
+    )
+
+    async def pages(fetch) -> list[list[str]]:
+        ids, cursor = [], ""
+        while cursor is not None:
+            restaurants, cursor = await fetch(cursor)
+            ids.append([restaurant.id for restaurant in restaurants])
+        return ids
+
+    async def scenario():
+        assert await pages(lambda cursor: repository.list_restaurants_after(cursor, limit=3)) == [
+            ["r0", "r1", "r2"],
+            ["r3", "r4", "r5"],
+            ["r6"],
+        ]
+        assert container.queries[-1][0].startswith("SELECT c.id") and "vector" not in container.queries[-1][0]
+
+        search_pages = await pages(lambda cursor: repository.search_restaurants_after("Dish", cursor, k=4))
+        assert [len(page) for page in search_pages] == [4, 3]
+        query, parameters = container.queries[-1]
+        assert "SELECT TOP @top" in query and "OFFSET" not in query
+        assert {parameter["name"] for parameter in parameters} == {"@queryVector", "@top"}
+
+        nearby_pages = await pages(
+            lambda cursor: repository.find_nearby_restaurants_after(35.68, 139.77, cursor, distance_km=5, limit=5)
+        )
+        assert nearby_pages == [["r0", "r1", "r2", "r3", "r4"], ["r5", "r6"]]
+
+        # Cursors are tied to the query they were issued for
+        _, cursor = await repository.search_restaurants_after("Dish", k=4)
+        with pytest.raises(InvalidCursorError):
+            await repository.search_restaurants_after("Ramen", cursor, k=4)
+        with pytest.raises(InvalidCursorError):
+            await repository.list_restaurants_after("not a cursor")
+
+    asyncio.run(scenario())
+
+    # The local index pages with offsets inside the cursor
+    repository.vector_index = RestaurantVectorIndex()
+    local_pages = asyncio.run(pages(lambda cursor: repository.search_restaurants_after("Dish 3", cursor, k=4)))
+    assert [len(page) for page in local_pages] == [4, 3] and local_pages[0][0] == "r3"
+
+
+def test_queries_project_api_fields_and_endpoints_return_sparse_fields(embedder, monkeypatch):
+    container = AsyncInMemoryContainer()
+    repository = AsyncRestaurantRepository(
+        container=container,
+        embed_documents=embedder,
+        embedding_cache=EmbeddingCache(),
+        result_cache=RestaurantResultCache(ttl=0),
+    )
+    asyncio.run(
+        repository.create_restaurant(
+            Restaurant(
+                id="r1", name="Sushi Bar", description="Fresh nigiri", price=3000, latitude=35.68, longitude=139.77
+            )
+        )
+    )
+    monkeypatch.setattr(foodies, "restaurant_repo", repository)
+    client = TestClient(app)
+
+    # Only the API fields are read from Cosmos DB, never the embedding vector
+    restaurants = client.get("/foodies/restaurants/").json()
+    assert restaurants == [
+        {
+            "id": "r1",
+            "name": "Sushi Bar",
+            "description": "Fresh nigiri",
+            "price": 3000.0,
+            "latitude": 35.68,
+            "longitude": 139.77,
+            "tags": [],
+        }
+    ]
+    client.get("/foodies/restaurants/search/", params={"query": "nigiri"})
+    client.get("/foodies/restaurants/near/", params={"latitude": 35.68, "longitude": 139.77})
+    assert all("*" not in query and "SELECT c.id" in query for query, _ in container.queries)
+
+    assert client.get("/foodies/restaurants/", params={"fields": "id, name"}).json() == [
+        {"id": "r1", "name": "Sushi Bar"}
+    ]
+    assert client.get("/foodies/restaurants/", params={"fields": "name", "cursor": ""}).json() == {
+        "restaurants": [{"name": "Sushi Bar"}],
+        "next_cursor": None,
+    }
+    nearby = client.get(
+        "/foodies/restaurants/near/", params={"latitude": 35.68, "longitude": 139.77, "fields": "id,distance_km"}
+    ).json()
+    assert nearby == [{"id": "r1", "distance_km": 0.0}]
+    assert client.get("/foodies/restaurants/search/", params={"query": "nigiri", "fields": "vector"}).status_code == 400